@@ -4,14 +4,22 @@ Paul Szypryt
 July 8, 2016
 
 Takes the frequency, I, and Q values around a single microwave resonator as inputs.  Adjusts the loop for the cable delay and fits the position of the center.
+fitLoops() does the same for every resonator of a sweep at once.
 """
 
-import matplotlib.pyplot as plt
 import numpy as np
 import scipy.linalg
 
+# Constraint matrix for B^2 + C^2 - 4AD = 1, see LoopFitter()
+BMAT = np.array([[0.0, 0.0, 0.0, -2.0],
+                 [0.0, 1.0, 0.0, 0.0],
+                 [0.0, 0.0, 1.0, 0.0],
+                 [-2.0, 0.0, 0.0, 0.0]])
+
 
 def RemoveDelay(IData, QData, frequencyData, tau):
+    # Arrays broadcast, so a [nFreqs, nSteps] sweep can be corrected with a [nSteps] or [nFreqs, nSteps]
+    # frequencyData in one call
     delayAngle = 2.0*np.pi*frequencyData*tau
 
     IRemoved = IData*np.cos(delayAngle) - QData*np.sin(delayAngle)
@@ -109,47 +117,121 @@ def LoopFitter(IData, QData):
 
 
 
-#....................................................................................
-# Test cases for above function
-
-# Load an IQ sweep file, separate out I, Q and frequency
-testFile = 'iqdata_jul_8_veruna_4.620303GHz.npz'
-testData = np.load(testFile)
-testI = testData['i']
-testQ = testData['q']
-testFrequencies = testData['freqs']*10.0**6
-
-
-# Synthetic circle test case, no cable delay
-syntheticTheta = np.linspace(0.0,2.0*np.pi,101)
-syntheticError = np.random.randn(101)/10
-syntheticICenter = np.random.randn()
-syntheticQCenter = np.random.randn()
-
-syntheticFrequencyData = np.linspace(4.0,4.2,101)
-
-syntheticIData = syntheticICenter + (np.cos(syntheticTheta) + syntheticError)
-syntheticQData = syntheticQCenter + (np.sin(syntheticTheta) + syntheticError)
-
-#print 'Expected I Center: ' + str(syntheticICenter)
-#print 'Expected Q Center: ' + str(syntheticQCenter)
-
-#LoopFitter(syntheticIData, syntheticQData, syntheticFrequencyData)
+def fitLoops(IData, QData, frequencyData=None, tau=0.):
+    """
+    Batched LoopFitter(). Fits a circle to every row of IData, QData at once by solving the stacked 4x4
+    generalized eigenproblems built from each row's moments
 
-testTau = 40.0*10.0**-9
-
-print testFrequencies
-
-IRemoved, QRemoved = RemoveDelay(testI, testQ, testFrequencies, testTau)
-
-
-ICenter, QCenter, circleRadius = LoopFitter(testI, testQ)
-ICenterRemoved, QCenterRemoved, circleRadiusRemoved = LoopFitter(IRemoved, QRemoved)
-
-plt.plot(testI, testQ, 'b.', ICenter, QCenter, 'bo', IRemoved, QRemoved, 'r.', ICenterRemoved, QCenterRemoved, 'r.')
-plt.show()
-
-#plt.plot(testI, testQ, 'b.', ICenter, QCenter, 'ro')
-#plt.show()
+    INPUTS:
+        IData, QData - [..., nPoints] arrays, e.g. [nFreqs, nSteps] from an IQ sweep
+        frequencyData - frequencies in Hz broadcastable to IData. Only used to remove the cable delay
+        tau - cable delay in seconds. If nonzero the delay is removed with RemoveDelay() before fitting
+    OUTPUTS:
+        xCen, yCen, radius - arrays of shape IData.shape[:-1]. NaN where the fit failed
+    """
+    x = np.asarray(IData, dtype=float)
+    y = np.asarray(QData, dtype=float)
+    if tau:
+        x, y = RemoveDelay(x, y, frequencyData, tau)
+    batchShape = x.shape[:-1]
+    n = x.shape[-1]
+    x = x.reshape(-1, n)
+    y = y.reshape(-1, n)
 
+    # The fit is translation invariant. Center the data so the moments are well conditioned
+    xMean = x.mean(axis=1, keepdims=True)
+    yMean = y.mean(axis=1, keepdims=True)
+    x = x - xMean
+    y = y - yMean
+    w = x**2 + y**2
 
+    # Calculate moments, same layout as LoopFitter()
+    Mww = np.sum(w*w, axis=1)
+    Mxw = np.sum(x*w, axis=1)
+    Myw = np.sum(y*w, axis=1)
+    Mw = np.sum(w, axis=1)
+    Mxx = np.sum(x*x, axis=1)
+    Mxy = np.sum(x*y, axis=1)
+    Mx = np.sum(x, axis=1)
+    Myy = np.sum(y*y, axis=1)
+    My = np.sum(y, axis=1)
+    nn = np.full(Mw.shape, float(n))
+    MMat = np.stack([np.stack([Mww, Mxw, Myw, Mw], axis=-1),
+                     np.stack([Mxw, Mxx, Mxy, Mx], axis=-1),
+                     np.stack([Myw, Mxy, Myy, My], axis=-1),
+                     np.stack([Mw, Mx, My, nn], axis=-1)], axis=-2)
+
+    # B is invertible, so M*A=eta*B*A is the ordinary eigenproblem inv(B)*M*A=eta*A
+    xCen = np.full(len(x), np.nan)
+    yCen = np.full(len(x), np.nan)
+    radius = np.full(len(x), np.nan)
+    good = np.all(np.isfinite(MMat.reshape(len(x), -1)), axis=1)
+    if np.any(good):
+        eigenvalues, eigenvectors = np.linalg.eig(np.matmul(np.linalg.inv(BMAT), MMat[good]))
+        eigenvalues = np.real(eigenvalues)
+
+        # We want the smallest positive eigenvalue. Account for 0 being represented as extremely small
+        # negative value...
+        eigenvalues[eigenvalues < -1./n] = np.inf
+        etaInd = np.argmin(eigenvalues, axis=1)
+        AMat = np.real(eigenvectors[np.arange(len(etaInd)), :, etaInd])
+        A, B, C, D = AMat.T
+
+        # Subject to the constraint B^2 + C^2 - 4AD = 1, need to renormalize.
+        with np.errstate(invalid='ignore', divide='ignore'):
+            normFactor = 1/np.sqrt(B**2 + C**2 - 4*A*D)
+            A = A*normFactor
+            B = B*normFactor
+            C = C*normFactor
+            # Reparameterize to go back to the physical parameters of interest
+            xCen[good] = -B/(2*A) + xMean[good, 0]
+            yCen[good] = -C/(2*A) + yMean[good, 0]
+            radius[good] = 1/(2*np.abs(A))
+        failed = ~(np.isfinite(xCen) & np.isfinite(yCen) & np.isfinite(radius))
+        xCen[failed] = yCen[failed] = radius[failed] = np.nan
+
+    return xCen.reshape(batchShape), yCen.reshape(batchShape), radius.reshape(batchShape)
+
+
+if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+
+    # Load an IQ sweep file, separate out I, Q and frequency
+    testFile = 'iqdata_jul_8_veruna_4.620303GHz.npz'
+    testData = np.load(testFile)
+    testI = testData['i']
+    testQ = testData['q']
+    testFrequencies = testData['freqs']*10.0**6
+
+
+    # Synthetic circle test case, no cable delay
+    syntheticTheta = np.linspace(0.0,2.0*np.pi,101)
+    syntheticError = np.random.randn(101)/10
+    syntheticICenter = np.random.randn()
+    syntheticQCenter = np.random.randn()
+
+    syntheticFrequencyData = np.linspace(4.0,4.2,101)
+
+    syntheticIData = syntheticICenter + (np.cos(syntheticTheta) + syntheticError)
+    syntheticQData = syntheticQCenter + (np.sin(syntheticTheta) + syntheticError)
+
+    #print 'Expected I Center: ' + str(syntheticICenter)
+    #print 'Expected Q Center: ' + str(syntheticQCenter)
+
+    #LoopFitter(syntheticIData, syntheticQData, syntheticFrequencyData)
+
+    testTau = 40.0*10.0**-9
+
+    print testFrequencies
+
+    IRemoved, QRemoved = RemoveDelay(testI, testQ, testFrequencies, testTau)
+
+
+    ICenter, QCenter, circleRadius = LoopFitter(testI, testQ)
+    ICenterRemoved, QCenterRemoved, circleRadiusRemoved = LoopFitter(IRemoved, QRemoved)
+
+    plt.plot(testI, testQ, 'b.', ICenter, QCenter, 'bo', IRemoved, QRemoved, 'r.', ICenterRemoved, QCenterRemoved, 'r.')
+    plt.show()
+
+    #plt.plot(testI, testQ, 'b.', ICenter, QCenter, 'ro')
+    #plt.show()
@@ -94,6 +94,7 @@ import struct
 import sys
 import time
 import warnings
+from multiprocessing.pool import ThreadPool
 from socket import inet_aton
 
 import casperfpga
@@ -105,6 +106,7 @@ from mkidcore.readdict import ReadDict
 from mkidreadout.channelizer.adcTools import checkSpectrumForSpikes, streamSpectrum
 from mkidreadout.channelizer.binTools import castBin
 from mkidreadout.configuration import sweepdata
+from mkidreadout.configuration.optimalfilters.triggerPhotons import TriggerEngine
 
 
 #from mkidreadout.channelizer.Roach2Utils import cy_generateTones
@@ -151,6 +153,7 @@ class Roach2Controls(object):
         self.v7_ready = 0
         self.lut_dump_buffer_size = self.params['lut_dump_buffer_size']
         self.thresholdList = -np.pi * np.ones(1024)
+        self.adcAttenHistory = []  # (optimal atten, fit slope) from each getOptimalADCAtten()
 
     def connect(self):
         self.fpga = casperfpga.katcp_fpga.KatcpFpga(self.ip, timeout=3.)
@@ -512,12 +515,14 @@ class Roach2Controls(object):
         
         """
         if nBytesPerSample == 4:
-            formatChar = 'L'
+            formatDtype = '>u4'
         elif nBytesPerSample == 8:
-            formatChar = 'Q'
+            formatDtype = '>u8'
+        else:
+            raise ValueError('nBytesPerSample must be 4 or 8')
         memValues = np.array(valuesToWrite, dtype=np.uint64)  # cast signed values
-        nValues = len(valuesToWrite)
-        toWriteStr = struct.pack('>{}{}'.format(nValues, formatChar), *memValues)
+        # serialize the whole array at once instead of exploding it into struct.pack
+        toWriteStr = memValues.astype(formatDtype).tobytes()
         self.fpga.blindwrite(memName, toWriteStr, start)
 
     def writeQdr(self, memName, valuesToWrite, start=0, bQdrFlip=True, nQdrRows=2 ** 20):
@@ -965,13 +970,19 @@ class Roach2Controls(object):
         return {'bus0': bus0, 'bus1': bus1, 'bus2': bus2, 'bus3': bus3, 'adcData': adcData, 'iVals': iVals,
                 'qVals': qVals}
 
-    def getOptimalADCAtten(self, startAtten, iqBalRange=[0.7, 1.3], rmsRange=[0.15, 0.19], checkForSpikes=True):
+    def getOptimalADCAtten(self, startAtten=None, iqBalRange=[0.7, 1.3], rmsRange=[0.15, 0.19], checkForSpikes=True):
         """
         Determines and sets the ADC attenuation such that the RMS amplitude of the ADC input is within the
         desired range. Also performs basic error checking (IQ balance and undesired harmonics in FFT)
 
+        The ADC RMS in dB is linear in the attenuation, so after each snapshot a line is fit to the
+        (atten, RMS dB) points so far and we jump straight to the predicted optimum. Until there are two
+        points the slope found by the last search on this board is used (-1 dB/dB the first time).
+        This usually converges in two or three snapshots.
+
         INPUTS:
             startAtten - initial value of the attenuation; i.e. where to begin the optimization
+                         If None, start from the optimum found by the last search on this board
             iqBalRange - range of allowable values for I_rms/Q_rms. Warning is raised if value outside this range
             rmsRange - range of desired RMS values for ADC input. Optimization ends when ADC RMS is within this range
             checkForSpikes - if True, compute FFT of ADC input and raise warning if there are large harmonics
@@ -981,13 +992,19 @@ class Roach2Controls(object):
 
         """
         adcFullScale = 2. ** 11
-        curAtten = startAtten
-        rmsTarget = np.mean(rmsRange)
+        rmsTargetDB = 20 * np.log10(np.mean(rmsRange))
         nMaxIters = 10
+        maxAtten = 63.5
 
-        nIters = 0
+        history = self.adcAttenHistory
+        if startAtten is None:
+            startAtten = history[-1][0] if history else maxAtten / 2.
+        slope = history[-1][1] if history else -1.
+        curAtten = min(max(np.round(4 * startAtten) / 4., 0), maxAtten)
+        attens = []
+        rmsDBs = []
 
-        while True:
+        for nIters in range(nMaxIters):
             atten3 = np.floor(curAtten * 2) / 4.
             atten4 = np.ceil(curAtten * 2) / 4.
 
@@ -1015,34 +1032,41 @@ class Roach2Controls(object):
             if rmsRange[0] < iRms < rmsRange[1] and rmsRange[0] < qRms < rmsRange[1]:
                 break
 
-            else:
-                iDBOffs = 20 * np.log10(rmsTarget / iRms)
-                qDBOffs = 20 * np.log10(rmsTarget / qRms)
-                dbOffs = (iDBOffs + qDBOffs) / 2
-                curAtten -= dbOffs
-                curAtten = np.round(4 * curAtten) / 4.
-
-                if curAtten < 0:
-                    curAtten = 0
-                    self.changeAtten(3, 0)
-                    self.changeAtten(4, 0)
-                    getLogger(__name__).warning('Dynamic range target unachievable... setting ADC Atten to 0')
-                    warnings.warn('Dynamic range target unachievable... setting ADC Atten to 0')
-                    break
-                elif curAtten > 63.5:
-                    curAtten = 63.5
-                    self.changeAtten(3, 31.75)
-                    self.changeAtten(4, 31.75)
-                    getLogger(__name__).critical('Dynamic range target unachievable... setting ADC Atten to max')
-                    raise Exception('Dynamic range target unachievable... setting ADC Atten to max')
-
-            nIters += 1
-
-            if nIters >= nMaxIters:
+            # the mean of the I and Q dB offsets from the target
+            attens.append(curAtten)
+            rmsDBs.append(20 * np.log10(np.sqrt(iRms * qRms)))
+            if len(np.unique(attens[-3:])) > 1:
+                fitSlope = np.polyfit(attens[-3:], rmsDBs[-3:], 1)[0]
+                if fitSlope < -0.1:  # otherwise we're probably at the noise floor or saturated. Keep the old slope
+                    slope = fitSlope
+            intercept = np.mean(np.asarray(rmsDBs[-3:]) - slope * np.asarray(attens[-3:]))
+
+            newAtten = np.round(4 * (rmsTargetDB - intercept) / slope) / 4.
+            if newAtten == curAtten:  # model is off by less than a step, nudge it in the right direction
+                newAtten += 0.25 if rmsDBs[-1] > rmsTargetDB else -0.25
+            curAtten = newAtten
+
+            if curAtten < 0:
+                curAtten = 0
+                self.changeAtten(3, 0)
+                self.changeAtten(4, 0)
+                getLogger(__name__).warning('Dynamic range target unachievable... setting ADC Atten to 0')
+                warnings.warn('Dynamic range target unachievable... setting ADC Atten to 0')
+                break
+            elif curAtten > maxAtten:
+                curAtten = maxAtten
                 self.changeAtten(3, 31.75)
                 self.changeAtten(4, 31.75)
-                getLogger(__name__).critical('Max Iters exceeded... setting ADC Atten to max')
-                raise Exception('Max Iters exceeded... setting ADC Atten to max')
+                getLogger(__name__).critical('Dynamic range target unachievable... setting ADC Atten to max')
+                raise Exception('Dynamic range target unachievable... setting ADC Atten to max')
+        else:
+            self.changeAtten(3, 31.75)
+            self.changeAtten(4, 31.75)
+            getLogger(__name__).critical('Max Iters exceeded... setting ADC Atten to max')
+            raise Exception('Max Iters exceeded... setting ADC Atten to max')
+
+        getLogger(__name__).debug('Found ADC atten {} in {} snapshots'.format(curAtten, nIters + 1))
+        self.adcAttenHistory = history[-9:] + [(curAtten, slope)]
 
         if checkForSpikes:
             specDict = streamSpectrum(snapDict['iVals'], snapDict['qVals'])
@@ -1387,8 +1411,9 @@ class Roach2Controls(object):
         self.freqChannels = np.reshape(self.freqChannels, (-1, nStreams), order)
 
         self.streamChannelToFreqChannel = np.reshape(self.streamChannelToFreqChannel, (-1, nStreams), order)
-        streamCh = list(zip(*np.where(self.streamChannelToFreqChannel!= self.channelPadValue)))
-        self.freqChannelToStreamChannel[[self.streamChannelToFreqChannel[l] for l in streamCh]]=streamCh
+        isResonator = self.streamChannelToFreqChannel != self.channelPadValue
+        self.freqChannelToStreamChannel[self.streamChannelToFreqChannel[isResonator]] = np.transpose(
+            np.nonzero(isResonator))
 
         #getLogger(__name__).debug('\tFreq Channels: %s', self.freqChannels)
         getLogger(__name__).debug('...Done!')
@@ -1551,6 +1576,37 @@ class Roach2Controls(object):
         """
         return self.streamChannelToFreqChannel[ch, stream]
 
+    def getStreamChannelIndexOfResIDs(self, resIDs, roachResIDs):
+        """
+        Vectorized join between a list of resonators (e.g. from a beammap or wavecal solution)
+        and the stream/channel layout in the firmware: resID --> freqCh --> (ch, stream)
+
+        Call self.generateResonatorChannels() first with the freqs corresponding to roachResIDs
+
+        INPUTS:
+            resIDs - 1d array of resIDs in an arbitrary order (need not be unique)
+            roachResIDs - 1d array of resIDs loaded on this roach. Index is the freqCh
+        OUTPUTS:
+            index - 2d int array shaped like self.streamChannelToFreqChannel. index[ch, stream] is the
+                    index in resIDs of the resonator in that stream/channel (the first one if it isn't unique).
+                    -1 for empty channels or resonators not found in resIDs
+        """
+        resIDs = np.ravel(resIDs)
+        roachResIDs = np.ravel(roachResIDs)
+        freqChToIndex = np.full(len(roachResIDs), -1, dtype=int)
+        if len(resIDs):
+            sortInds = np.argsort(resIDs, kind='mergesort')  # stable so we find the first occurrence
+            sortedResIDs = resIDs[sortInds]
+            pos = np.clip(np.searchsorted(sortedResIDs, roachResIDs), 0, len(resIDs) - 1)
+            found = sortedResIDs[pos] == roachResIDs
+            freqChToIndex[found] = sortInds[pos[found]]
+
+        freqChannels = self.streamChannelToFreqChannel
+        isResonator = freqChannels != self.channelPadValue
+        index = np.full(freqChannels.shape, -1, dtype=int)
+        index[isResonator] = freqChToIndex[freqChannels[isResonator]]
+        return index
+
     def setMaxCountRate(self, cpsLimit=2500):
         for reg in self.params['captureCPSlim_regs']:
             try:
@@ -1611,7 +1667,7 @@ class Roach2Controls(object):
         time.sleep(.003)  # Each snapshot should take 2 msec of phase data
         self.fpga.write_int(self.params['captureLoadThreshold_regs'][stream], 0)
 
-    def loadFIRCoeffs(self, coeffFile):
+    def loadFIRCoeffs(self, coeffFile, skipUnchanged=False):
         """
         This function loads the FIR coefficients into the Firmware's phase filter for every resonator
         You can provide a filter for each resonator channel or just a single filter that's applied to each resonator
@@ -1626,6 +1682,12 @@ class Roach2Controls(object):
                         The i'th column corresponds to the i'th resonator in the freqList
                         If there is only one column then use it for every resonator in the freqList
                         The j'th row is the filter's coefficient for the j'th tap
+            skipUnchanged - only write the coefficient memory when a channel's taps differ from the previous
+                            channel's. Only use this with firmware whose coefficient memory keeps its contents
+                            after a load (not yet checked on hardware)
+
+        OUTPUTS:
+            loadTimes - dictionary of the time in seconds taken to load each stream that was written
         """
         # Decide which channels to write FIRs to
         try:
@@ -1647,37 +1709,51 @@ class Roach2Controls(object):
             firCoeffs = np.transpose(firCoeffs)
         firBinPt = self.params['firBinPt']
         firInts = np.asarray(firCoeffs * (2 ** firBinPt), dtype=np.int32)
-        zeroWriteStr = struct.pack('>{}{}'.format(len(firInts[0]), 'l'),
-                                   *np.zeros(len(firInts[0])))  # write zeros for channels without resonators
 
-        # loop through and write FIRs to firmware
+        # taps for every stream channel, zero for channels without resonators
         nStreams = self.params['nChannels'] / self.params['nChannelsPerStream']
+        nChansPerStream = self.params['nChannelsPerStream']
+        streamTaps = np.zeros((nStreams, nChansPerStream, firInts.shape[1]), dtype=np.int32)
+        streamTaps[np.atleast_1d(streams), np.atleast_1d(channels)] = firInts[np.atleast_1d(freqChans)]
+        nBytes = streamTaps.shape[2] * 4
+        loadDelay = self.params.get('firLoadDelay', 0)
+
+        # loop through and write FIRs to firmware
+        loadTimes = {}
         for stream in range(nStreams):
+            tic = time.time()
+            nWrites = 0
             try:
                 self.fpga.write_int(self.params['firLoadChan_regs'][stream], 0)  # just double check that this is at 0
-                ch_inds = np.where(
-                    streams == stream)  # indices in list of resonator channels that correspond to this stream
-                ch_stream = np.atleast_1d(channels)[ch_inds]  # list of the stream channels with this stream
-                ch_freqs = np.atleast_1d(freqChans)[ch_inds]  # list of freq channels with this stream
-                for ch in range(self.params['nChannelsPerStream']):
-                    if ch in np.atleast_1d(ch_stream):
-                        ch_freq = int(np.atleast_1d(ch_freqs)[np.where(np.atleast_1d(
-                            ch_stream) == ch)])  # The freq channel of the resonator corresponding to ch/stream
-                        toWriteStr = struct.pack('>{}{}'.format(len(firInts[ch_freq]), 'l'), *firInts[ch_freq])
-                        getLogger(__name__).debug(' ch:' + str(ch_freq) + ' ch/stream: ' + str(ch) + '/' + str(stream))
-                    else:
-                        toWriteStr = zeroWriteStr
-                    self.fpga.blindwrite(self.params['firTapsMem_regs'][stream], toWriteStr, 0)
-                    time.sleep(.001)  # 1ms is more than enough. Should only take nTaps/fpgaClockRate seconds to load in
-                    loadVal = (
-                                          1 << 8) + ch  # first bit indicates we will write, next 8 bits is the chan number for the stream
+                tapStr = streamTaps[stream].astype('>i4').tobytes()
+                lastWriteStr = None
+                for ch in range(nChansPerStream):
+                    toWriteStr = tapStr[ch * nBytes:(ch + 1) * nBytes]
+                    # The coefficient memory holds a single channel. If it keeps its contents after a load only
+                    # write it when the taps change (e.g. a single filter for every resonator, or the zeros
+                    # for unused channels)
+                    if not skipUnchanged or toWriteStr != lastWriteStr:
+                        self.fpga.blindwrite(self.params['firTapsMem_regs'][stream], toWriteStr, 0)
+                        lastWriteStr = toWriteStr
+                        nWrites += 1
+                    # katcp handles requests in order, so the taps are in memory before the load strobe is
+                    # seen. Loading only takes nTaps/fpgaClockRate, much less than a round trip.
+                    if loadDelay:
+                        time.sleep(loadDelay)
+                    loadVal = (1 << 8) + ch  # first bit indicates we will write, next 8 bits is the chan number for the stream
                     self.fpga.write_int(self.params['firLoadChan_regs'][stream], loadVal)
-                    time.sleep(.001)
+                    if loadDelay:
+                        time.sleep(loadDelay)
                     self.fpga.write_int(self.params['firLoadChan_regs'][stream], 0)
+                loadTimes[stream] = time.time() - tic
+                getLogger(__name__).debug('Loaded FIRs on stream {} in {:.2f} s ({} tap writes)'.format(
+                    stream, loadTimes[stream], nWrites))
             except:
                 getLogger(__name__).error('Failed to write FIRs on stream ' + str(stream))  # Often times test
                 # firmware only implements stream 0
                 if stream == 0: raise
+        getLogger(__name__).info('Loaded FIRs in {:.2f} s'.format(sum(loadTimes.values())))
+        return loadTimes
 
     def loadWavecal(self, sol, freqListFile=None):
         """
@@ -1706,41 +1782,29 @@ class Roach2Controls(object):
 
         solResIDs, solCoeffs = sol.getWvlSoln(feedline=sd.feedline)
 
-        freqCh_roach = np.arange(len(resID_roach))
-        freqCh = np.ones(len(solResIDs)) * -2 #channel at each wvl solution
-        for rID, fCh in zip(resID_roach, freqCh_roach):
-            freqCh[solResIDs == rID] = fCh
-
         self.generateResonatorChannels(freqs)
-        allStreamChannels, allStreams = self.getStreamChannelFromFreqChannel()
-        bitmask = 2**self.params['nBitsWvlCoeff']-1 #1 at each bit that is part of coeffs #TODO: add to params
-
-        for stream in np.unique(allStreams):
-            streamWvlCoeffBits = []
-            for streamChannel in allStreamChannels[allStreams == stream]:
-                freqChannel = self.getFreqChannelFromStreamChannel(streamChannel, stream)
-                indx = np.where(freqCh == freqChannel)[0]
-                if len(indx) == 0:
-                    getLogger(__name__).debug('Frequency channel {} not found in wavecal.'.format(freqChannel))
-                    coeffs = np.array([0, 1, 8]) #b=1, c=2**3; to find (signed) phase just subtract 8 #TODO: add to params
-                else:
-                    coeffs = solCoeffs[indx]
-
-                coeffs = (coeffs*2**self.params['binPtWvlCoeff']).astype(np.int64) #convert to integer for loading in firmware #TODO: add to params
-                
-                #convert to proper twos-complement signed values
-                negInds = coeffs<0
-                if np.any(negInds):
-                    coeffs[negInds] = -coeffs[negInds]
-                    coeffs[negInds] = ((~coeffs[negInds])&bitmask) + 1
-
-                #consolidate into single number
-                chanCoeffVal = (coeffs[0] & bitmask) + ((coeffs[1] & bitmask) << 21) + ((coeffs[2] & bitmask) << 42)
-                streamWvlCoeffBits.append(chanCoeffVal)
-                
-            streamCoordBits = np.array(streamCoordBits)
-            self.writeBram(memName=self.params['wvllut_bram'][stream], valuesToWrite=streamCoordBits, nBytesPerSample=8)
+        solIndex = self.getStreamChannelIndexOfResIDs(solResIDs, resID_roach)  # [ch, stream] --> wvl solution
+        isResonator = self.streamChannelToFreqChannel != self.channelPadValue
+        missing = isResonator & (solIndex < 0)
+        if missing.any():
+            getLogger(__name__).debug('Frequency channels {} not found in wavecal.'.format(
+                np.sort(self.streamChannelToFreqChannel[missing])))
+
+        coeffs = np.empty(solIndex.shape + (3,))
+        coeffs[:] = [0, 1, 8]  # b=1, c=2**3; to find (signed) phase just subtract 8 #TODO: add to params
+        coeffs[solIndex >= 0] = np.reshape(solCoeffs, (len(solResIDs), -1))[solIndex[solIndex >= 0], :3]
+        coeffs = (coeffs*2**self.params['binPtWvlCoeff']).astype(np.int64)  # convert to integer for loading in firmware #TODO: add to params
+
+        # masking the int64 gives the proper twos-complement signed values
+        bitmask = 2**self.params['nBitsWvlCoeff']-1  # 1 at each bit that is part of coeffs #TODO: add to params
+        coeffs &= bitmask
 
+        # consolidate into single number
+        chanCoeffVals = coeffs[..., 0] + (coeffs[..., 1] << 21) + (coeffs[..., 2] << 42)
+
+        for stream in np.where(isResonator.any(axis=0))[0]:
+            self.writeBram(memName=self.params['wvllut_bram'][stream], valuesToWrite=chanCoeffVals[:, stream],
+                           nBytesPerSample=8)
 
     def takePhaseSnapshotOfFreqChannel(self, freqChan):
         """
@@ -1793,6 +1857,7 @@ class Roach2Controls(object):
             -nNegDeriveChecks-nNegDeriveLeniance/nNegDeriveChecks negative slopes, 
                 followed by nPosDeriveChecks positive slopes
             -<threshold (b/c pulses are negative)
+            -deadtime ticks after each trigger
         
         INPUTS:
             selChanIndex: channel to take data from
@@ -1803,37 +1868,12 @@ class Roach2Controls(object):
             trigPos: array of size len(phaseData), w/ a 1
             at photon trigger positions
         """
-        phaseDeriv = np.diff(phaseData)
-        isNegDeriv = phaseDeriv <= 0
-        isPosDeriv = phaseDeriv > 0
-        phaseData = phaseData - np.median(phaseData)  # baseline subtract data
-        threshCond = phaseData < self.thresholdList[selChanIndex]
-        # threshCond = np.delete(meetsThresh,np.arange(0,nNegDerivChecks)) #align this condition with derivatives
-        threshCond = np.delete(threshCond, np.arange(0, nNegDerivChecks))  # align this condition with derivatives
-
-        negDerivChecksSum = np.zeros(len(isNegDeriv[0:-nNegDerivChecks - 1]))
-        for i in range(nNegDerivChecks):
-            negDerivChecksSum += isNegDeriv[i:i - nNegDerivChecks - 1]
-        negDerivCond = (negDerivChecksSum >= (nNegDerivChecks - nNegDerivLeniance))
-
-        posDerivChecksSum = np.zeros(len(isPosDeriv[0:-nPosDerivChecks - 1]))
-        for i in range(nPosDerivChecks):
-            posDerivChecksSum += isPosDeriv[i:i - nPosDerivChecks - 1]
-        posDerivCond = posDerivChecksSum >= nPosDerivChecks
-        posDerivCond = np.delete(posDerivCond, np.arange(0, nNegDerivChecks))  # align with other conditions
-
-        trigger = np.logical_and(threshCond[0:len(negDerivCond)], negDerivCond)
-        trigger = np.logical_and(trigger[0:len(posDerivCond)], posDerivCond[0:len(trigger)])
-        trigger = np.pad(trigger, (nNegDerivChecks, 0), 'constant')
-        trigger = np.pad(trigger, (0, len(phaseData) - len(trigger)), 'constant')
-
-        # apply deadtime
-        trigSum = np.zeros(len(trigger))
-        for i in range(deadtime):
-            trigSum[deadtime:] += trigger[deadtime - i:len(trigger) - i]
-        violatesDt = np.where(trigSum >= 2)[0]
-        trigger[violatesDt] = 0
-
+        engine = TriggerEngine(phaseData - np.median(phaseData))  # baseline subtract data
+        peakIndices = engine.trigger(self.thresholdList[selChanIndex], nNegDerivChecks=nNegDerivChecks,
+                                     negDerivLenience=nNegDerivLeniance, nPosDerivChecks=nPosDerivChecks,
+                                     deadtime=deadtime)
+        trigger = np.zeros(len(phaseData), dtype=bool)
+        trigger[peakIndices] = True
         return trigger
 
     # def startPhaseStream(self,selChanIndex=0, pktsPerFrame=100, fabric_port=50000, destIPID=50):
@@ -2092,7 +2132,7 @@ class Roach2Controls(object):
 
         # plt.show()
 
-    def performIQSweep(self, startLOFreq, stopLOFreq, stepLOFreq):
+    def performIQSweep(self, startLOFreq, stopLOFreq, stepLOFreq, nAvgs=1):
         """
         Performs a sweep over the LO frequency.  Records 
         one IQ point per channel per freqeuency; stores in
@@ -2118,6 +2158,7 @@ class Roach2Controls(object):
             startLOFreq - starting sweep frequency [MHz]
             stopLOFreq - final sweep frequency [MHz]
             stepLOFreq - frequency sweep step size [MHz]
+            nAvgs - number of IQ points to average at each LO step
         OUTPUTS:
             iqSweepData - Dictionary with following keywords
                           I - 2D array with shape = [nFreqs, nLOsteps]
@@ -2126,39 +2167,27 @@ class Roach2Controls(object):
             
         """
         LOFreqs = np.arange(startLOFreq, stopLOFreq, stepLOFreq)
-        nStreams = self.params['nChannels'] / self.params['nChannelsPerStream']
-        iqData = np.empty([nStreams, 0])
+        return self.performIQSweepAtLOFreqs(LOFreqs, nAvgs=nAvgs)
+
+    def performIQSweepAtLOFreqs(self, LOFreqs, nAvgs=1):
+        """
+        Same as performIQSweep() but sweeps over an arbitrary list of LO frequencies.
+        Used for sweeps with non-uniform steps (see RoachStateMachine.adaptiveIQSweep())
 
-        # The magic number 4 below is the number of IQ points per read
-        # We get two I points and two Q points every read
-        iqPt = np.empty([nStreams, self.params['nChannelsPerStream'] * 4])
-        self.fpga.write_int(self.params['iqSnpStart_reg'], 0)
+        INPUTS:
+            LOFreqs - list of LO frequencies [MHz]
+            nAvgs - number of IQ points to average at each LO step
+        OUTPUTS:
+            iqSweepData - see performIQSweep()
+        """
+        LOFreqs = np.atleast_1d(LOFreqs)
 
-        for i in range(len(LOFreqs)):
-            getLogger(__name__).debug('Sweeping LO ' + str(LOFreqs[i]) + ' MHz')
-            self.loadLOFreq(LOFreqs[i])
+        def setLO(step):
+            getLogger(__name__).debug('Sweeping LO ' + str(LOFreqs[step]) + ' MHz')
+            self.loadLOFreq(LOFreqs[step])
             # time.sleep(0.01)    # I dunno how long it takes to set the LO
-            if i % 2 == 0:
-                for stream in range(nStreams):
-                    self.fpga.snapshots[self.params['iqSnp_regs'][stream]].arm(man_valid=False, man_trig=False)
-            self.fpga.write_int(self.params['iqSnpStart_reg'], 1)
-            time.sleep(0.001)  # takes nChannelsPerStream/fpgaClockRate seconds to load all the values
-            if i % 2 == 1:
-                for stream in range(nStreams):
-                    iqPt[stream] = \
-                    self.fpga.snapshots[self.params['iqSnp_regs'][stream]].read(timeout=10, arm=False)['data']['iq']
-                iqData = np.append(iqData, iqPt, 1)
-            self.fpga.write_int(self.params['iqSnpStart_reg'], 0)
 
-        # if odd number of LO steps then we still need to read out half of the last buffer
-        if len(LOFreqs) % 2 == 1:
-            self.fpga.write_int(self.params['iqSnpStart_reg'], 1)
-            time.sleep(0.001)
-            for stream in range(nStreams):
-                iqPt[stream] = \
-                self.fpga.snapshots[self.params['iqSnp_regs'][stream]].read(timeout=10, arm=False)['data']['iq']
-            iqData = np.append(iqData, iqPt[:, :self.params['nChannelsPerStream'] * 2], 1)
-            self.fpga.write_int(self.params['iqSnpStart_reg'], 0)
+        iqData = self.acquireIQData(len(LOFreqs), setStep=setLO, nAvgs=nAvgs)
 
         self.loadLOFreq()  # reloads initial lo freq
         self.iqSweepData = self.formatIQSweepData(iqData)
@@ -2166,6 +2195,75 @@ class Roach2Controls(object):
         # self.iqSweepData = iqData
         return self.iqSweepData
 
+    def acquireIQData(self, nSteps, setStep=None, nAvgs=1):
+        """
+        Takes IQ points with the iq snapshot blocks. Used by performIQSweep() and takeAvgIQData()
+
+        Each snapshot holds two IQ points per channel so the snapshots are armed before every
+        other trigger and read after the second one. The streams are read concurrently.
+        When averaging, the nAvgs points at each step are summed in place so memory doesn't
+        grow with the number of points.
+
+        INPUTS:
+            nSteps - number of steps (ie. LO freqs)
+            setStep - function called with the step index before the first point of each step. (ie. to set the LO)
+            nAvgs - number of IQ points averaged at each step
+        OUTPUTS:
+            iqData - 3D array with shape = [nStreams, nSteps, nChannelsPerStream+nChannelsPerStream]
+                     The last axis has 256 I points followed by 256 Q points
+        """
+        nStreams = int(self.params['nChannels'] / self.params['nChannelsPerStream'])
+        nValsPerPt = 2 * self.params['nChannelsPerStream']
+        iqData = np.zeros([nStreams, nSteps, nValsPerPt])
+        iqPt = np.empty([nStreams, 2, nValsPerPt])  # the two IQ points in a snapshot
+        ptSteps = np.repeat(np.arange(nSteps), nAvgs)  # the step each IQ point belongs to
+
+        pool = ThreadPool(nStreams)  # reads the snapshots of the streams concurrently
+        try:
+            self.fpga.write_int(self.params['iqSnpStart_reg'], 0)
+            for i, step in enumerate(ptSteps):
+                if setStep is not None and i % nAvgs == 0:
+                    setStep(step)
+                if i % 2 == 0:
+                    for stream in range(nStreams):
+                        self.fpga.snapshots[self.params['iqSnp_regs'][stream]].arm(man_valid=False, man_trig=False)
+                self.fpga.write_int(self.params['iqSnpStart_reg'], 1)
+                time.sleep(0.001)  # takes nChannelsPerStream/fpgaClockRate seconds to load all the values
+                if i % 2 == 1:
+                    self._readIQSnapshots(iqPt, pool)
+                    iqData[:, ptSteps[i - 1]] += iqPt[:, 0]
+                    iqData[:, step] += iqPt[:, 1]
+                self.fpga.write_int(self.params['iqSnpStart_reg'], 0)
+
+            # if odd number of points then we still need to read out half of the last buffer
+            if len(ptSteps) % 2 == 1:
+                self.fpga.write_int(self.params['iqSnpStart_reg'], 1)
+                time.sleep(0.001)
+                self._readIQSnapshots(iqPt, pool)
+                iqData[:, ptSteps[-1]] += iqPt[:, 0]
+                self.fpga.write_int(self.params['iqSnpStart_reg'], 0)
+        finally:
+            pool.close()
+            pool.join()
+
+        if nAvgs > 1:
+            iqData /= nAvgs
+        return iqData
+
+    def _readIQSnapshots(self, iqPt, pool):
+        """
+        Reads the iq snapshot of every stream concurrently
+
+        INPUTS:
+            iqPt - [nStreams, 2, nChannelsPerStream+nChannelsPerStream] array to read the data into
+            pool - ThreadPool with a thread for each stream
+        """
+        def readStream(stream):
+            snp = self.fpga.snapshots[self.params['iqSnp_regs'][stream]]
+            iqPt[stream] = np.reshape(snp.read(timeout=10, arm=False)['data']['iq'], iqPt[stream].shape)
+
+        pool.map(readStream, range(len(iqPt)))
+
     def formatIQSweepData(self, iqDataStreams):
         """
         Reshapes the iqdata into a usable format
@@ -2174,54 +2272,33 @@ class Roach2Controls(object):
         If we haven't loaded in a freqList then the order is channels 0..256 in stream 0, then stream 1, etc..
         
         INPUTS:
-            iqDataStreams - 2D array with following shape:
+            iqDataStreams - 3D array with shape [nStreams, nSteps, nChannelsPerStream+nChannelsPerStream]
+                            (see acquireIQData()) or the equivalent 2D array with shape:
                             [nStreams, (nChannelsPerStream+nChannelsPerStream) * nSteps]
         OUTPUTS:
             iqSweepData - Dictionary with following keywords
                           I - 2D array with shape = [nFreqs, nSteps]
                           Q - 2D array with shape = [nFreqs, nSteps]
         """
+        nChannelsPerStream = self.params['nChannelsPerStream']
+        nStreams = int(self.params['nChannels'] / nChannelsPerStream)
         # Only return IQ data for channels/streams with resonators associated with them
         try:
-            freqChans = range(len(self.freqList))
             # channels, streams = self.freqChannelToStreamChannel(freqChans)      # Need to be careful about how the resonators are distributed into firmware streams
-            channels, streams = self.getStreamChannelFromFreqChannel(freqChans)
+            channels, streams = self.getStreamChannelFromFreqChannel()
         except AttributeError:  # If we haven't loaded in frequencies yet then grab all channels
-            freqChans = range(self.params['nChannels'])
-            streams = np.repeat(range(self.params['nChannels'] / self.params['nChannelsPerStream']),
-                                self.params['nChannelsPerStream'])
-            channels = np.tile(range(self.params['nChannelsPerStream']),
-                               self.params['nChannels'] / self.params['nChannelsPerStream'])
+            streams = np.repeat(np.arange(nStreams), nChannelsPerStream)
+            channels = np.tile(np.arange(nChannelsPerStream), nStreams)
+
+        iqDataStreams = np.asarray(iqDataStreams)
+        if iqDataStreams.ndim == 2:
+            iqDataStreams = np.reshape(iqDataStreams, (len(iqDataStreams), -1, 2 * nChannelsPerStream))
 
-        I_list = []
-        Q_list = []
-        for i in range(len(freqChans)):
-            ch, stream = np.atleast_1d(channels)[i], np.atleast_1d(streams)[i]
-            # if i==380 or i==371:
-            #    getLogger(__name__).info('i:',i,' stream/ch:',stream,'/',ch)
-            #    getLogger(__name__).info('freq[ch]:',self.freqList[i])
-            #    getLogger(__name__).info('freq[ch,stream]:',self.freqChannels[ch,stream])
-            I = iqDataStreams[stream, ch:: self.params['nChannelsPerStream'] * 2]
-            Q = iqDataStreams[stream, ch + self.params['nChannelsPerStream']:: self.params['nChannelsPerStream'] * 2]
-            # Ivals = np.roll(I.flatten(),-2)
-            # Qvals = np.roll(I.flatten(),-2)
-            I_list.append(I.flatten())
-            Q_list.append(Q.flatten())
-
-        return {'I': I_list, 'Q': Q_list}
-
-        # I_list2=I_list[2:] + I_list[:2]
-        # Q_list2=Q_list[2:] + Q_list[:2]
-
-        I_list2 = I_list[-2:] + I_list[:-2]
-        Q_list2 = Q_list[-2:] + Q_list[:-2]
-
-        # I_list2[:-2]=I_list[2:]     # There is a 2 cycle delay in the snapshot block
-        # I_list2[-2:]=I_list[:2]     # need to shift the channels by two
-        # Q_list2=Q_list
-        # Q_list2[:-2]=Q_list[2:]
-        # Q_list2[-2:]=Q_list[:2]
-        return {'I': I_list2, 'Q': Q_list2}
+        # the advanced indices are separated by a slice so the resonator axis comes first: [nFreqs, nSteps]
+        channels, streams = np.atleast_1d(channels), np.atleast_1d(streams)
+        I = iqDataStreams[streams, :, channels]
+        Q = iqDataStreams[streams, :, channels + nChannelsPerStream]
+        return {'I': I, 'Q': Q}
 
     def loadBeammapCoords(self, beammap, freqListFile=None):
         """
@@ -2254,33 +2331,31 @@ class Roach2Controls(object):
             getLogger(__name__).error('unable to load freqs {}'.format(os.path.isfile(freqListFile)), exc_info=True)
             raise
 
-        freqCh_roach = np.arange(len(resID_roach))
-        freqCh = np.ones(len(beammap.resIDs)) * -2
-        for rID, fCh in zip(resID_roach, freqCh_roach):
-            freqCh[beammap.resIDs == rID] = fCh
-
         self.generateResonatorChannels(freqs)
-        allStreamChannels, allStreams = self.getStreamChannelFromFreqChannel()
-        for stream in np.unique(allStreams):
-            streamCoordBits = []
-            for streamChannel in allStreamChannels[allStreams == stream]:
-                freqChannel = self.getFreqChannelFromStreamChannel(streamChannel, stream)
-                indx = np.where(freqCh == freqChannel)[0]
-                if len(indx) == 0:
-                    getLogger(__name__).warning('Frequency channel {} for found in beammap, should not happen.'.format(freqChannel))
-                    # If a resonator is being probed but isn't mentioned in the beammap file
-                    # This shouldn't happen since all 10000 pixels should be in the beammap...
-                    # First 20 bits are 10111111111111111111. Fake photons are 01111's. Headers have the frist 8 bits as 1's
-                    x = 2 ** self.params['nBitsXCoord'] - 1 - 2 ** (self.params['nBitsXCoord'] - 2)
-                    y = 2 ** self.params['nBitsYCoord'] - 1
-                else:
-                    x = beammap.xCoords[indx[0]]
-                    y = beammap.yCoords[indx[0]]
-                x = max(0, min(2 ** self.params['nBitsXCoord'] - 1, x))  # clip to between 0 and 2^10-1
-                y = max(0, min(2 ** self.params['nBitsYCoord'] - 1, y))
-                streamCoordBits.append((int(x) << self.params['nBitsYCoord']) + int(y))
-            streamCoordBits = np.array(streamCoordBits)
-            self.writeBram(memName=self.params['pixelnames_bram'][stream], valuesToWrite=streamCoordBits)
+        bmIndex = self.getStreamChannelIndexOfResIDs(beammap.resIDs, resID_roach)  # [ch, stream] --> beammap
+        isResonator = self.streamChannelToFreqChannel != self.channelPadValue
+        missing = isResonator & (bmIndex < 0)
+        if missing.any():
+            # If a resonator is being probed but isn't mentioned in the beammap file
+            # This shouldn't happen since all 10000 pixels should be in the beammap...
+            getLogger(__name__).warning('Frequency channels {} not found in beammap, should not happen.'.format(
+                np.sort(self.streamChannelToFreqChannel[missing])))
+
+        # First 20 bits are 10111111111111111111. Fake photons are 01111's. Headers have the frist 8 bits as 1's
+        x = np.full(bmIndex.shape, 2 ** self.params['nBitsXCoord'] - 1 - 2 ** (self.params['nBitsXCoord'] - 2), dtype=float)
+        y = np.full(bmIndex.shape, 2 ** self.params['nBitsYCoord'] - 1, dtype=float)
+        x[bmIndex >= 0] = np.asarray(beammap.xCoords, dtype=float)[bmIndex[bmIndex >= 0]]
+        y[bmIndex >= 0] = np.asarray(beammap.yCoords, dtype=float)[bmIndex[bmIndex >= 0]]
+        # unbeammapped (NaN) pixels go to the out of range max coordinate, as min/max clipping always did
+        x[np.isnan(x)] = 2 ** self.params['nBitsXCoord'] - 1
+        y[np.isnan(y)] = 2 ** self.params['nBitsYCoord'] - 1
+        x = np.clip(x, 0, 2 ** self.params['nBitsXCoord'] - 1).astype(int)  # clip to between 0 and 2^10-1
+        y = np.clip(y, 0, 2 ** self.params['nBitsYCoord'] - 1).astype(int)
+        coordBits = (x << self.params['nBitsYCoord']) + y
+
+        # one bulk transfer per stream, indexed by channel
+        for stream in np.where(isResonator.any(axis=0))[0]:
+            self.writeBram(memName=self.params['pixelnames_bram'][stream], valuesToWrite=coordBits[:, stream])
 
     def takeAvgIQData(self, numPts=100):
         """
@@ -2295,33 +2370,10 @@ class Roach2Controls(object):
                           Q - 2D array with shape = [nFreqs, nLOsteps]
         """
 
-        counter = np.arange(numPts)
-        nStreams = self.params['nChannels'] / self.params['nChannelsPerStream']
-        iqData = np.empty([nStreams, 0])
-        self.fpga.write_int(self.params['iqSnpStart_reg'], 0)
-        iqPt = np.empty([nStreams, self.params['nChannelsPerStream'] * 4])
-
-        for i in counter:
+        def logPoint(i):
             getLogger(__name__).debug('IQ point #' + str(i))
-            if i % 2 == 0:
-                for stream in range(nStreams):
-                    self.fpga.snapshots[self.params['iqSnp_regs'][stream]].arm(man_valid=False, man_trig=False)
-            self.fpga.write_int(self.params['iqSnpStart_reg'], 1)
-            time.sleep(0.001)  # takes nChannelsPerStream/fpgaClockRate seconds to load all the values
-            if i % 2 == 1:
-                for stream in range(nStreams):
-                    iqPt[stream] = self.fpga.snapshots[self.params['iqSnp_regs'][stream]].read(timeout=10, arm=False)['data']['iq']
-                iqData = np.append(iqData, iqPt, 1)
-            self.fpga.write_int(self.params['iqSnpStart_reg'], 0)
 
-        # if odd number of steps then we still need to read out half of the last buffer
-        if len(counter) % 2 == 1:
-            self.fpga.write_int(self.params['iqSnpStart_reg'], 1)
-            time.sleep(0.001)
-            for stream in range(nStreams):
-                iqPt[stream] = self.fpga.snapshots[self.params['iqSnp_regs'][stream]].read(timeout=10, arm=False)['data']['iq']
-            iqData = np.append(iqData, iqPt[:, :self.params['nChannelsPerStream'] * 2], 1)
-            self.fpga.write_int(self.params['iqSnpStart_reg'], 0)
+        iqData = self.acquireIQData(numPts, setStep=logPoint)
 
         self.iqToneData = self.formatIQSweepData(iqData)
         # self.iqToneDataRaw = iqData
@@ -2340,19 +2392,18 @@ class Roach2Controls(object):
         # channels, streams = self.freqChannelToStreamChannel()
         channels, streams = self.getStreamChannelFromFreqChannel()
 
-        for i in range(len(centers)):
-            ch = channels[i]
-            stream = streams[i]
-            # ch, stream = np.where(self.freqChannels == self.freqList[i])
-            # getLogger(__name__).info('IQ center',ch,centers[i][0],centers[i][1])
-            I_c = int(centers[i][0] / 2 ** 3)
-            Q_c = int(centers[i][1] / 2 ** 3)
-
-            center = (I_c << 16) + (Q_c << 0)  # 32 bit number - 16bit I + 16bit Q
-            # getLogger(__name__).info('loading I,Q',I_c,Q_c)
-            self.fpga.write_int(self.params['iqCenter_regs'][stream], center)
-            self.fpga.write_int(self.params['iqLoadCenter_regs'][stream], (ch << 1) + (1 << 0))
-            self.fpga.write_int(self.params['iqLoadCenter_regs'][stream], 0)
+        centers = np.reshape(centers, (-1, 2))
+        I_c = np.trunc(centers[:, 0] / 2 ** 3).astype(np.int64)
+        Q_c = np.trunc(centers[:, 1] / 2 ** 3).astype(np.int64)
+        centerVals = (I_c << 16) + (Q_c << 0)  # 32 bit number - 16bit I + 16bit Q
+        loadVals = (np.asarray(channels, dtype=np.int64) << 1) + (1 << 0)
+
+        # The centers are loaded through a register, not a bram, so we can't coalesce them into one transfer.
+        # Blind writes skip the katcp read back, which is most of the time spent here
+        for center, loadVal, stream in zip(centerVals, loadVals, streams):
+            self.fpga.write_int(self.params['iqCenter_regs'][stream], int(center), blindwrite=True)
+            self.fpga.write_int(self.params['iqLoadCenter_regs'][stream], int(loadVal), blindwrite=True)
+            self.fpga.write_int(self.params['iqLoadCenter_regs'][stream], 0, blindwrite=True)
 
     def sendUARTCommand(self, inByte, blocking=False):
         """
@@ -7,19 +7,65 @@ The RoachStateMachine class runs the commands on the readout boards. Uses Roach2
 import os
 import random
 import sys
+import threading
 import time
 from Queue import Queue
 
 import numpy as np
 from PyQt4 import QtCore
 from pkg_resources import resource_filename
+from tables import open_file
 
 import mkidreadout.configuration.sweepdata as sweepdata
 from mkidcore.corelog import getLogger
+from mkidreadout.channelizer.LoopFitter import fitLoops
 from mkidreadout.channelizer.Roach2Controls import Roach2Controls
 from mkidreadout.utils import iqsweep
 
 
+class PipelineWorker(threading.Thread):
+    """
+    Calls func on every item put() into a bounded queue from a background thread.
+    put() blocks when the worker falls behind. close() waits for the queue to drain and
+    reraises the first error from func in the calling thread.
+    """
+    def __init__(self, func, maxsize=2):
+        super(PipelineWorker, self).__init__()
+        self.daemon = True
+        self.func = func
+        self.queue = Queue(maxsize=maxsize)
+        self.exc_info = None
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.exc_info is not None:
+                continue  # drain the queue after an error
+            try:
+                self.func(item)
+            except:
+                self.exc_info = sys.exc_info()
+
+    def put(self, item):
+        self.queue.put(item)
+
+    def close(self, reraise=True):
+        """
+        INPUTS:
+            reraise - if False the error from func is only logged. Use when another exception is already
+                      propagating so it isn't replaced by the worker's
+        """
+        self.queue.put(None)
+        self.join()
+        if self.exc_info is not None:
+            if not reraise:
+                getLogger(__name__).error('Pipeline worker failed', exc_info=self.exc_info)
+                return
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+
+
 class RoachStateMachine(QtCore.QObject):  # Extends QObject for use with QThreads
     """
     This class defines and executes commands on the readout boards using the Roach2Controls object.
@@ -109,6 +155,7 @@ class RoachStateMachine(QtCore.QObject):  # Extends QObject for use with QThread
 
         self.roachController = Roach2Controls(ip, FPGAParamFile, feedline=fl, num=self.num,
                                               range=range, verbose=True, debug=False)
+        self.adcAttenCache = {}  # total DAC power [dB] --> optimal ADC atten. See getOptimalADCAtten()
 
     def addCommands(self, command):
         """
@@ -275,6 +322,7 @@ class RoachStateMachine(QtCore.QObject):  # Extends QObject for use with QThread
         self.roachController.resIDs = resIDs
         self.roachController.phaseOffsList = phaseOffsList
         self.roachController.iqRatioList = iqRatioList
+        self.adcAttenCache = {}  # new resonators, new DAC comb
 
         # getLogger(__name__).debug('new Freq: {}'.format(self.roachController.freqList))
 
@@ -305,6 +353,7 @@ class RoachStateMachine(QtCore.QObject):  # Extends QObject for use with QThread
         """
         adcAtten = self.config.roaches.get('r{}.adcatten'.format(self.num))
         newDacAtten = self.roachController.generateDacComb()['dacAtten']
+        self.adcAttenCache = {}  # the cached attens were found with the old comb
 
         getLogger(__name__).info("Initializing ADC/DAC board communication")
         self.roachController.initializeV7UART()
@@ -353,51 +402,43 @@ class RoachStateMachine(QtCore.QObject):  # Extends QObject for use with QThread
         start_ADCAtten = self.config.roaches.get('r{}.adcatten'.format(self.num))
         newADCAtten = start_ADCAtten
 
-        powerSweepFile = self.roachController.tagfile(self.config.roaches.get('r{}.powersweeproot'.format(self.num)),
-                                                      dir=self.config.paths.data,
-                                                      epilog=time.strftime("%Y%m%d-%H%M%S", time.localtime()))
-        for dacAtten in np.arange(start_DACAtten, stop_DACAtten + 1):
-            if stop_DACAtten > start_DACAtten:
-                dacAtten1 = np.floor(dacAtten * 2) / 4.
-                dacAtten2 = np.ceil(dacAtten * 2) / 4.
-                self.roachController.changeAtten(1, dacAtten1)
-                self.roachController.changeAtten(2, dacAtten2)
-                getLogger(__name__).info('Changed DAC atten: {}'.format(dacAtten))
-                # keep total power on the ADC the same
-                newADCAtten = self.roachController.getOptimalADCAtten(newADCAtten)
-                getLogger(__name__).info('Changed ADC atten: {}'.format(newADCAtten))
-
-            iqData = self.roachController.performIQSweep(LO_start / 1.e6, LO_end / 1.e6, LO_step / 1.e6)
-            self.I_data = iqData['I']
-            self.Q_data = iqData['Q']
-            self.freqOffsets = iqData['freqOffsets']
-            if stop_DACAtten > start_DACAtten:
-
-                # Save the power sweep
-                nSteps = len(self.freqOffsets)
-                for n in range(len(self.roachController.freqList)):
-                    w = iqsweep.IQsweep()
-                    w.f0 = self.roachController.freqList[n]
-                    w.span = LO_span / 1e6
-                    w.fsteps = nSteps
-                    w.atten1 = self.roachController.attenList[n] - start_DACAtten + dacAtten
-                    w.atten2 = 0
-                    w.scale = 1.
-                    w.PreadoutdB = -w.atten1 - 20 * np.log10(w.scale)
-                    w.Tstart = 0.100
-                    w.Tend = 0.100
-                    w.I0 = 0.0
-                    w.Q0 = 0.0
-                    w.resnum = n
-                    w.resID = self.roachController.resIDs[n]
-                    w.freq = w.f0 + self.freqOffsets
-                    w.I = self.I_data[n]
-                    w.Q = self.Q_data[n]
-                    w.Isd = np.zeros(nSteps)
-                    w.Qsd = np.zeros(nSteps)
-                    w.time = time.time()
-                    w.savenoise = 0
-                    w.Save(powerSweepFile, 'r0', 'a')  # always r0
+        powerSweep = stop_DACAtten > start_DACAtten
+        if powerSweep:
+            powerSweepFile = self.roachController.tagfile(self.config.roaches.get('r{}.powersweeproot'.format(self.num)),
+                                                          dir=self.config.paths.data,
+                                                          epilog=time.strftime("%Y%m%d-%H%M%S", time.localtime()))
+            # Acquisition stays on this thread. The analysis and HDF5 save of each attenuation's block
+            # overlap with the acquisition of the next one
+            self.powerSweepSummary = {'dacAtten': [], 'centers': [], 'maxIQVel': []}
+            pipeline = PipelineWorker(lambda block: self._processPowerSweepBlock(powerSweepFile, LO_span,
+                                                                                start_DACAtten, block))
+            pipeline.start()
+
+        try:
+            for dacAtten in np.arange(start_DACAtten, stop_DACAtten + 1):
+                if powerSweep:
+                    dacAtten1 = np.floor(dacAtten * 2) / 4.
+                    dacAtten2 = np.ceil(dacAtten * 2) / 4.
+                    self.roachController.changeAtten(1, dacAtten1)
+                    self.roachController.changeAtten(2, dacAtten2)
+                    getLogger(__name__).info('Changed DAC atten: {}'.format(dacAtten))
+                    # keep total power on the ADC the same
+                    newADCAtten = self.getOptimalADCAtten(dacAtten - start_DACAtten, newADCAtten)
+                    getLogger(__name__).info('Changed ADC atten: {}'.format(newADCAtten))
+
+                iqData = self.iqSweep(LO_start, LO_end, LO_step)
+                self.I_data = iqData['I']
+                self.Q_data = iqData['Q']
+                self.freqOffsets = iqData['freqOffsets']
+                if powerSweep:
+                    pipeline.put((dacAtten, self.I_data, self.Q_data, self.freqOffsets))
+        except:
+            exc_info = sys.exc_info()
+            if powerSweep:
+                pipeline.close(reraise=False)  # don't hide the acquisition error behind the worker's
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if powerSweep:
+            pipeline.close()  # everything is on disk before we move on
 
         # Get freq list, center, IQonResonance
         # Only for last sweep if power sweeping
@@ -406,7 +447,7 @@ class RoachStateMachine(QtCore.QObject):  # Extends QObject for use with QThread
         # time.sleep(.1)  # I'm not sure if we need this but might need to wait for LO to stabilize after sweep
         iqOnRes = self.roachController.takeAvgIQData(nPoints)
 
-        if stop_DACAtten > start_DACAtten:  # reset the dac/adc atten to the start value again if we did a power sweep
+        if powerSweep:  # reset the dac/adc atten to the start value again if we did a power sweep
             dacAtten1 = np.floor(start_DACAtten * 2) / 4.
             dacAtten2 = np.ceil(start_DACAtten * 2) / 4.
             self.roachController.changeAtten(1, dacAtten1)
@@ -428,6 +469,197 @@ class RoachStateMachine(QtCore.QObject):  # Extends QObject for use with QThread
                 'freqList': fList, 'centers': np.copy(self.centers), 'IonRes': np.copy(iqOnRes['I']),
                 'QonRes': np.copy(iqOnRes['Q'])}
     
+    def _processPowerSweepBlock(self, powerSweepFile, LO_span, start_DACAtten, block):
+        """
+        Analysis and save stage of the power sweep pipeline. Runs in a PipelineWorker thread
+
+        Appends the loop centers and max IQ velocity of each resonator to self.powerSweepSummary
+        then saves the sweep of every resonator at this attenuation to the power sweep file
+
+        INPUTS:
+            block - (dacAtten, I, Q, freqOffsets) from a single attenuation
+        """
+        dacAtten, I_data, Q_data, freqOffsets = block
+        I_data = np.asarray(I_data)
+        Q_data = np.asarray(Q_data)
+
+        iqVel = np.sqrt(np.diff(I_data, axis=1) ** 2 + np.diff(Q_data, axis=1) ** 2)
+        self.powerSweepSummary['dacAtten'].append(dacAtten)
+        self.powerSweepSummary['centers'].append(self.loopCenters(I_data, Q_data, freqOffsets))
+        self.powerSweepSummary['maxIQVel'].append(np.max(iqVel, axis=1))
+
+        nSteps = len(freqOffsets)
+        h5file = open_file(powerSweepFile, mode='a', title="IQ sweep file created " + time.asctime())
+        try:
+            for n in range(len(self.roachController.freqList)):
+                w = iqsweep.IQsweep()
+                w.f0 = self.roachController.freqList[n]
+                w.span = LO_span / 1e6
+                w.fsteps = nSteps
+                w.atten1 = self.roachController.attenList[n] - start_DACAtten + dacAtten
+                w.atten2 = 0
+                w.scale = 1.
+                w.PreadoutdB = -w.atten1 - 20 * np.log10(w.scale)
+                w.Tstart = 0.100
+                w.Tend = 0.100
+                w.I0 = 0.0
+                w.Q0 = 0.0
+                w.resnum = n
+                w.resID = self.roachController.resIDs[n]
+                w.freq = w.f0 + freqOffsets
+                w.I = I_data[n]
+                w.Q = Q_data[n]
+                w.Isd = np.zeros(nSteps)
+                w.Qsd = np.zeros(nSteps)
+                w.time = time.time()
+                w.savenoise = 0
+                w.SaveTo(h5file, 'r0')  # always r0
+        finally:
+            h5file.close()
+
+    def getOptimalADCAtten(self, dacAttenOffset, startAtten):
+        """
+        Sets the ADC atten for the current DAC comb, only searching for it with
+        Roach2Controls.getOptimalADCAtten() if we haven't already found it at the same total DAC power.
+
+        The cache is keyed on the total power of the DAC comb in dB (to the nearest 0.25 dB) so
+        it stays valid across sweeps. It's cleared whenever the freqs are loaded or the DAC comb is redefined.
+
+        INPUTS:
+            dacAttenOffset - global DAC atten relative to the attenuations in the freq file
+            startAtten - where to start the search if it isn't cached
+        OUTPUTS:
+            the optimal ADC atten
+        """
+        attens = np.asarray(self.roachController.attenList, dtype=float) + dacAttenOffset
+        totalDacPower = 10 * np.log10(np.sum(10 ** (-attens / 10.)))
+        key = np.round(4 * totalDacPower) / 4.
+        if key in self.adcAttenCache:
+            adcAtten = self.adcAttenCache[key]
+            self.roachController.changeAtten(3, np.floor(adcAtten * 2) / 4.)
+            self.roachController.changeAtten(4, np.ceil(adcAtten * 2) / 4.)
+            getLogger(__name__).debug('Using cached ADC atten {} for DAC power {} dB'.format(adcAtten, key))
+            return adcAtten
+        adcAtten = self.roachController.getOptimalADCAtten(startAtten)
+        self.adcAttenCache[key] = adcAtten
+        return adcAtten
+
+    def loopCenters(self, I_data, Q_data, freqOffsets=None):
+        """
+        Finds the (I,Q) center of the loops by fitting a circle to every resonator at once with
+        LoopFitter.fitLoops(). If sweepcabledelay is set in the config the cable delay is removed first,
+        relative to each tone so the centers stay in the frame the firmware sees on resonance.
+
+        Resonators where the fit fails, or the loop is so flat the fitted center is far from the data,
+        fall back to the middle of the 5th-95th percentile range of I and Q
+
+        INPUTS:
+            I_data, Q_data - [nFreqs, nLOsteps]
+            freqOffsets - [nLOsteps] LO offsets in Hz. Only needed for the cable delay
+        OUTPUTS:
+            centers - [nFreqs, 2]
+        """
+        I_data = np.atleast_2d(I_data)
+        Q_data = np.atleast_2d(Q_data)
+        I_centers = (np.percentile(I_data, 95, axis=1) + np.percentile(I_data, 5, axis=1)) / 2.
+        Q_centers = (np.percentile(Q_data, 95, axis=1) + np.percentile(Q_data, 5, axis=1)) / 2.
+
+        tau = self.config.roaches.get('r{}.sweepcabledelay'.format(self.num))
+        if freqOffsets is None:
+            tau = 0.
+        I_fit, Q_fit, radius = fitLoops(I_data, Q_data, freqOffsets, tau)
+        span = np.maximum(np.ptp(I_data, axis=1), np.ptp(Q_data, axis=1))
+        good = np.isfinite(radius) & (radius < 10 * span)
+        if not np.all(good):
+            getLogger(__name__).debug('Circle fit failed for {} of {} loops'.format(np.sum(~good), len(good)))
+        I_centers[good] = I_fit[good]
+        Q_centers[good] = Q_fit[good]
+        return np.transpose([I_centers.flatten(), Q_centers.flatten()])
+
+    def iqSweep(self, LO_start, LO_end, LO_step):
+        """
+        Sweeps the LO with uniform steps, or with self.adaptiveIQSweep() if sweepadaptive is set in the config
+
+        INPUTS:
+            LO_start, LO_end, LO_step - sweep range and (finest) step size in Hz
+        OUTPUTS:
+            iqData - see Roach2Controls.performIQSweep()
+        """
+        if self.config.roaches.get('r{}.sweepadaptive'.format(self.num)):
+            return self.adaptiveIQSweep(LO_start, LO_end, LO_step)
+        return self.roachController.performIQSweep(LO_start / 1.e6, LO_end / 1.e6, LO_step / 1.e6)
+
+    def adaptiveIQSweep(self, LO_start, LO_end, LO_step, maxFraction=0.8):
+        """
+        Two pass LO sweep that only takes finely spaced points near the resonances
+
+        The coarse pass steps the LO by sweepcoarsestep. Each resonator's center is estimated from
+        the peak IQ velocity, then the fine pass fills in every LO_step offset within sweepfinespan/2
+        of any resonator's center. Both passes are on the same LO_step grid so they merge without duplicates.
+        The LO_step offsets that weren't measured are interpolated from their neighbours, so the result is the
+        same uniform grid a full sweep returns (loop fits, IQ velocities and the power sweep files assume that)
+        With many resonators the windows can cover most of the span. If the two passes would measure more than
+        maxFraction of the LO steps then the fine pass measures all the remaining steps instead, so nothing is
+        interpolated. Spans with fewer than two LO steps are swept uniformly.
+
+        INPUTS:
+            LO_start, LO_end, LO_step - sweep range and fine step size in Hz
+            maxFraction - fraction of the LO steps above which every step is measured
+        OUTPUTS:
+            iqData - see Roach2Controls.performIQSweep()
+        """
+        coarseStep = self.config.roaches.get('r{}.sweepcoarsestep'.format(self.num))
+        fineSpan = self.config.roaches.get('r{}.sweepfinespan'.format(self.num))
+        LO_freq = self.roachController.LOFreq
+
+        LOFreqs = np.arange(LO_start, LO_end, LO_step)
+        if len(LOFreqs) < 2:
+            return self.roachController.performIQSweep(LO_start / 1.e6, LO_end / 1.e6, LO_step / 1.e6)
+        isCoarse = np.zeros(len(LOFreqs), dtype=bool)
+        isCoarse[::max(1, int(np.round(coarseStep / LO_step)))] = True
+        isCoarse[-1] = True  # make sure the coarse pass covers the whole span
+        coarseData = self.roachController.performIQSweepAtLOFreqs(LOFreqs[isCoarse] / 1.e6)
+        coarseOffsets = coarseData['freqOffsets']
+        offsets = LOFreqs - LO_freq
+        isFine = np.zeros(len(LOFreqs), dtype=bool)
+
+        if len(coarseData['I']):
+            # resonance is where the IQ velocity peaks. [nFreqs]
+            iqVel = np.sqrt(np.diff(coarseData['I'], axis=1) ** 2 + np.diff(coarseData['Q'], axis=1) ** 2)
+            resOffsets = ((coarseOffsets[:-1] + coarseOffsets[1:]) / 2.)[np.argmax(iqVel, axis=1)]
+
+            # LO offsets covered by the union of the resonance windows, with the resonances sorted so it's a
+            # searchsorted instead of an [nFreqs, nLOsteps] comparison
+            resOffsets = np.sort(resOffsets)
+            nearest = np.clip(np.searchsorted(resOffsets, offsets), 1, len(resOffsets) - 1)
+            distance = np.minimum(np.abs(offsets - resOffsets[nearest - 1]), np.abs(offsets - resOffsets[nearest]))
+            isFine = (distance <= fineSpan / 2.) & ~isCoarse
+        if isCoarse.sum() + isFine.sum() > maxFraction * len(LOFreqs):
+            isFine = ~isCoarse
+        getLogger(__name__).info('Roach {}: adaptive sweep with {} coarse + {} fine LO steps instead of {}'.format(
+            self.num, isCoarse.sum(), isFine.sum(), len(LOFreqs)))
+
+        # merge the two passes in order of LO offset
+        iqData = coarseData
+        if isFine.any():
+            fineData = self.roachController.performIQSweepAtLOFreqs(LOFreqs[isFine] / 1.e6)
+            sortInds = np.argsort(np.concatenate((coarseOffsets, fineData['freqOffsets'])))
+            iqData = {'freqOffsets': np.concatenate((coarseOffsets, fineData['freqOffsets']))[sortInds]}
+            for key in ('I', 'Q'):
+                iqData[key] = np.concatenate((coarseData[key], fineData[key]), axis=1)[:, sortInds]
+
+        # interpolate onto the uniform LO_step grid
+        measured = iqData['freqOffsets']
+        right = np.clip(np.searchsorted(measured, offsets), 1, len(measured) - 1)
+        left = right - 1
+        weight = np.clip((offsets - measured[left]) / (measured[right] - measured[left]), 0., 1.)
+        for key in ('I', 'Q'):
+            data = np.asarray(iqData[key])
+            iqData[key] = data[:, left] * (1 - weight) + data[:, right] * weight
+        iqData['freqOffsets'] = offsets
+        self.roachController.iqSweepData = iqData
+        return iqData
+
     def rotateLoops(self):
         """
         Rotate loops so that the on resonance phase=0.
@@ -456,11 +688,8 @@ class RoachStateMachine(QtCore.QObject):  # Extends QObject for use with QThread
         phaseList = np.copy(self.roachController.ddsPhaseList)
         # channels, streams = self.roachController.freqChannelToStreamChannel()
         channels, streams = self.roachController.getStreamChannelFromFreqChannel()
-        for i in range(len(channels)):
-            if not i%5:
-                getLogger(__name__).info("ch{} str{}".format(channels[i], streams[i]))
-                #getLogger(__name__).info("phaseList shape: {}".format(phaseList.shape))
-            phaseList[channels[i], streams[i]] = phaseList[channels[i], streams[i]] + rotation_phases[i]
+        phaseList[channels, streams] = phaseList[channels, streams] + rotation_phases
+        getLogger(__name__).info("Rotated {} loops".format(len(channels)))
 
         # for i in range(len(self.roachController.freqList)):
         #    arg = np.where(self.roachController.freqChannels == self.roachController.freqList[i])
@@ -535,10 +764,7 @@ class RoachStateMachine(QtCore.QObject):  # Extends QObject for use with QThread
         Finds the (I,Q) center of the loops
         sets self.centers - [nFreqs, 2]
         """
-        I_centers = (np.percentile(self.I_data, 95, axis=1) + np.percentile(self.I_data, 5, axis=1)) / 2.
-        Q_centers = (np.percentile(self.Q_data, 95, axis=1) + np.percentile(self.Q_data, 5, axis=1)) / 2.
-
-        self.centers = np.transpose([I_centers.flatten(), Q_centers.flatten()])
+        self.centers = self.loopCenters(self.I_data, self.Q_data, self.freqOffsets)
 
     def loadFIRs(self):
         """
@@ -0,0 +1,145 @@
+"""
+Checks Roach2Controls.loadFIRCoeffs() without a board
+
+StandInFpga models the firmware's FIR programming interface for each stream: blindwrite() fills the single
+channel coefficient memory (firTapsMem_regs) and setting bit 8 of the load register (firLoadChan_regs) copies
+the memory into the channel in the low 8 bits. Each check loads a filter file onto the stand-in and compares the
+taps of every channel with the ones the original per channel loop would have loaded: the resonator's filter, or
+zeros for channels without a resonator.
+
+Usage:
+$ python firLoadCheck.py [paramFile]
+Exits with status 1 if any check fails
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+
+from mkidcore.corelog import getLogger
+from mkidreadout.channelizer.Roach2Controls import Roach2Controls
+
+
+class StandInFpga(object):
+    def __init__(self, params, keepMemory=True):
+        """
+        INPUTS:
+            params - Roach2Controls params
+            keepMemory - if False the coefficient memory is cleared by every load, so each channel has to be
+                         written before its load
+        """
+        self.memRegs = list(params['firTapsMem_regs'])
+        self.loadRegs = list(params['firLoadChan_regs'])
+        self.keepMemory = keepMemory
+        self.memory = [None] * len(self.memRegs)
+        self.loadVals = [0] * len(self.loadRegs)
+        self.taps = {}  # (stream, ch): taps loaded into the channel
+
+    def blindwrite(self, reg, data, offset=0):
+        self.memory[self.memRegs.index(reg)] = np.frombuffer(data, dtype='>i4').astype(int)
+
+    def write_int(self, reg, val):
+        stream = self.loadRegs.index(reg)
+        if (val & (1 << 8)) and not (self.loadVals[stream] & (1 << 8)):
+            memory = self.memory[stream]
+            self.taps[stream, val & 0xff] = None if memory is None else memory.copy()
+            if not self.keepMemory:
+                self.memory[stream] = None
+        self.loadVals[stream] = val
+
+
+def expectedTaps(roach, firInts):
+    """ The [nStreams, nChannelsPerStream, nTaps] taps the original per channel loop of loadFIRCoeffs() loaded """
+    try:
+        freqChans = range(len(roach.freqList))
+        channels, streams = roach.getStreamChannelFromFreqChannel(freqChans)
+    except AttributeError:
+        freqChans = range(roach.params['nChannels'])
+        streams = np.repeat(range(roach.params['nChannels'] / roach.params['nChannelsPerStream']),
+                            roach.params['nChannelsPerStream'])
+        channels = np.tile(range(roach.params['nChannelsPerStream']),
+                           roach.params['nChannels'] / roach.params['nChannelsPerStream'])
+
+    nStreams = roach.params['nChannels'] / roach.params['nChannelsPerStream']
+    taps = np.zeros((nStreams, roach.params['nChannelsPerStream'], firInts.shape[1]), dtype=int)
+    for stream in range(nStreams):
+        ch_inds = np.where(np.atleast_1d(streams) == stream)
+        ch_stream = np.atleast_1d(channels)[ch_inds]
+        ch_freqs = np.atleast_1d(freqChans)[ch_inds]
+        for ch in range(roach.params['nChannelsPerStream']):
+            if ch in ch_stream:
+                taps[stream, ch] = firInts[ch_freqs[ch_stream == ch][0]]
+    return taps
+
+
+def checkFIRLoad(paramFile='', nResonators=300, perResonator=True, useFreqList=True, skipUnchanged=False,
+                 keepMemory=True, nTaps=30):
+    """
+    Load random filters onto a StandInFpga and compare the taps of every channel with expectedTaps()
+
+    INPUTS:
+        paramFile - Roach2Controls param file
+        nResonators - number of resonators in the freqList
+        perResonator - a filter for each resonator, otherwise one filter for all of them
+        useFreqList - assign the resonators to random stream channels, otherwise load every channel
+        skipUnchanged, keepMemory - passed on to loadFIRCoeffs() and StandInFpga
+        nTaps - number of filter taps
+    OUTPUTS:
+        True if every channel has the expected taps
+    """
+    roach = Roach2Controls('0.0.0.0', paramFile)
+    roach.fpga = StandInFpga(roach.params, keepMemory=keepMemory)
+    nChannels = roach.params['nChannels']
+    nChansPerStream = roach.params['nChannelsPerStream']
+    if useFreqList:
+        slots = np.random.permutation(nChannels)[:nResonators]
+        roach.freqList = np.arange(len(slots))
+        roach.freqChannelToStreamChannel = np.transpose([slots % nChansPerStream, slots // nChansPerStream])
+    nFilters = (len(roach.freqList) if useFreqList else nChannels) if perResonator else 1
+
+    tempDir = tempfile.mkdtemp()
+    try:
+        coeffFile = os.path.join(tempDir, 'fir.txt')
+        # loadFIRCoeffs() reads a row per resonator, or a single column for one filter
+        coeffs = np.random.uniform(-1, 1, (nFilters, nTaps)) if perResonator else np.random.uniform(-1, 1, nTaps)
+        np.savetxt(coeffFile, coeffs)
+        roach.loadFIRCoeffs(coeffFile, skipUnchanged=skipUnchanged)
+
+        firCoeffs = np.transpose(np.loadtxt(coeffFile))
+        if firCoeffs.ndim == 1:
+            firCoeffs = np.tile(firCoeffs, (len(roach.freqList) if useFreqList else nChannels, 1))
+        else:
+            firCoeffs = np.transpose(firCoeffs)
+        firInts = np.asarray(firCoeffs * (2 ** roach.params['firBinPt']), dtype=np.int32)
+    finally:
+        shutil.rmtree(tempDir)
+
+    expected = expectedTaps(roach, firInts)
+    nBad = 0
+    for stream in range(expected.shape[0]):
+        for ch in range(expected.shape[1]):
+            taps = roach.fpga.taps.get((stream, ch))
+            if taps is None or not np.array_equal(taps, expected[stream, ch]):
+                nBad += 1
+    getLogger(__name__).info('perResonator={} useFreqList={} skipUnchanged={} keepMemory={}: {} of {} channels '
+                             'wrong'.format(perResonator, useFreqList, skipUnchanged, keepMemory, nBad,
+                                            expected.shape[0] * expected.shape[1]))
+    return nBad == 0
+
+
+if __name__ == '__main__':
+    paramFile = sys.argv[1] if len(sys.argv) > 1 else ''
+    failed = []
+    for perResonator, useFreqList in ((True, True), (False, True), (True, False), (False, False)):
+        for skipUnchanged, keepMemory in ((False, True), (False, False), (True, True)):
+            case = (perResonator, useFreqList, skipUnchanged, keepMemory)
+            if not checkFIRLoad(paramFile, perResonator=perResonator, useFreqList=useFreqList,
+                                skipUnchanged=skipUnchanged, keepMemory=keepMemory):
+                failed.append(case)
+    if failed:
+        print 'FAILED (perResonator, useFreqList, skipUnchanged, keepMemory):', failed
+        sys.exit(1)
+    print 'All FIR load checks passed'
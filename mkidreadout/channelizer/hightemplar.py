@@ -26,6 +26,7 @@ from __future__ import print_function
 import argparse
 import os
 import sys
+import threading
 import traceback
 from datetime import datetime
 from functools import partial
@@ -318,14 +319,32 @@ class HighTemplar(QMainWindow):
         self.settingsWindow.show()
 
     def onContextAutoADCatten(self, roachNums):
+        """
+        Finds the optimal ADC atten on each idle roach. The boards are independent so the searches run concurrently
+        """
+        newAdcAttens = {}
+
+        def autoADCAtten(roachArg, adcAtten):
+            try:
+                newAdcAttens[roachArg] = self.roaches[roachArg].roachController.getOptimalADCAtten(adcAtten)
+            except Exception:
+                getLogger(__name__).error('Auto ADC Atten failed on roach ' + str(self.roachNums[roachArg]),
+                                          exc_info=True)
+
+        threads = []
         for roachNum in roachNums:
             roachArg = np.where(np.asarray(self.roachNums) == roachNum)[0][0]
             if self.roachThreads[roachArg].isRunning():
                 getLogger(__name__).info('Roach ' + str(roachNum) + ' is busy')
             else:
                 adcAtten = self.roaches[roachArg].config.roaches.get('r{}.adcatten'.format(roachNum))
-                newAdcAtten = self.roaches[roachArg].roachController.getOptimalADCAtten(adcAtten)
-                self.sweepWindows[roachArg].updateADCAttenSpinBox(newAdcAtten)
+                t = threading.Thread(target=autoADCAtten, args=(roachArg, adcAtten))
+                threads.append(t)
+                t.start()
+        for t in threads:
+            t.join()
+        for roachArg, newAdcAtten in newAdcAttens.items():
+            self.sweepWindows[roachArg].updateADCAttenSpinBox(newAdcAtten)
 
     def onContextPlotSweepClick(self, roachNums):
         for roachNum in roachNums:
@@ -322,8 +322,6 @@ class Resonator:
         ax2.set_ylabel("S21 (db)")
         ax2.set_xlabel("f(GHz)")
 
-        p = rf['m'].params
-
         textstr = "Q=%.1f \n "%rf['Q']
         textstr += "Qc=%.1f \n "%rf['Qc']
         textstr += "Qi=%.1f \n "%rf['Qi']
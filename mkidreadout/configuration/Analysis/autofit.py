@@ -3,11 +3,22 @@ import os
 
 import numpy as np
 from matplotlib.backends.backend_pdf import PdfPages
-from mkidreadout.widesweep.WideSweepFile import WideSweepFile
+from mkidreadout.configuration.widesweep.WideSweepFile import WideSweepFile
 
+from fitservice import FitCache, fitWindows
 from Resonator import Resonator
 
 
+def resfitWindow(f, I, Ierr, Q, Qerr):
+    """
+    Resonator.resfit() of one window, run in the fitservice pool. The mpfit object isn't returned so the
+    result can be pickled and cached
+    """
+    rf = Resonator(f, I, Ierr, Q, Qerr).resfit()
+    del rf['m']
+    return rf
+
+
 class Autofit(object):
     def __init__(self, wideSweepFileName, reslocFileName, logFileName):
         self.logFile = open(logFileName, 'wb')
@@ -15,38 +26,65 @@ class Autofit(object):
         self.res = np.loadtxt(reslocFileName)
         self.n = self.res.shape[0]
 
-    def run(self, nToDo='all', width=50, plotFileName=None):
-        if plotFileName:
-            pdf = PdfPages(plotFileName)
-        else:
-            pdf = None
+    def windows(self, nToDo='all', width=50):
+        """
+        The (f, I, Ierr, Q, Qerr) data around each of the first nToDo resonators
+        """
         if nToDo == 'all': nToDo = self.n
-        print nToDo
-        for iToDo in range(nToDo):
-            ind = self.res[iToDo, 1]
-            print "begin iToDo=", iToDo, ' nToDo', nToDo, ' centered at ind=', ind, ' x=', self.wsf.x[ind]
-            indStart = max(0, self.res[iToDo, 1] - width)
-            indEnd = min(len(self.wsf.x), self.res[iToDo, 1] + width + 1 - 10)
-            f = self.wsf.x[indStart:indEnd]
-            I = self.wsf.I[indStart:indEnd]
-            Ierr = self.wsf.Ierr[indStart:indEnd]
-            # Ierr = self.wsf.Ierr
-            Q = self.wsf.Q[indStart:indEnd]
-            Qerr = self.wsf.Qerr[indStart:indEnd]
-            # Qerr = self.wsf.Qerr
-            res = Resonator(f, I, Ierr, Q, Qerr)
-            rf = res.resfit()
+        # the errors may be a single value for the whole sweep
+        Ierr = np.broadcast_to(self.wsf.Ierr, np.shape(self.wsf.x))
+        Qerr = np.broadcast_to(self.wsf.Qerr, np.shape(self.wsf.x))
+        windows = []
+        for iToDo in range(int(nToDo)):
+            ind = int(self.res[iToDo, 1])
+            indStart = max(0, ind - width)
+            indEnd = min(len(self.wsf.x), ind + width + 1 - 10)
+            windows.append((self.wsf.x[indStart:indEnd], self.wsf.I[indStart:indEnd],
+                            Ierr[indStart:indEnd], self.wsf.Q[indStart:indEnd], Qerr[indStart:indEnd]))
+        return windows
+
+    def run(self, nToDo='all', width=50, plotFileName=None, nProcesses=None, cacheFileName=None):
+        """
+        Fit the resonators across a process pool (see fitservice.fitWindows) and write the log. Plotting is
+        a separate stage that only runs once all the fits are done, and only if plotFileName is given
+
+        INPUTS:
+            nToDo - number of resonators to fit, or 'all'
+            width - number of data points around peak to use
+            plotFileName - pdf of the fits. No plots if None
+            nProcesses - number of fitting processes. None uses every cpu
+            cacheFileName - fits are cached in this file, keyed by the window data, so a rerun only fits
+                            resonators whose data changed
+        """
+        windows = self.windows(nToDo, width)
+        cache = FitCache(cacheFileName) if cacheFileName else None
+        fits = fitWindows(resfitWindow, windows, nProcesses=nProcesses, cache=cache)
 
+        for iToDo, rf in enumerate(fits):
+            if rf is None:
+                print "fit failed for iToDo=", iToDo
+                continue
             line = "%4i %17.6f %17.2f %17.2f %17.2f %17.2f\n" % (
             self.res[iToDo, 0], rf['f0'], rf['Q'], rf['Qi'], rf['Qc'], rf['chi2Mazin'])
             self.logFile.write(line)
-            self.logFile.flush()
-            print line
-            res.plot(rf, pdf)
-        if pdf:
-            pdf.close()
         self.logFile.close()
 
+        if plotFileName:
+            self.plot(windows, fits, plotFileName)
+        return fits
+
+    def plot(self, windows, fits, plotFileName):
+        """
+        Write a pdf page for every fit resonator
+        """
+        pdf = PdfPages(plotFileName)
+        try:
+            for window, rf in zip(windows, fits):
+                if rf is not None:
+                    Resonator(*window).plot(rf, pdf)
+        finally:
+            pdf.close()
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Autofit peaks chosen in WideAna.py or WideAna.pro. "
@@ -67,6 +105,10 @@ if __name__ == '__main__':
                         help='number of resonators to fit')
     parser.add_argument('--width', dest='width', default=50,
                         help='number of data points around peak to use')
+    parser.add_argument('--nProcesses', dest='nProcesses', default=None, type=int,
+                        help='number of fitting processes, defaults to every cpu')
+    parser.add_argument('--noPlot', dest='noPlot', action='store_true',
+                        help="don't write the pdf of the fits")
 
     args = parser.parse_args()
     print "args={}".format(args)
@@ -79,7 +121,9 @@ if __name__ == '__main__':
         s = os.path.splitext(args.wideSweepFile)
         reslocFileName = os.path.join(args.dataDir, s[0] + '-freqs-good' + s[1])
     print "rlfn={}".format(reslocFileName)
-    plotFileName = os.path.splitext(wideSweepFileName)[0] + "-autofit.pdf"
+    plotFileName = None if args.noPlot else os.path.splitext(wideSweepFileName)[0] + "-autofit.pdf"
     logFileName = os.path.splitext(wideSweepFileName)[0] + "-autofit.log"
+    cacheFileName = os.path.splitext(wideSweepFileName)[0] + "-autofit-cache.pkl"
     af = Autofit(wideSweepFileName, reslocFileName, logFileName)
-    af.run(nToDo=args.nToDo, width=int(args.width), plotFileName=plotFileName)
+    af.run(nToDo=args.nToDo, width=int(args.width), plotFileName=plotFileName, nProcesses=args.nProcesses,
+           cacheFileName=cacheFileName)
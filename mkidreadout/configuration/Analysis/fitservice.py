@@ -0,0 +1,153 @@
+"""
+Fitting service for independent resonator windows
+
+fitWindows() runs a fit function over a list of data windows (one per resonator) across a process pool.
+Results are cached by a hash of the fit function name, the fit parameters and the window data. Rerunning a survey, or resuming
+one that died, then only fits the windows that are new or changed. Plotting is left to the caller, as a
+separate stage once all the fits are in.
+
+Usage:
+    cache = FitCache('survey-cache.pkl')
+    fits = fitWindows(fitFunction, [(f, I, Q), ...], cache=cache, fitParams={'maxfev': 1000})
+
+fitFunction must be a module level function (so it can be pickled) that takes the arrays of one window as
+positional arguments and fitParams as keyword arguments, and returns something picklable. Anything that changes
+the result of a fit other than the window data has to be in fitParams, or stale fits will be read from the cache.
+"""
+import cPickle as pickle
+import hashlib
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from mkidcore.corelog import getLogger
+
+
+def windowKey(func, window, fitParams=None):
+    """
+    Cache key for fitting window with func: sha1 of the function name, the fit parameters and the dtype, shape
+    and bytes of every array in the window
+    """
+    h = hashlib.sha1(func.__name__)
+    if fitParams:
+        h.update(repr(sorted(fitParams.items())))
+    for a in window:
+        a = np.ascontiguousarray(a)
+        h.update('{}{}'.format(a.dtype.str, a.shape))
+        h.update(a.tobytes())
+    return h.hexdigest()
+
+
+class FitCache(object):
+    """
+    Dictionary of fit results keyed by windowKey(), pickled to fileName. save() writes to a temporary file
+    and renames it so a crash never leaves a truncated cache behind
+    """
+    def __init__(self, fileName=None):
+        self.fileName = fileName
+        self.results = {}
+        if fileName and os.path.isfile(fileName):
+            try:
+                with open(fileName, 'rb') as f:
+                    self.results = pickle.load(f)
+                getLogger(__name__).info('Loaded {} cached fits from {}'.format(len(self.results), fileName))
+            except Exception:
+                getLogger(__name__).warning('Could not read fit cache {}, starting a new one'.format(fileName),
+                                            exc_info=True)
+        self._dirty = False
+
+    def __contains__(self, key):
+        return key in self.results
+
+    def __getitem__(self, key):
+        return self.results[key]
+
+    def __setitem__(self, key, value):
+        self.results[key] = value
+        self._dirty = True
+
+    def __len__(self):
+        return len(self.results)
+
+    def save(self):
+        if not self.fileName or not self._dirty:
+            return
+        tmpName = self.fileName + '.tmp'
+        with open(tmpName, 'wb') as f:
+            pickle.dump(self.results, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpName, self.fileName)
+        self._dirty = False
+
+
+def _fitTask(task):
+    """ Pool worker: task is (index, func, window, fitParams). Failures are returned, not raised, so one bad
+    window doesn't end the survey """
+    index, func, window, fitParams = task
+    try:
+        return index, func(*window, **fitParams), None
+    except Exception as e:
+        return index, None, '{}: {}'.format(type(e).__name__, e)
+
+
+def fitWindows(func, windows, nProcesses=None, cache=None, saveEvery=50, fitParams=None):
+    """
+    Fit every window with func across a process pool
+
+    INPUTS:
+        func - module level function called as func(*window, **fitParams)
+        windows - list of tuples of arrays, one per resonator
+        nProcesses - number of worker processes. None uses every cpu, 1 fits in this process
+        cache - optional FitCache. Windows already in it aren't refit and new results are added
+        saveEvery - save the cache after this many new fits (and always at the end)
+        fitParams - dictionary of keyword arguments for func. They're part of the cache key, so changing them
+                    refits every window
+    OUTPUTS:
+        results - list of func's return value for each window, None where the fit raised
+    """
+    fitParams = fitParams or {}
+    results = [None] * len(windows)
+    keys = [windowKey(func, window, fitParams) for window in windows] if cache is not None else None
+    todo = []
+    for i, window in enumerate(windows):
+        if cache is not None and keys[i] in cache:
+            results[i] = cache[keys[i]]
+        else:
+            todo.append(i)
+    getLogger(__name__).info('Fitting {} of {} windows ({} cached)'.format(len(todo), len(windows),
+                                                                          len(windows) - len(todo)))
+    if not todo:
+        return results
+
+    if nProcesses is None:
+        nProcesses = multiprocessing.cpu_count()
+    nProcesses = max(min(int(nProcesses), len(todo)), 1)
+    tasks = ((i, func, windows[i], fitParams) for i in todo)
+    pool = multiprocessing.Pool(nProcesses) if nProcesses > 1 else None
+    tic = time.time()
+    nFailed = 0
+    try:
+        fits = pool.imap_unordered(_fitTask, tasks) if pool is not None else (_fitTask(task) for task in tasks)
+        for count, (i, result, error) in enumerate(fits):
+            if error is not None:
+                nFailed += 1
+                getLogger(__name__).warning('Fit of window {} failed: {}'.format(i, error))
+            else:
+                results[i] = result
+                if cache is not None:
+                    cache[keys[i]] = result
+                    if not (count + 1) % saveEvery:
+                        cache.save()
+            if not (count + 1) % 100:
+                getLogger(__name__).info('Fit {}/{} windows, {:.1f} fits/s'.format(
+                    count + 1, len(todo), (count + 1) / (time.time() - tic)))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if cache is not None:
+            cache.save()
+    getLogger(__name__).info('Fit {} windows in {:.1f} s with {} processes, {} failed'.format(
+        len(todo), time.time() - tic, nProcesses, nFailed))
+    return results
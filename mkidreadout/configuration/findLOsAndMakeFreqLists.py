@@ -22,17 +22,59 @@ from mkidcore.readdict import ReadDict
 from mkidreadout.configuration.createTemplarResList import createTemplarResList
 
 
-def findLOs(freqs, loRange=0.2, nIters=10000, colParamWeight=1, resBW=0.0002, ifHole=0.003):
+def countSidebandTones(freqs, los, resBW=0.0002, ifHole=0.003, maxElements=2**22):
+    '''
+    Scores each LO in los against a sorted list of resonator frequencies. A tone is in the band of
+    an LO if it's within 1 GHz (the alias band) and further than ifHole from it. Both sidebands fold
+    onto the same IF, so tones in the band whose IFs are closer than resBW collide.
+
+    Parameters
+    ----------
+        freqs - sorted array of resonator frequencies, in GHz
+        los - array of candidate LO frequencies, in GHz
+        resBW, ifHole - see findLOs()
+        maxElements - the IFs of this many (LO, tone) pairs are sorted at once
+    Returns
+    -------
+        nInBand - number of tones in the band of each LO
+        nCollisions - number of sideband collisions of each LO
+    '''
+    los = np.asarray(los, dtype=float)
+    lowStart = np.searchsorted(freqs, los-1, side='right')
+    lowEnd = np.searchsorted(freqs, los-ifHole, side='left')
+    highStart = np.searchsorted(freqs, los+ifHole, side='right')
+    highEnd = np.searchsorted(freqs, los+1, side='left')
+    nInBand = (lowEnd - lowStart) + (highEnd - highStart)
+
+    toneInds = np.arange(len(freqs))
+    nCollisions = np.zeros(len(los), dtype=int)
+    chunk = max(1, maxElements//max(len(freqs), 1))
+    for i in range(0, len(los), chunk):
+        rows = slice(i, i+chunk)
+        isInBand = (((toneInds>=lowStart[rows, np.newaxis]) & (toneInds<lowEnd[rows, np.newaxis])) |
+                    ((toneInds>=highStart[rows, np.newaxis]) & (toneInds<highEnd[rows, np.newaxis])))
+        freqsIF = np.where(isInBand, np.abs(freqs - los[rows, np.newaxis]), 2.) #out of band tones sort to the end
+        freqsIF.sort(axis=1)
+        isColl = np.diff(freqsIF, axis=1)<resBW
+        isColl &= toneInds[:-1]<(nInBand[rows, np.newaxis]-1)
+        nCollisions[rows] = isColl.sum(axis=1)
+
+    return nInBand, nCollisions
+
+def findLOs(freqs, loRange=0.2, loStep=0.0001, colParamWeight=1, resBW=0.0002, ifHole=0.003):
     '''
     Finds the optimal LO frequencies for a feedline, given a list of resonator frequencies.
-    Does Monte Carlo optimization to minimize the number of out of band tones and sideband 
-    collisions.
+    Scores a grid of LO pairs to minimize the number of out of band tones and sideband
+    collisions. The tones in band and the collisions of an LO don't depend on the other LO,
+    so each LO of the grid is scored once (countSidebandTones()) and the pairs are summed.
+    If the resonators span too little for any pair in the search bands to be 2 GHz apart the
+    HF LO grid is extended up to 2 GHz above the highest LF LO.
     
     Parameters
     ----------
         freqs - list of resonator frequencies, in GHz
         loRange - size of LO search band, in GHz
-        nIters - number of optimization interations
+        loStep - spacing of the LO grid, in GHz
         colParamWeight - relative weighting between number of collisions and number of omitted
             tones in cost function. 1 usually gives good performance, set to 0 if you don't want
             to optimize for sideband collisions. 
@@ -43,49 +85,25 @@ def findLOs(freqs, loRange=0.2, nIters=10000, colParamWeight=1, resBW=0.0002, if
     -------
         lo1, lo2 - low and high frequency LOs (in GHz)
     '''
-    lfRange = np.array([freqs[0]+1-loRange/2, freqs[0]+1+loRange/2]) #range to search for LF LO; 200 MHz span
-    hfRange = np.array([freqs[-1]-1-loRange/2, freqs[-1]-1+loRange/2])
-    
-    nCollisionsOpt = len(freqs) #number of sideband collisions
-    nFreqsOmittedOpt = len(freqs) #number of frequencies outside LO band
-    costOpt = nCollisionsOpt + colParamWeight*nCollisionsOpt
-    for i in range(nIters):
-        lo1 = np.random.rand(1)[0]*loRange + lfRange[0]
-        hflolb = max(hfRange[0], lo1 + 2) #lower bound of hf sampling range; want LOs to be 1 GHz apart
-        lo2 = np.random.rand(1)[0]*(hfRange[1]-hflolb) + hflolb
-
-        #find nFreqsOmitted
-        freqsIF1 = freqs - lo1
-        freqsIF2 = freqs - lo2
-        isInLFBand = np.logical_and(np.abs(freqsIF1)<1, np.abs(freqsIF1)>ifHole)
-        isInHFBand = np.logical_and(np.abs(freqsIF2)<1, np.abs(freqsIF2)>ifHole)
-        isNotValidTone = np.logical_not(np.logical_or(isInLFBand, isInHFBand))
-        nFreqsOmitted = np.sum(isNotValidTone)
-
-        #find nCollisions
-        freqsIF1 = freqsIF1[np.where(isInLFBand)]
-        freqsIF2 = freqsIF2[np.where(isInHFBand)]
-        freqsIF1SB = np.sort(np.abs(freqsIF1))
-        freqsIF2SB = np.sort(np.abs(freqsIF2))
-        nLFColl = np.sum(np.diff(freqsIF1SB)<resBW)
-        nHFColl = np.sum(np.diff(freqsIF2SB)<resBW)
-        nCollisions = nLFColl + nHFColl
-
-        #pdb.set_trace()
-
-        cost = nFreqsOmitted + colParamWeight*nCollisions
-        if cost<costOpt:
-            costOpt = cost
-            nCollisionsOpt = nCollisions
-            nFreqsOmittedOpt = nFreqsOmitted
-            lo1Opt = lo1
-            lo2Opt = lo2
-            #print 'nCollOpt', nCollisionsOpt
-            #print 'nFreqsOmittedOpt', nFreqsOmittedOpt
-            #print 'los', lo1, lo2
-
-    print 'Optimal nCollisions', nCollisionsOpt
-    print 'Optimal nFreqsOmitted', nFreqsOmittedOpt
+    freqs = np.sort(np.asarray(freqs, dtype=float))
+    nGrid = int(round(loRange/loStep)) + 1
+    lo1s = np.linspace(freqs[0]+1-loRange/2, freqs[0]+1+loRange/2, nGrid) #range to search for LF LO; 200 MHz span
+    lo2s = np.linspace(freqs[-1]-1-loRange/2, freqs[-1]-1+loRange/2, nGrid)
+    if lo2s[-1] < lo1s[0] + 2: #no pair 2 GHz apart, so search above the HF band too
+        lo2s = np.linspace(lo2s[0], lo1s[-1]+2, int(round((lo1s[-1]+2-lo2s[0])/loStep)) + 1)
+
+    nInBand1, nCollisions1 = countSidebandTones(freqs, lo1s, resBW, ifHole)
+    nInBand2, nCollisions2 = countSidebandTones(freqs, lo2s, resBW, ifHole)
+    nFreqsOmitted = len(freqs) - nInBand1[:, np.newaxis] - nInBand2 #the bands of LOs 2 GHz apart don't overlap
+    nCollisions = nCollisions1[:, np.newaxis] + nCollisions2
+    cost = nFreqsOmitted + colParamWeight*nCollisions
+    cost = np.where(lo2s >= lo1s[:, np.newaxis] + 2, cost, np.inf) #want LOs to be 2 GHz apart
+    i1, i2 = np.unravel_index(np.argmin(cost), cost.shape)
+    lo1Opt = lo1s[i1]
+    lo2Opt = lo2s[i2]
+
+    print 'Optimal nCollisions', nCollisions[i1, i2]
+    print 'Optimal nFreqsOmitted', nFreqsOmitted[i1, i2]
     print 'LO1', lo1Opt
     print 'LO2', lo2Opt
 
@@ -3,262 +3,116 @@ import numpy as np
 import makeNoiseSpectrum as mNS
 
 
-def wienerFilter(template, noiseSpectrum,nTaps=50):
+def wienerFilter(template, noiseSpectrum, nTaps=50, cutoff=250000., rolloff=True, sampleRate=1e6):
     """
     Default Filter. Calculate acausal Wiener Filter coefficients (roll off frequencies above 250 kHz)     
+
+    The wienerFilter* variants are this filter with a different cutoff or with the frequencies above
+    the cutoff discarded instead of rolled off. Filters for many resonators are made in one call by
+    stacking their templates and noise spectra.
  
     INPUTS:
-    noiseSpectrum - noise spectrum same length as template
-    template - template of pulse shape
+    noiseSpectrum - noise spectrum same length as template ([nResonators, nFreqs] for several)
+    template - template of pulse shape ([nResonators, nSamples] for several)
+    nTaps - number of filter coefficients
+    cutoff - frequency (Hz) above which the template is suppressed, None to use all frequencies
+    rolloff - simulate an anti-aliasing filter roll off above cutoff, otherwise discard those frequencies
+    sampleRate - sample rate of the template (Hz)
     
     OUTPUTS:
-    wienerFilter - list of Wiener Filter coefficients
+    wienerFilter - list of Wiener Filter coefficients ([nResonators, nTaps] for several)
     """
-    template /= np.max(np.abs(template)) #should be redundant
+    template = np.asarray(template, dtype=float)
+    template = template/np.max(np.abs(template), axis=-1)[..., np.newaxis] #should be redundant
+
+    templateFft = np.fft.rfft(template, axis=-1)
+    if cutoff is not None:
+        freqs = np.fft.rfftfreq(template.shape[-1], d=1./sampleRate)
+        if rolloff:
+            #simulate anti-aliasing filter roll off
+            templateFft = templateFft/(1+(freqs/cutoff)**8.0)
+        else:
+            templateFft[..., freqs>cutoff] = 0
 
-    #simulate anti-aliasing filter roll off
-    templateFft=np.fft.rfft(template)
-    spectrum=1/(1+(np.fft.rfftfreq(len(template),d=1e-6)/250000.0)**8.0)
-    templateFft=templateFft*spectrum
-    
     #set up so that filter works with a coorelation, not a convolution. 
     #Take the conjugate of templateFft for the other case
-    wienerFilter= np.fft.irfft(np.conj(templateFft)/noiseSpectrum)[-nTaps:]
-    filterNorm = np.convolve(template[:nTaps],wienerFilter, mode='same').max()
-    wienerFilter /= filterNorm
+    wienerFilter = np.fft.irfft(np.conj(templateFft)/noiseSpectrum, axis=-1)[..., -nTaps:]
+    #peak of np.convolve(template[:nTaps], wienerFilter, mode='same') for every resonator at once
+    filterNorm = np.max(mNS.convolveRows(template[..., :nTaps], wienerFilter), axis=-1)[..., np.newaxis]
     
-    return -wienerFilter
+    return -wienerFilter/filterNorm
 
 def wienerFilter250(template, noiseSpectrum,nTaps=50):
     """
     Calculate acausal Wiener Filter coefficients (discard frequencies above 250 kHz)
 
-    INPUTS:
-    noiseSpectrum - noise spectrum same length as template
-    template - template of pulse shape
-    
-    OUTPUTS:
-    wienerFilter - list of Wiener Filter coefficients
+    Same as wienerFilter with cutoff=250000. and rolloff=False
     """
-    noiseFreqs=np.fft.rfftfreq(len(template),d=1e-6)
-    logic=(noiseFreqs>250000)
-    template /= np.max(np.abs(template)) #should be redundant
-
-    templateFft=np.fft.rfft(template)
-    templateFft[logic]=0     
-
-    #set up so that filter works with a coorelation, not a convolution. 
-    #Take the conjugate of templateFft for the other case
-    wienerFilter= np.fft.irfft(np.conj(templateFft)/noiseSpectrum)[-nTaps:]
-    filterNorm = np.convolve(template[:nTaps], wienerFilter, mode='same').max()
-    wienerFilter /= filterNorm
-
-    return -wienerFilter
+    return wienerFilter(template, noiseSpectrum, nTaps=nTaps, cutoff=250000., rolloff=False)
 
 def wienerFilter250s(template, noiseSpectrum,nTaps=50):
     """
     Calculate acausal Wiener Filter coefficients (roll off frequencies above 250 kHz)     
- 
-    INPUTS:
-    noiseSpectrum - noise spectrum same length as template
-    template - template of pulse shape
-    
-    OUTPUTS:
-    wienerFilter - list of Wiener Filter coefficients
-    """
-    template /= np.max(np.abs(template)) #should be redundant
 
-    #simulate anti-aliasing filter roll off
-    templateFft=np.fft.rfft(template)
-    spectrum=1/(1+(np.fft.rfftfreq(len(template),d=1e-6)/250000.0)**8.0)
-    templateFft=templateFft*spectrum
-    
-    #set up so that filter works with a coorelation, not a convolution. 
-    #Take the conjugate of templateFft for the other case
-    wienerFilter= np.fft.irfft(np.conj(templateFft)/noiseSpectrum)[-nTaps:]
-    filterNorm = np.convolve(template[:nTaps], wienerFilter, mode='same').max()
-    wienerFilter /= filterNorm
-    
-    return -wienerFilter
+    Same as wienerFilter with cutoff=250000.
+    """
+    return wienerFilter(template, noiseSpectrum, nTaps=nTaps, cutoff=250000.)
 
 def wienerFilter200(template, noiseSpectrum,nTaps=50):
     """
     Calculate acausal Wiener Filter coefficients (discard frequencies above 200 kHz)
 
-    INPUTS:
-    noiseSpectrum - noise spectrum same length as template
-    template - template of pulse shape
-    
-    OUTPUTS:
-    wienerFilter - list of Wiener Filter coefficients
+    Same as wienerFilter with cutoff=200000. and rolloff=False
     """
-    noiseFreqs=np.fft.rfftfreq(len(template),d=1e-6)
-    logic=(noiseFreqs>200000)
-    template /= np.max(np.abs(template)) #should be redundant
-
-    templateFft=np.fft.rfft(template)
-    templateFft[logic]=0     
-
-    #set up so that filter works with a coorelation, not a convolution. 
-    #Take the conjugate of templateFft for the other case
-    wienerFilter= np.fft.irfft(np.conj(templateFft)/noiseSpectrum)[-nTaps:]
-    filterNorm = np.convolve(template[:nTaps], wienerFilter, mode='same').max()
-    wienerFilter /= filterNorm
-
-    return -wienerFilter
+    return wienerFilter(template, noiseSpectrum, nTaps=nTaps, cutoff=200000., rolloff=False)
 
 def wienerFilter200s(template, noiseSpectrum,nTaps=50):
     """
     Calculate acausal Wiener Filter coefficients (roll off frequencies above 200 kHz)     
- 
-    INPUTS:
-    noiseSpectrum - noise spectrum same length as template
-    template - template of pulse shape
-    
-    OUTPUTS:
-    wienerFilter - list of Wiener Filter coefficients
-    """
-    template /= np.max(np.abs(template)) #should be redundant
 
-    #simulate anti-aliasing filter roll off
-    templateFft=np.fft.rfft(template)
-    spectrum=1/(1+(np.fft.rfftfreq(len(template),d=1e-6)/200000.0)**8.0)
-    templateFft=templateFft*spectrum
-    
-    #set up so that filter works with a coorelation, not a convolution. 
-    #Take the conjugate of templateFft for the other case
-    wienerFilter= np.fft.irfft(np.conj(templateFft)/noiseSpectrum)[-nTaps:]
-    filterNorm = np.convolve(template[:nTaps], wienerFilter, mode='same').max()
-    wienerFilter /= filterNorm
-    
-    return -wienerFilter
+    Same as wienerFilter with cutoff=200000.
+    """
+    return wienerFilter(template, noiseSpectrum, nTaps=nTaps, cutoff=200000.)
 
 def wienerFilter150(template, noiseSpectrum,nTaps=50):
     """
     Calculate acausal Wiener Filter coefficients (discard frequencies above 150 kHz)
 
-    INPUTS:
-    noiseSpectrum - noise spectrum same length as template
-    template - template of pulse shape
-    
-    OUTPUTS:
-    wienerFilter - list of Wiener Filter coefficients
+    Same as wienerFilter with cutoff=150000. and rolloff=False
     """
-    noiseFreqs=np.fft.rfftfreq(len(template),d=1e-6)
-    logic=(noiseFreqs>150000)
-    template /= np.max(np.abs(template)) #should be redundant
-
-    templateFft=np.fft.rfft(template)
-    templateFft[logic]=0     
-
-    #set up so that filter works with a coorelation, not a convolution. 
-    #Take the conjugate of templateFft for the other case
-    wienerFilter= np.fft.irfft(np.conj(templateFft)/noiseSpectrum)[-nTaps:]
-    filterNorm = np.convolve(template[:nTaps], wienerFilter, mode='same').max()
-    wienerFilter /= filterNorm
-
-    return -wienerFilter
+    return wienerFilter(template, noiseSpectrum, nTaps=nTaps, cutoff=150000., rolloff=False)
 
 def wienerFilter150s(template, noiseSpectrum,nTaps=50):
     """
     Calculate acausal Wiener Filter coefficients (roll off frequencies above 150 kHz)     
- 
-    INPUTS:
-    noiseSpectrum - noise spectrum same length as template
-    template - template of pulse shape
-    
-    OUTPUTS:
-    wienerFilter - list of Wiener Filter coefficients
-    """
-    template /= np.max(np.abs(template)) #should be redundant
 
-    #simulate anti-aliasing filter roll off
-    templateFft=np.fft.rfft(template)
-    spectrum=1/(1+(np.fft.rfftfreq(len(template),d=1e-6)/150000.0)**8.0)
-    templateFft=templateFft*spectrum
-    
-    #set up so that filter works with a coorelation, not a convolution. 
-    #Take the conjugate of templateFft for the other case
-    wienerFilter= np.fft.irfft(np.conj(templateFft)/noiseSpectrum)[-nTaps:]
-    filterNorm = np.convolve(template[:nTaps], wienerFilter, mode='same').max()
-    wienerFilter /= filterNorm
-    
-    return -wienerFilter
+    Same as wienerFilter with cutoff=150000.
+    """
+    return wienerFilter(template, noiseSpectrum, nTaps=nTaps, cutoff=150000.)
 
 def wienerFilter100(template, noiseSpectrum,nTaps=50):
     """
     Calculate acausal Wiener Filter coefficients (discard frequencies above 100 kHz)
 
-    INPUTS:
-    noiseSpectrum - noise spectrum same length as template
-    template - template of pulse shape
-    
-    OUTPUTS:
-    wienerFilter - list of Wiener Filter coefficients
+    Same as wienerFilter with cutoff=100000. and rolloff=False
     """
-    noiseFreqs=np.fft.rfftfreq(len(template),d=1e-6)
-    logic=(noiseFreqs>100000)
-    template /= np.max(np.abs(template)) #should be redundant
-
-    templateFft=np.fft.rfft(template)
-    templateFft[logic]=0     
-
-    # set up so that filter works with a convolution, not a correlation.
-    # Remove the conjugate of templateFft for the other case
-    wienerFilter= np.fft.irfft(np.conj(templateFft)/noiseSpectrum)[-nTaps:]
-    filterNorm = np.convolve(template[:nTaps], wienerFilter, mode='same').max()
-    wienerFilter /= filterNorm
-
-    return -wienerFilter
+    return wienerFilter(template, noiseSpectrum, nTaps=nTaps, cutoff=100000., rolloff=False)
 
 def wienerFilter100s(template, noiseSpectrum,nTaps=50):
     """
     Calculate acausal Wiener Filter coefficients (roll off frequencies above 100 kHz)     
- 
-    INPUTS:
-    noiseSpectrum - noise spectrum same length as template
-    template - template of pulse shape
-    
-    OUTPUTS:
-    wienerFilter - list of Wiener Filter coefficients
-    """
-    template /= np.max(np.abs(template)) #should be redundant
 
-    # simulate anti-aliasing filter roll off
-    templateFft=np.fft.rfft(template)
-    spectrum=1/(1+(np.fft.rfftfreq(len(template),d=1e-6)/100000.0)**8.0)
-    templateFft=templateFft*spectrum
-    
-    # set up so that filter works with a convolution, not a correlation.
-    # Remove the conjugate of templateFft for the other case
-    wienerFilter= np.fft.irfft(np.conj(templateFft)/noiseSpectrum)[-nTaps:]
-    filterNorm = np.convolve(template[:nTaps], wienerFilter, mode='same').max()
-    wienerFilter /= filterNorm
-    
-    return -wienerFilter
+    Same as wienerFilter with cutoff=100000.
+    """
+    return wienerFilter(template, noiseSpectrum, nTaps=nTaps, cutoff=100000.)
 
 def wienerFilter0(template, noiseSpectrum,nTaps=50):
     """
     Calculate acausal Wiener Filter coefficients. All frequencies are used.
 
-    INPUTS:
-    noiseSpectrum - noise spectrum same length as template
-    template - template of pulse shape
-    
-    OUTPUTS:
-    wienerFilter - list of Wiener Filter coefficients
+    Same as wienerFilter with cutoff=None
     """
-
-    template /= np.max(np.abs(template))  # should be redundant
-
-    # set up so that filter works with a convolution, not a correlation.
-    # Remove the conjugate of templateFft for the other case
-    templateFft = np.fft.rfft(template)
-    wienerFilter= np.fft.irfft(np.conj(templateFft)/noiseSpectrum)[-nTaps:]
-
-    filterNorm = np.convolve(template[:nTaps], wienerFilter, mode='same').max()
-    wienerFilter /= filterNorm
-    return -wienerFilter
+    return wienerFilter(template, noiseSpectrum, nTaps=nTaps, cutoff=None)
 
 def matchedFilter(template, noiseSpectrum, nTaps=50):
     """
@@ -275,25 +129,28 @@ def matchedFilter(template, noiseSpectrum, nTaps=50):
                   to get the pulse heights 
     """
     # check normalized to 1
-    template/=np.max(np.abs(template))
+    template = np.asarray(template, dtype=float)
+    template = template/np.max(np.abs(template), axis=-1)[..., np.newaxis]
     
     # mimic antialiasing filter
-    fft=np.fft.rfft(template)
-    spectrum=1/(1+(np.fft.rfftfreq(len(template),d=1e-6)/250000.0)**8.0)
+    fft=np.fft.rfft(template, axis=-1)
+    spectrum=1/(1+(np.fft.rfftfreq(template.shape[-1],d=1e-6)/250000.0)**8.0)
     fft=fft*spectrum
-    template1=np.fft.irfft(fft)
-    template1 /= np.max(np.abs(template1)) 
+    template1=np.fft.irfft(fft, axis=-1)
+    template1 /= np.max(np.abs(template1), axis=-1)[..., np.newaxis]
 
-    noiseCov = mNS.covFromPsd(noiseSpectrum, nTaps)['covMatrix']
+    # Toeplitz noise covariance, solved with the Levinson recursion (batched over resonators)
+    autocovariance = mNS.autocovFromPsd(noiseSpectrum, nTaps)
    
-    template1 = template1[:nTaps]  #shorten template to length nTaps
-    template = template[:nTaps]
+    template1 = template1[..., :nTaps]  #shorten template to length nTaps
+    template = template[..., :nTaps]
 
-    filterNorm= np.dot(template,np.linalg.solve(noiseCov,template1))
-    matchedFilt=np.linalg.solve(noiseCov,template1)/filterNorm
+    solution = mNS.solveToeplitz(autocovariance, template1)
+    filterNorm = np.sum(template*solution, axis=-1)[..., np.newaxis]
+    matchedFilt = solution/filterNorm
 
     # flip so that the result works with a convolution
-    matchedFilt = matchedFilt[::-1]
+    matchedFilt = matchedFilt[..., ::-1]
 
     return -matchedFilt
 
@@ -321,9 +178,9 @@ def superMatchedFilter(template, noiseSpectrum, nTaps=50):
     else:
         pos_neg=1
     # check normalized to 1
-    template/=np.abs(template[np.argmax(np.abs(template))])    
-    # create covariance inverse matrix
-    noiseCovInv = mNS.covFromPsd(noiseSpectrum, nTaps)['covMatrixInv']
+    template = template/np.abs(template[np.argmax(np.abs(template))])    
+    # noise covariance as its autocovariance, the matrix is never inverted
+    autocovariance = mNS.autocovFromPsd(noiseSpectrum, nTaps)
     # shorten template to length nTaps
     template = template[:nTaps]  
     # create exponential to be orthogonal to
@@ -333,9 +190,10 @@ def superMatchedFilter(template, noiseSpectrum, nTaps=50):
     orthMat=np.array([template,exponential])
     orthMat=orthMat.T
     e1=np.array([1,0])
-    norm=np.linalg.inv(np.dot(orthMat.T,np.dot(noiseCovInv,orthMat)))
-    superMatchedFilter=np.dot(noiseCovInv,np.dot(orthMat,np.dot(norm,e1)))
+    covInvOrth = mNS.solveToeplitz(autocovariance, orthMat)
+    norm=np.linalg.inv(np.dot(orthMat.T,covInvOrth))
+    superMatchedFilter=np.dot(covInvOrth,np.dot(norm,e1))
 
     # Flip if you want the filter to work with a correlation and not convolution
     # superMatchedFilter=superMatchedFilter[::-1]
-    return superMatchedFilter  
+    return superMatchedFilter
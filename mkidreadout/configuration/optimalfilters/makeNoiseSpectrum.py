@@ -1,4 +1,5 @@
 import numpy as np
+import scipy.linalg
 
 import triggerPhotons as tP
 
@@ -25,53 +26,42 @@ def makeNoiseSpectrum(data, peakIndices=(), window=800, noiseOffsetFromPeak=200,
     
     #If no peaks, choose random indices to make spectrum 
     if len(peakIndices)==0:
-        peakIndices=np.array([0])
         rate = len(data)/float(window)/1000.
+        meanStep = sampleRate/rate
+        nSteps = int(2*len(data)/meanStep) + 10
+        peakIndices = np.array([0])
         while peakIndices[-1]<(len(data)-1):
-            prob=np.random.rand()
-            currentIndex=peakIndices[-1]
-            peakIndices=np.append(peakIndices,currentIndex+np.ceil(-np.log(prob)/rate*sampleRate).astype(int))
+            steps = np.ceil(-np.log(np.random.rand(nSteps))/rate*sampleRate).astype(int)
+            peakIndices = np.concatenate((peakIndices, peakIndices[-1] + np.cumsum(steps)))
+        peakIndices = peakIndices[:np.argmax(peakIndices>=(len(data)-1))+1]
         peakIndices=peakIndices[:-2]      
     if len(peakIndices)==0:
         raise ValueError('makeNoiseSpectrum: input data set is too short for the number of FFT points specified')
+
+    #noise windows before each pulse, as rows of a strided view of the data
+    peakIndices = peakIndices[(peakIndices > window+noiseOffsetFromPeak) & (peakIndices < len(data)+noiseOffsetFromPeak)]
+    windows = noiseWindows(data, peakIndices-window-noiseOffsetFromPeak, window)
     #Baseline subtract noise data
-    if(baselineSubtract):
-        noiseStream = np.array([])
-        for iPeak,peakIndex in enumerate(peakIndices):
-            if peakIndex > window+noiseOffsetFromPeak and peakIndex < len(data)+noiseOffsetFromPeak:
-                noiseStream = np.append(noiseStream, data[peakIndex-window-noiseOffsetFromPeak:peakIndex-noiseOffsetFromPeak])
-        data = data - np.mean(noiseStream)
+    if(baselineSubtract) and len(windows):
+        windows = windows - np.mean(windows)
     
     #Calculate noise spectra for the defined area before each pulse
-    if len(peakIndices)>2000:
-        peakIndices = peakIndices[:2000]
-        noiseSpectra = np.zeros((len(peakIndices), len(np.fft.rfftfreq(window)) ))
+    windows = windows[:2000]
+    peakIndices = peakIndices[:2000]
+    #Remove windows with pulses by convolving with a filt if provided
+    if len(filt)!=0:
+        filteredData = convolveRows(windows, np.asarray(filt))
+        contaminated = tP.anyPulses(filteredData, nSigmaThreshold = 2., negDerivLenience = 1)
+        good = np.flatnonzero(~contaminated)[:500]
+        nRejected = np.count_nonzero(contaminated[:good[-1]+1]) if len(good) else len(contaminated)
+        windows = windows[good]
+        goodInd = peakIndices[good]
     else:
-        noiseSpectra = np.zeros((len(peakIndices), len(np.fft.rfftfreq(window)) ))
-    rejectInd=np.array([])
-    goodInd=np.array([])
-    counter=0
-    for iPeak,peakIndex in enumerate(peakIndices):
-        if peakIndex > window+noiseOffsetFromPeak and peakIndex < len(data)+noiseOffsetFromPeak:
-            noiseData = data[peakIndex-window-noiseOffsetFromPeak:peakIndex-noiseOffsetFromPeak]
-            noiseSpectra[counter] =4*window/sampleRate*np.abs(np.fft.rfft(data[peakIndex-window-noiseOffsetFromPeak:peakIndex-noiseOffsetFromPeak]))**2
-            if len(filt)!=0:
-                filteredData=np.convolve(noiseData,filt,mode='same')
-                peakDict=tP.detectPulses(filteredData, nSigmaThreshold = 2., negDerivLenience = 1, bNegativePulses=True)
-                if len(peakDict['peakIndices'])!=0:
-                    rejectInd=np.append(rejectInd,int(counter-1)) 
-                else:
-                    goodInd=np.append(goodInd,int(peakIndex))
-                    counter += 1
-        if counter==500:
-            break   
-    noiseSpectra=noiseSpectra[0:counter]
-    #Remove indicies with pulses by convolving with a filt if provided
-    if len(filt)!=0: 
-        noiseSpectra = np.delete(noiseSpectra, rejectInd.astype(int), axis=0) 
+        windows = windows[:500]
+        goodInd = peakIndices[:500]
+        nRejected = 0
+    noiseSpectra = 4*window/sampleRate*np.abs(np.fft.rfft(windows, axis=-1))**2
     noiseFreqs = np.fft.rfftfreq(window,1./sampleRate)
-    if len(np.shape(noiseSpectra))==0:
-        raise ValueError('makeWienerNoiseSpectrum: not enough spectra to average')
     if np.shape(noiseSpectra)[0]<5:
         raise ValueError('makeWienerNoiseSpectrum: not enough spectra to average') 
            
@@ -80,9 +70,34 @@ def makeNoiseSpectrum(data, peakIndices=(), window=800, noiseOffsetFromPeak=200,
     if not np.all(noiseSpectrum>0):
         raise ValueError('makeWienerNoiseSpectrum: not all noise data >0')
     if isVerbose:
-        print len(noiseSpectra[:,0]),'traces used to make noise spectrum', len(rejectInd), 'cut for pulse contamination'
+        print len(noiseSpectra[:,0]),'traces used to make noise spectrum', nRejected, 'cut for pulse contamination'
 
     return {'spectrum':noiseSpectrum, 'freqs':noiseFreqs, 'indices':goodInd}
+
+def noiseWindows(data, starts, window):
+    '''
+    Gather data[start:start+window] for each start into a [len(starts), window] array using a strided view
+    of the data, so there is one copy and no loop
+    '''
+    data = np.ascontiguousarray(data)
+    starts = np.asarray(starts, dtype=int)
+    if len(data) < window:
+        return np.zeros((0, window), dtype=data.dtype)
+    view = np.lib.stride_tricks.as_strided(data, shape=(len(data)-window+1, window),
+                                           strides=(data.strides[0], data.strides[0]))
+    return view[starts]
+
+def convolveRows(data, filt):
+    '''
+    np.convolve(row, filt, mode='same') of every row of data, with one batched FFT. filt is either a single
+    filter or one per row
+    '''
+    nSamples = data.shape[-1]
+    nFilt = filt.shape[-1]
+    nFull = nSamples + nFilt - 1
+    full = np.fft.irfft(np.fft.rfft(data, nFull, axis=-1)*np.fft.rfft(filt, nFull, axis=-1), nFull, axis=-1)
+    start = (min(nSamples, nFilt)-1)//2
+    return full[..., start:start+max(nSamples, nFilt)]
     
 def covFromData(data,size=800,nTrials=None):
     '''
@@ -99,22 +114,52 @@ def covFromData(data,size=800,nTrials=None):
     covMatrixInv = np.linalg.inv(covMatrix)
     return {'covMatrix':covMatrix,'covMatrixInv':covMatrixInv}
 
-def covFromPsd(powerSpectrum,size=None):
+def autocovFromPsd(powerSpectrum, size=None):
     '''
-    make a covariance matrix from a power spectral density
+    autocovariance (the first row of the Toeplitz covariance matrix) of a power spectral density.
+    Works on the last axis so several spectra can be stacked
     '''
-    autocovariance = np.real(np.fft.irfft(powerSpectrum))
-    if size is None:
-        size = len(autocovariance)
-    sampledAutocovariance = autocovariance[0:size]
+    return np.fft.irfft(powerSpectrum, axis=-1)[..., :size]
 
-    shiftingRow = np.concatenate((sampledAutocovariance[:0:-1],sampledAutocovariance))
-    covMatrix = []
+def solveToeplitz(autocovariance, b):
+    '''
+    Solve covMatrix x = b for the symmetric Toeplitz covariance matrix with first row autocovariance, using the
+    Levinson recursion instead of building and inverting the matrix.
 
-    for iRow in range(size):
-        covMatrix.append(shiftingRow[size-iRow-1:size-iRow-1+size])
+    INPUTS:
+    autocovariance - first row of the covariance matrix. [nResonators, size] solves a system per resonator in
+        one vectorized recursion
+    b - right hand side, [size] or [size, nRHS] (with the same leading axes as autocovariance)
 
-    covMatrix = np.array(covMatrix)
+    OUTPUTS:
+    x, same shape as b
+    '''
+    autocovariance = np.asarray(autocovariance, dtype=float)
+    b = np.asarray(b, dtype=float)
+    if autocovariance.ndim == 1:
+        return scipy.linalg.solve_toeplitz(autocovariance, b)
+    isVector = b.ndim == autocovariance.ndim
+    if isVector:
+        b = b[..., np.newaxis]
+    size = autocovariance.shape[-1]
+    zero = np.zeros(autocovariance.shape[:-1] + (1,))
+    forward = 1/autocovariance[..., :1]  # solves covMatrix f = [1, 0, ...] for the leading k x k block
+    x = b[..., :1, :]/autocovariance[..., :1, np.newaxis]
+    for k in range(1, size):
+        lags = autocovariance[..., k:0:-1]
+        error = np.sum(lags*forward, axis=-1, keepdims=True)
+        forward = (np.concatenate((forward, zero), axis=-1) -
+                   error*np.concatenate((zero, forward[..., ::-1]), axis=-1))/(1 - error**2)
+        xError = np.sum(lags[..., np.newaxis]*x, axis=-2)
+        x = (np.concatenate((x, np.zeros_like(x[..., :1, :])), axis=-2) +
+             (b[..., k, :] - xError)[..., np.newaxis, :]*forward[..., ::-1, np.newaxis])
+    return x[..., 0] if isVector else x
 
-    covMatrixInv = np.linalg.inv(covMatrix)
+def covFromPsd(powerSpectrum,size=None):
+    '''
+    make a covariance matrix from a power spectral density
+    '''
+    sampledAutocovariance = autocovFromPsd(powerSpectrum, size)
+    covMatrix = scipy.linalg.toeplitz(sampledAutocovariance)
+    covMatrixInv = solveToeplitz(sampledAutocovariance, np.eye(len(sampledAutocovariance)))
     return {'covMatrix':covMatrix,'covMatrixInv':covMatrixInv,'autocovariance':sampledAutocovariance}
@@ -245,22 +245,16 @@ def averagePulses(data, peakIndices, nPointsBefore=5, nPointsAfter=195, decayTim
     time - time markers indexing data points in 'template'
            (use as x-axis when plotting)
     '''
-    numPeaks = 0
-    template=np.zeros(nPointsBefore+nPointsAfter)
-    for iPeak,peakIndex in enumerate(peakIndices):
-        peakIndex=int(peakIndex)
-        if peakIndex >= max(nPointsBefore,decayTime) and peakIndex < min(len(data)-nPointsAfter,len(data)-decayTime):
-            peakRecord = data[int(peakIndex-nPointsBefore):int(peakIndex+nPointsAfter)]
-            peakData = data[int(peakIndex-decayTime):int(peakIndex+decayTime)]
-
-            peakHeight = np.max(np.abs(peakData))
-            peakRecord /= peakHeight
-
-            template += peakRecord
-            numPeaks += 1
-    if numPeaks==0:
+    # gather every valid pulse into a [nPulses, nPoints] array (a copy, data is not modified)
+    peakIndices = np.asarray(peakIndices).astype(int)
+    peakIndices = peakIndices[(peakIndices >= max(nPointsBefore, decayTime)) &
+                              (peakIndices < min(len(data)-nPointsAfter, len(data)-decayTime))]
+    if len(peakIndices)==0:
         raise ValueError('averagePulses: No valid peaks found')
-    
+    peakRecords = mNS.noiseWindows(data, peakIndices-nPointsBefore, nPointsBefore+nPointsAfter)
+    peakHeights = np.max(np.abs(mNS.noiseWindows(data, peakIndices-decayTime, 2*decayTime)), axis=1)
+
+    template = np.sum(peakRecords/peakHeights[:, np.newaxis], axis=0)
     template=template/np.max(np.abs(template))
     time = np.arange(0,nPointsBefore+nPointsAfter)/sampleRate
     return template, time
@@ -282,30 +276,25 @@ def correctPeakOffs(data, peakIndices, noiseDict, template, offsets=np.arange(-2
     newPeakIndices - list of corrected peak indices
     '''
         
-    nOffsets = len(offsets)
+    offsets = np.asarray(offsets)
     nPointsTotal = nPointsBefore + nPointsAfter
-    filterSet = np.zeros((nOffsets,len(np.fft.rfftfreq(nPointsTotal)) ),dtype=np.complex64)
-    newPeakIndices = []
-    
-    # Create a set of filters from different template offsets
-    for i,offset in enumerate(offsets):
-        templateOffs = np.roll(template, offset)
-        filterSet[i] = makeWienerFilter(noiseDict, templateOffs)
+
+    # Create a set of filters from different template offsets (row i is np.roll(template, offsets[i]))
+    rollIndices = (np.arange(len(template))[np.newaxis, :] - offsets[:, np.newaxis]) % len(template)
+    filterSet = makeWienerFilter(noiseDict, template[rollIndices]).astype(np.complex64)
 
     #find which peak index offset is the best for each pulse:
     #   apply each offset to the pulse, then determine which offset 
     #   maximizes the pulse amplitude after application of the filter
-    for iPeak,peakIndex in enumerate(peakIndices):
-        if peakIndex > nPointsBefore-np.min(offsets) and peakIndex < len(data)-(nPointsAfter+np.max(offsets)):
-            peakRecord = data[int(peakIndex-nPointsBefore):int(peakIndex+nPointsAfter)]
-            peakRecord = peakRecord /peakRecord[nPointsBefore]
-            #check which time shifted filter results in the biggest signal
-            peakRecordFft = np.fft.rfft(peakRecord)/nPointsTotal
-            convSums = np.abs(np.sum(filterSet*peakRecordFft,axis=1))
-            bestOffsetIndex = np.argmax(convSums)
-            bestConvSum = convSums[bestOffsetIndex]
-            bestOffset = offsets[bestOffsetIndex]
-            newPeakIndices=np.append(newPeakIndices, int(peakIndex+bestOffset))
+    peakIndices = np.asarray(peakIndices)
+    peakIndices = peakIndices[(peakIndices > nPointsBefore-np.min(offsets)) &
+                              (peakIndices < len(data)-(nPointsAfter+np.max(offsets)))].astype(int)
+    peakRecords = mNS.noiseWindows(data, peakIndices-nPointsBefore, nPointsTotal)
+    peakRecords = peakRecords/peakRecords[:, nPointsBefore:nPointsBefore+1]
+    #check which time shifted filter results in the biggest signal
+    peakRecordFfts = np.fft.rfft(peakRecords, axis=1)/nPointsTotal
+    convSums = np.abs(np.dot(peakRecordFfts, filterSet.T))
+    newPeakIndices = peakIndices + offsets[np.argmax(convSums, axis=1)]
 
     return newPeakIndices
     
@@ -315,16 +304,17 @@ def makeWienerFilter(noiseDict, template):
     
     INPUTS:
     noiseDict - Dictionary containing noise spectrum and list of corresponding frequencies
-    template - template of pulse shape
+    template - template of pulse shape, or a [nTemplates, nPoints] array of templates
     
     OUTPUTS:
-    wienerFilter - list of Wiener Filter coefficients
+    wienerFilter - list of Wiener Filter coefficients (one row per template)
     '''
-    template /= np.max(np.abs(template)) #should be redundant
+    template = np.asarray(template, dtype=float)
+    template = template/np.max(np.abs(template), axis=-1, keepdims=True) #should be redundant
     noiseSpectrum = noiseDict['spectrum']
-    templateFft = np.fft.rfft(template)/len(template)
+    templateFft = np.fft.rfft(template, axis=-1)/template.shape[-1]
     wienerFilter = np.conj(templateFft)/noiseSpectrum
-    filterNorm = np.sum(np.abs(templateFft)**2/noiseSpectrum)
+    filterNorm = np.sum(np.abs(templateFft)**2/noiseSpectrum, axis=-1, keepdims=True)
     wienerFilter /= filterNorm
     return wienerFilter
         
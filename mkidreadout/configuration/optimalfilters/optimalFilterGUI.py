@@ -417,7 +417,8 @@ class MainWindow(QtGui.QMainWindow):
  
 def execute_filter_calcs(progress_callback=[],dataset=[],mainDirectory=[],directory=[],continuing=False,filterMethod=mF.wienerFilter):
     defaultTemplate=np.loadtxt('template200_15us.txt') #change default template here
-    result=pD.processData(directory,defaultTemplate,GUI=True, progress_callback=progress_callback, dataset=dataset, mainDirectory=mainDirectory, continuing=continuing,filterMethod=filterMethod)    
+    result=pD.processData(directory,defaultTemplate,GUI=True, progress_callback=progress_callback, dataset=dataset, mainDirectory=mainDirectory, continuing=continuing,filterMethod=filterMethod,
+                          nProcesses=1) #datasets already run in parallel in the QThreadPool
     return result   
 
 def execute_filters_only(filterCode=[],progress_callback=[],dataset=[],mainDirectory=[],directory=[],filterMethod=mF.wienerFilter): 
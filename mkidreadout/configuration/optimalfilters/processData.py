@@ -1,3 +1,4 @@
+import multiprocessing
 import os
 import pickle
 import sys
@@ -9,12 +10,137 @@ import makeFilters as mF
 import makeNoiseSpectrum as mNS
 import makeTemplate as mT
 
+# filter types stored in filter_type.txt
+TYPE_MESSAGES = {0: "template and filter calculation failed. Using default template as filter",
+                 1: "filter calculation failed. Using calculated template as filter",
+                 2: "template calculation failed. Using default template with noise as filter",
+                 3: "calculation successful"}
+STAGES = ('load', 'template', 'filter')
+
+
+def resultsDtype(nTemplate=200, nTaps=50):
+    """
+    numpy dtype of one row of the processData checkpoint file
+    INPUTS:
+    nTemplate - number of template coefficients
+    nTaps - number of filter coefficients
+    """
+    return np.dtype([('fileName', 'S256'), ('done', np.bool_), ('loaded', np.bool_),
+                     ('type', np.int8), ('filter', np.float64, nTaps),
+                     ('template', np.float64, nTemplate),
+                     ('roughTemplate', np.float64, nTemplate),
+                     ('noise', np.float64, nTemplate // 2 + 1),
+                     ('fourier', np.float64, nTaps // 2 + 1),
+                     ('timing', np.float64, len(STAGES))])
+
+
+def processFile(directory, fileName, defaultTemplate, filterMethod=mF.wienerFilter,
+                nTaps=50):
+    """
+    Create the template, noise spectrum and filter for a single resonator .npz file
+    INPUTS:
+    directory - path for the folder containing the data
+    fileName - name of the .npz file in directory
+    defaultTemplate - numpy array with template coefficients (200 coefficients)
+    filterMethod - filter calculation method. Must have same input structure as functions
+                   in makeFilter.py
+    nTaps - number of filter coefficients
+    OUTPUTS:
+    result - dictionary with the fields of resultsDtype(). 'type' is the index into
+             TYPE_MESSAGES and 'timing' holds the load, template and filter times in s
+    """
+    # make default Filter (renormalize and flip)
+    defaultFilter = -defaultTemplate[0:nTaps] / np.dot(defaultTemplate[0:nTaps],
+                                                       defaultTemplate[0:nTaps])
+    defaultFilter = defaultFilter[::-1]
+    nNoise = len(defaultTemplate) // 2 + 1
+    result = {'loaded': True, 'type': 0, 'template': defaultTemplate,
+              'roughTemplate': np.zeros(np.shape(defaultTemplate)),
+              'noise': np.zeros(nNoise), 'filter': defaultFilter}
+    startLoop = time.time()
+    finishedLoad = startLoop
+    finishedTemp = startLoop
+
+    # reinitialize flags
+    noiseFlag = 0
+    templateFlag = 0
+    filterFlag = 0
+
+    # load data
+    try:
+        rawData = np.load(os.path.join(directory, fileName))
+        key = rawData.keys()
+        rawData = rawData[key[0]]
+    except Exception:
+        # use default filter and templates
+        result['loaded'] = False
+    finishedLoad = time.time()
+
+    if result['loaded']:
+        # make template
+        try:
+            template, _, noiseDict, templateList, _ = mT.makeTemplate(
+                rawData, nSigmaTrig=5., numOffsCorrIters=2, defaultFilter=defaultFilter)
+            result['roughTemplate'] = templateList[-1]
+            noiseFlag = 1
+            # check for bad template
+            # (fall times greater than 7 and less than 50, assuming 50 points given)
+            if (np.trapz(template[5:50]) > -5 or np.trapz(template[5:50]) < -31.6
+               or templateList[-1][5] != -1):
+                raise ValueError('proccessData: template not correct')
+            result['template'] = template
+            templateFlag = 1
+        except Exception:
+            result['roughTemplate'] = np.zeros(np.shape(defaultTemplate))
+        finishedTemp = time.time()
+
+        # make filter
+        try:
+            if templateFlag:
+                filterCoef = filterMethod(template, noiseDict['spectrum'], nTaps=nTaps)
+            elif noiseFlag:
+                filterCoef = filterMethod(defaultTemplate, noiseDict['spectrum'],
+                                          nTaps=nTaps)
+            else:
+                data = mT.hpFilter(rawData)
+                noiseDict = mNS.makeNoiseSpectrum(data, window=len(defaultTemplate),
+                                                  filt=defaultFilter)
+                filterCoef = filterMethod(defaultTemplate, noiseDict['spectrum'],
+                                          nTaps=nTaps)
+            result['filter'] = filterCoef
+            result['noise'] = noiseDict['spectrum']
+            filterFlag = 1
+        except Exception:
+            if templateFlag:
+                filterArray = -template[:nTaps] / np.dot(template[:nTaps], template[:nTaps])
+                result['filter'] = filterArray[::-1]
+            result['noise'] = np.zeros(nNoise)
+    finishedFilt = time.time()
+
+    # categorize the result (see TYPE_MESSAGES)
+    result['type'] = 2 * filterFlag + templateFlag
+    # find fourier transform of filter for comparison
+    result['fourier'] = np.abs(np.fft.rfft(result['filter']))**2
+    result['timing'] = (finishedLoad - startLoop, finishedTemp - finishedLoad,
+                        finishedFilt - finishedTemp)
+    return result
+
+
+def _processTask(task):
+    """ Pool worker: task is (index, directory, fileName, defaultTemplate, filterMethod) """
+    return task[0], processFile(*task[1:])
+
 
 def processData(directory, defaultTemplate, isVerbose=False, GUI=False,
                 progress_callback=(), dataset=(), mainDirectory=(), continuing=False,
-                filterMethod=mF.wienerFilter):
+                filterMethod=mF.wienerFilter, nProcesses=None):
     """
-    Loop through .npz files in the directory and create filter coefficient files for each
+    Create filter coefficient files for each .npz file in the directory. Files are handed
+    out one resonator at a time to a pool of processes and every result is checkpointed
+    to <filterName>_results.npy as it arrives, so a stopped or crashed calculation resumes
+    with exactly the files that were not finished. The text files (<filterName>
+    _coefficients.txt, template_coefficients.txt, ...) are written from the checkpoint in
+    channel order once all files are done.
     INPUTS:
     directory - path for the folder containing the data
     defaultTemplate - numpy array with template coefficients (200 coefficients)
@@ -26,23 +152,24 @@ def processData(directory, defaultTemplate, isVerbose=False, GUI=False,
     continuing - flag for if continuing from a previous calculation, ignored if GUI=False
     filterMethod - filter calculation method. Must have same input structure as functions
                    in makeFilter.py
+    nProcesses - number of worker processes. None uses every cpu, 1 runs in this process
+                 Use 1 when called from a multithreaded program like optimalFilterGUI, which
+                 already runs one dataset per thread
     """
     # start time
     startTime = time.time()
-    # make default Filter (renormalize and flip)
-    defaultFilter = -defaultTemplate[0:50] / np.dot(defaultTemplate[0:50],
-                                                    defaultTemplate[0:50])
-    defaultFilter = defaultFilter[::-1]
 
     # parse filterMethod name
     filterName = str(filterMethod).split(' ')[1]
+    resultsFile = os.path.join(directory, filterName + '_results.npy')
 
     # set flag for log file output when unexpected files in the directory
     logFileFlag = 0
 
     # check before deleting files
     continuingFlag = 0
-    if os.path.isfile(os.path.join(directory, "log_file.txt")) and not GUI:
+    if (os.path.isfile(os.path.join(directory, "log_file.txt")) or
+            os.path.isfile(resultsFile)) and not GUI:
         answer = query_yes_no("Are you continuing a stopped calculation?")
         if answer is True:
             continuingFlag = 1
@@ -53,26 +180,182 @@ def processData(directory, defaultTemplate, isVerbose=False, GUI=False,
                 return
     if GUI:
         continuingFlag = continuing
+    if continuingFlag and not os.path.isfile(resultsFile):
+        print("No checkpoint file {0} to continue from. Starting over."
+              .format(os.path.basename(resultsFile)))
+        continuingFlag = 0
 
     # delete old log and filter coefficients if exists if told to do so
     if not continuingFlag:
-        if os.path.isfile(os.path.join(directory, "log_file.txt")):
-            os.remove(os.path.join(directory, "log_file.txt"))
-        if os.path.isfile(os.path.join(directory, filterName + '_coefficients.txt')):
-            os.remove(os.path.join(directory, filterName + '_coefficients.txt'))
-        if os.path.isfile(os.path.join(directory, 'template_coefficients.txt')):
-            os.remove(os.path.join(directory, 'template_coefficients.txt'))
-        if os.path.isfile(os.path.join(directory, 'filter_type.txt')):
-            os.remove(os.path.join(directory, 'filter_type.txt'))
-        if os.path.isfile(os.path.join(directory, 'noise_data.txt')):
-            os.remove(os.path.join(directory, 'noise_data.txt'))
-        if os.path.isfile(os.path.join(directory, 'rough_templates.txt')):
-            os.remove(os.path.join(directory, 'rough_templates.txt'))
-        if os.path.isfile(os.path.join(directory, 'file_list.txt')):
-            os.remove(os.path.join(directory, 'file_list.txt'))
-        if os.path.isfile(os.path.join(directory, filterName + '_fourier.txt')):
-            os.remove(os.path.join(directory, filterName + '_fourier.txt'))
+        for fileName in ["log_file.txt", filterName + '_coefficients.txt',
+                         'template_coefficients.txt', 'filter_type.txt',
+                         'noise_data.txt', 'rough_templates.txt', 'file_list.txt',
+                         filterName + '_fourier.txt', filterName + '_results.npy']:
+            if os.path.isfile(os.path.join(directory, fileName)):
+                os.remove(os.path.join(directory, fileName))
 
+    if continuingFlag:
+        # the checkpoint holds the file list that was chosen when the calculation started
+        results = np.lib.format.open_memmap(resultsFile, mode='r+')
+        fileList = [str(fileName) for fileName in results['fileName']]
+    else:
+        fileList, logFileFlag = findFiles(directory)
+
+        # warn about unexpected files
+        if logFileFlag:
+            print("Unexpected files in the current directory. Check the log file to make "
+                  "sure the program removed the right ones!")
+            with open(os.path.join(directory, "log_file.txt"), 'a') as logfile:
+                logfile.write(os.linesep)
+
+        # uncomment these lines for debugging particular files
+        # indicies = range(0,11)
+        # fileList = [fileList[i] for i in indicies]
+
+        results = np.lib.format.open_memmap(
+            resultsFile, mode='w+', shape=(len(fileList),),
+            dtype=resultsDtype(nTemplate=len(defaultTemplate)))
+        results['fileName'] = fileList
+        results.flush()
+
+    # save file list
+    with open(os.path.join(directory, 'file_list.txt'), 'wb') as fp:
+        pickle.dump(fileList, fp)
+
+    todo = np.flatnonzero(~results['done'])
+    nDone = len(fileList) - len(todo)
+    if continuingFlag:
+        print('{0} of {1} files already calculated'.format(nDone, len(fileList)))
+
+    # print progress to terminal
+    perc = round(float(nDone) / max(len(fileList), 1) * 100, 1)
+    if isVerbose and not GUI:
+        sys.stdout.write("Percent of filters created: %.1f%%  " % perc + os.linesep)
+        sys.stdout.flush()
+    if GUI:
+        progress_callback.emit((perc, dataset))
+
+    # hand out the remaining files one resonator at a time
+    tasks = ((index, directory, fileList[index], defaultTemplate, filterMethod)
+             for index in todo)
+    if nProcesses is None:
+        nProcesses = multiprocessing.cpu_count()
+    nProcesses = max(min(int(nProcesses), len(todo)), 1)
+    pool = multiprocessing.Pool(nProcesses) if nProcesses > 1 else None
+    stageTime = np.zeros(len(STAGES))
+    loopStart = time.time()
+    try:
+        resultIterator = (pool.imap_unordered(_processTask, tasks) if pool is not None
+                          else (_processTask(task) for task in tasks))
+        for count, (index, result) in enumerate(resultIterator):
+            # checkpoint the result
+            for key, value in result.items():
+                results[key][index] = value
+            results['done'][index] = True
+            results.flush()
+            stageTime += result['timing']
+
+            # log result
+            with open(os.path.join(directory, "log_file.txt"), 'a') as logfile:
+                if result['loaded']:
+                    message = "{1}: File '{0}' {2} :: Timing info: {3}, {4}, {5}"
+                    logfile.write(message.format(fileList[index], index,
+                                                 TYPE_MESSAGES[result['type']],
+                                                 *np.round(result['timing'], 2)) +
+                                  os.linesep)
+                else:
+                    message = "{1}: File '{0}' data failed to load. Using default " + \
+                        "template and filter " + os.linesep
+                    logfile.write(message.format(fileList[index], index))
+
+            # print progress to terminal
+            nDone += 1
+            perc = round(float(nDone) / len(fileList) * 100, 1)
+            if isVerbose and not GUI:
+                rate = (count + 1) / (time.time() - loopStart)
+                message = ("Percent of filters created: %.1f%% (%.1f files/s, %.0f s " +
+                           "remaining)  " + os.linesep)
+                sys.stdout.write(message % (perc, rate, (len(todo) - count - 1) / rate))
+                sys.stdout.flush()
+            # if GUI is running check to see if program should end and display progress
+            if GUI:
+                progress_callback.emit((perc, dataset))
+                if killRequested(mainDirectory, dataset):
+                    return dataset, float((time.time() - startTime)), False, perc
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    loopTime = time.time() - loopStart
+
+    # write the text files from the checkpoint
+    for field, fileName in [('filter', filterName + '_coefficients.txt'),
+                            ('template', 'template_coefficients.txt'),
+                            ('roughTemplate', 'rough_templates.txt'),
+                            ('noise', 'noise_data.txt'),
+                            ('fourier', filterName + '_fourier.txt')]:
+        np.savetxt(os.path.join(directory, fileName), np.atleast_2d(results[field]))
+    np.savetxt(os.path.join(directory, 'filter_type.txt'), results['type'].astype(float))
+
+    # count number of each type of filter
+    typeArray = np.asarray(results['type'])
+    countdict = dict((filterType, np.sum(typeArray == filterType))
+                     for filterType in TYPE_MESSAGES.keys())
+    nFiles = float(max(len(typeArray), 1))
+    timingMessage = ("{0} files in {1:.1f} minutes with {2} processes. Time per file: " +
+                     ", ".join("{0} {{{1}:.2f}} s".format(stage, i + 3)
+                               for i, stage in enumerate(STAGES)))
+    timingMessage = timingMessage.format(len(todo), loopTime / 60.0, nProcesses,
+                                         *(stageTime / max(len(todo), 1)))
+    # print final results
+    if not GUI:
+        if isVerbose:
+            print(timingMessage)
+        print("{0}% of pixels using optimal filters"
+              .format(round(countdict[3] / nFiles * 100, 2)))
+        print("{0}% of pixels using default template with noise as filter"
+              .format(round(countdict[2] / nFiles * 100, 2)))
+        print("{0}% of pixels using calculated template as filter"
+              .format(round(countdict[1] / nFiles * 100, 2)))
+        print("{0}% of pixels using default template as filter"
+              .format(round(countdict[0] / nFiles * 100, 2)))
+
+    endTime = time.time()
+    # log final results
+    with open(os.path.join(directory, "log_file.txt"), 'a') as logfile:
+        logfile.write(os.linesep + "File list that was itterated over: " + os.linesep)
+        for fileName in fileList:
+            logfile.write(("{0} " + os.linesep).format(fileName))
+        logfile.write(os.linesep + " computation time: {0} minutes"
+                      .format((endTime - startTime) / 60.0))
+        logfile.write(os.linesep + timingMessage)
+        logfile.write((os.linesep + "{0}% of pixels using optimal filters " + os.linesep)
+                      .format(round(countdict[3] / nFiles * 100, 2)))
+        logfile.write(("{0}% of pixels using default template with noise as filter " +
+                       os.linesep)
+                      .format(round(countdict[2] / nFiles * 100, 2)))
+        logfile.write(("{0}% of pixels using calculated template as filter " + os.linesep)
+                      .format(round(countdict[1] / nFiles * 100, 2)))
+        logfile.write(("{0}% of pixels using default template as filter " + os.linesep)
+                      .format(round(countdict[0] / nFiles * 100, 2)))
+
+    # return some stuff if GUI is running
+    if GUI:
+        return dataset, float((endTime - startTime)), True, 100
+
+
+def findFiles(directory):
+    """
+    Find the snap_X_resIDX_DATE-time.npz files in the directory, sorted by channel number
+    and keeping only the most recent file for each channel. Removed files are reported in
+    the log file.
+    INPUTS:
+    directory - path for the folder containing the data
+    OUTPUTS:
+    fileList - list of file names
+    logFileFlag - 1 if any files were removed, 0 otherwise
+    """
+    logFileFlag = 0
     # get .npz files into list
     fileList = []
     for item in os.listdir(directory):
@@ -93,11 +376,10 @@ def processData(directory, defaultTemplate, isVerbose=False, GUI=False,
         else:
             logFileFlag = 1
             badNameInd.append(index)
-            if not continuingFlag:
-                with open(os.path.join(directory, "log_file.txt"), 'a') as logfile:
-                    message = "Removed '{0}' from file list due to incorrect name " +\
-                              "format" + os.linesep
-                    logfile.write(message.format(fileName))
+            with open(os.path.join(directory, "log_file.txt"), 'a') as logfile:
+                message = "Removed '{0}' from file list due to incorrect name " +\
+                          "format" + os.linesep
+                logfile.write(message.format(fileName))
 
     # remove filenames with incorrect formats
     fileList = [element for i, element in enumerate(fileList) if i not in badNameInd]
@@ -124,7 +406,7 @@ def processData(directory, defaultTemplate, isVerbose=False, GUI=False,
         sortedIndices = np.argsort(timeStampList)
 
         # print warning about duplicates to logfile
-        if len(sortedIndices) > 1 and not continuingFlag:
+        if len(sortedIndices) > 1:
             with open(os.path.join(directory, "log_file.txt"), 'a') as logfile:
                 for ind in sortedIndices[:-1]:
                     logFileFlag = 1
@@ -134,291 +416,23 @@ def processData(directory, defaultTemplate, isVerbose=False, GUI=False,
         # append channel number index with the largest timestamp to the good index list
         goodIndicies.append(indexList[sortedIndices[-1]])
 
-    # warn about unexpected files
-    if logFileFlag and not continuingFlag:
-        print("Unexpected files in the current directory. Check the log file to make "
-              "sure the program removed the right ones!")
-        with open(os.path.join(directory, "log_file.txt"), 'a') as logfile:
-            logfile.write(os.linesep)
-
-    # print progress to terminal
-    if isVerbose and not GUI:
-        sys.stdout.write("Percent of filters created: 0.0%  " + os.linesep)
-        sys.stdout.flush()
-    if GUI:
-        progress_callback.emit((0.0, dataset))
-
     # pick filenames removing duplicate channel numbers
     fileList = [fileList[i] for i in goodIndicies]
+    return fileList, logFileFlag
 
-    # uncomment these lines for debugging particular files
-    # indicies = range(0,11)
-    # fileList = [fileList[i] for i in indicies]
-
-    # start at a particular file if continuing calculation
-    if continuingFlag:
-        filters = np.atleast_2d(np.loadtxt(os.path.join(directory, filterName +
-                                                        '_coefficients.txt')))
-        num = filters.shape[0]
-        if num == len(fileList):
-            print('No more files to itterate over')
-            if GUI:
-                return dataset, float(time.time() - startTime), True, 100
-            else:
-                return
-        else:
-            fileListOriginal = fileList
-            fileList = fileList[num:]
-            with open(os.path.join(directory, 'file_list.txt'), 'wb') as fp:
-                pickle.dump(fileListOriginal, fp)
-
-    else:
-        # save file list if not continuing from previous calculation
-        with open(os.path.join(directory, 'file_list.txt'), 'wb') as fp:
-            pickle.dump(fileList, fp)
-
-    # initialize arrays
-    filterArray = np.zeros((1, 50))
-    templateArray = np.zeros((1, 200))
-    roughTemplateArray = np.zeros((1, 200))
-    typeArray = np.zeros(1)
-    noiseArray = np.zeros((1, 101))
-    filterNoiseArray = np.zeros((1, 26))
-
-    # loop through all the phase stream data files in the directories
-    for index, fileName in enumerate(fileList):
-        startLoop = time.time()
-        finishedLoad = startLoop
-        finishedTemp = startLoop
-        finishedFilt = startLoop
-
-        # reinitialize noise flag
-        noiseFlag = 0
 
-        # load data
-        try:
-            errorFlag = 0
-            # load data
-            rawData = np.load(os.path.join(directory, fileName))
-            key = rawData.keys()
-            rawData = rawData[key[0]]
-        except:
-            with open(os.path.join(directory, "log_file.txt"), 'a') as logfile:
-                message = "{1}: File '{0}' data failed to load. Using default " + \
-                    "template and filter " + os.linesep
-                logfile.write(message.format(fileName, index))
-            # use default filter and templates
-            templateArray = defaultTemplate
-            filterArray = defaultFilter
-            # find fourier transform of filter for comparison
-            filterNoiseArray = np.abs(np.fft.rfft(filterArray))**2
-
-            # save data
-            with open(os.path.join(directory, filterName +
-                                   '_coefficients.txt'), 'a') as filters:
-                np.savetxt(filters, np.atleast_2d(filterArray))
-            with open(os.path.join(directory,
-                                   'template_coefficients.txt'), 'a') as templates:
-                np.savetxt(templates, np.atleast_2d(templateArray))
-            with open(os.path.join(directory, 'rough_templates.txt'), 'a') as rough:
-                np.savetxt(rough, np.atleast_2d(roughTemplateArray))
-            with open(os.path.join(directory, 'filter_type.txt'), 'a') as types:
-                np.savetxt(types, np.atleast_1d(typeArray))
-            with open(os.path.join(directory, 'noise_data.txt'), 'a') as noise:
-                np.savetxt(noise, np.atleast_2d(noiseArray))
-            with open(os.path.join(directory, filterName + '_fourier.txt'), 'a') as noise:
-                np.savetxt(noise, np.atleast_2d(filterNoiseArray))
-
-            continue
-        finishedLoad = time.time()
-        # make template
-        try:
-            template, _, noiseDict, templateList, _ = mT.makeTemplate(
-                rawData, nSigmaTrig=5., numOffsCorrIters=2, defaultFilter=defaultFilter)
-            roughTemplateArray = templateList[-1]
-            noiseFlag = 1
-            # check for bad template
-            # (fall times greater than 7 and less than 50, assuming 50 points given)
-            if (np.trapz(template[5:50]) > -5 or np.trapz(template[5:50]) < -31.6
-               or templateList[-1][5] != -1):
-                errorFlag = 1
-                raise ValueError('proccessData: template not correct')
-            # add template coefficients to array
-            templateArray = template
-            templateFlag = 1
-        except:
-            # add template coefficients to array
-            templateArray = defaultTemplate
-            roughTemplateArray = np.zeros(np.shape(defaultTemplate))
-            templateFlag = 0
-        finishedTemp = time.time()
-
-        # make filter
+def killRequested(mainDirectory, dataset):
+    """
+    Check the optimalFilterGUI kill file for the dataset. Retries until the file can be
+    read since the GUI may be writing it.
+    """
+    while True:
         try:
-            if templateFlag:
-                filterCoef = filterMethod(template, noiseDict['spectrum'], nTaps=50)
-            elif noiseFlag:
-                filterCoef = filterMethod(defaultTemplate, noiseDict['spectrum'],
-                                          nTaps=50)
-            else:
-                data = mT.hpFilter(rawData)
-                noiseDict = mNS.makeNoiseSpectrum(data, window=200, filt=defaultFilter)
-                filterCoef = filterMethod(defaultTemplate, noiseDict['spectrum'],
-                                          nTaps=50)
-
-            # add filter coefficients to array
-            filterArray = filterCoef
-            noiseArray = noiseDict['spectrum']
-            # find fourier transform of filter for comparison
-            filterNoiseArray = np.abs(np.fft.rfft(filterArray))**2
-            filterFlag = 1
-        except:
-            # add filter coefficients to array
-            if templateFlag:
-                filterArray = -template[:50] / np.dot(template[:50], template[:50])
-                filterArray = filterArray[::-1]
-            else:
-                filterArray = defaultFilter
-            noiseArray = np.zeros(101)
-            # find fourier transform of filter for comparison
-            filterNoiseArray = np.abs(np.fft.rfft(filterArray))**2
-            filterFlag = 0
-        finishedFilt = time.time()
-
-        # log results and categorize them in the type array
-        with open(os.path.join(directory, "log_file.txt"), 'a') as logfile:
-            if templateFlag == 0 and filterFlag == 0:
-                message = "{1}: File '{0}' template and filter calculation failed. " + \
-                          "Using default template as filter :: Timing info: " + \
-                          "{2}, {3}, {4}" + os.linesep
-                logfile.write(message.format(fileName, index,
-                                             round(finishedLoad - startLoop, 2),
-                                             round(finishedTemp - finishedLoad, 2),
-                                             round(finishedFilt - finishedTemp, 2)))
-                typeArray = 0
-            elif templateFlag == 1 and filterFlag == 0:
-                message = "{1}: File '{0}' filter calculation failed. Using " + \
-                          "calculated template as filter :: Timing info: {2}, {3}, {4}" +\
-                          os.linesep
-                logfile.write(message.format(fileName, index,
-                                             round(finishedLoad - startLoop, 2),
-                                             round(finishedTemp - finishedLoad, 2),
-                                             round(finishedFilt - finishedTemp, 2)))
-                typeArray = 1
-            elif templateFlag == 0 and filterFlag == 1:
-                message = "{1}: File '{0}' template calculation failed. Using " + \
-                          "default template with noise as filter :: Timing info: " + \
-                          "{2}, {3}, {4}" + os.linesep
-                logfile.write(message.format(fileName, index,
-                                             round(finishedLoad - startLoop, 2),
-                                             round(finishedTemp - finishedLoad, 2),
-                                             round(finishedFilt - finishedTemp, 2)))
-                typeArray = 2
-            else:
-                message = "{1}: File '{0}' calculation successful :: Timing info: " + \
-                          "{2}, {3}, {4}" + os.linesep
-                logfile.write(message.format(fileName, index,
-                                             round(finishedLoad - startLoop, 2),
-                                             round(finishedTemp - finishedLoad, 2),
-                                             round(finishedFilt - finishedTemp, 2)))
-                typeArray = 3
-
-        # write new data to file
-        with open(os.path.join(directory, filterName +
-                               '_coefficients.txt'), 'a') as filters:
-            np.savetxt(filters, np.atleast_2d(filterArray))
-        with open(os.path.join(directory, 'template_coefficients.txt'), 'a') as templates:
-            np.savetxt(templates, np.atleast_2d(templateArray))
-        with open(os.path.join(directory, 'rough_templates.txt'), 'a') as rough:
-            np.savetxt(rough, np.atleast_2d(roughTemplateArray))
-        with open(os.path.join(directory, 'filter_type.txt'), 'a') as types:
-            np.savetxt(types, np.atleast_1d(typeArray))
-        with open(os.path.join(directory, 'noise_data.txt'), 'a') as noise:
-            np.savetxt(noise, np.atleast_2d(noiseArray))
-        with open(os.path.join(directory, filterName + '_fourier.txt'), 'a') as noise:
-            np.savetxt(noise, np.atleast_2d(filterNoiseArray))
-
-        # determine full filelist
-        if continuingFlag:
-            index0 = index + len(fileListOriginal) - len(fileList)
-            fileList0 = fileListOriginal
-        else:
-            index0 = index
-            fileList0 = fileList
-
-        # print progress to terminal
-        if isVerbose and not GUI:
-            if index != len(fileList) - 1:
-                if continuingFlag:
-                    index0 = index + len(fileListOriginal) - len(fileList)
-                else:
-                    index0 = index
-                perc = round(float(index0 + 1) / (len(fileList0)) * 100, 1)
-                message = "Percent of filters created: %.1f%%  " + os.linesep
-                sys.stdout.write(message % (perc))
-                sys.stdout.flush()
-            else:
-                print("Percent of filters created: 100%    ")
-        # if GUI is running check to see if program should end and display progress
-        if GUI:
-            perc = round(float(index0 + 1) / (len(fileList0)) * 100, 1)
-            progress_callback.emit((perc, dataset))
-            working = False
-            while not working:
-                try:
-                    killArray = np.loadtxt(os.path.join(mainDirectory, 'kill_processes' +
-                                                        str(dataset) + '.txt'))
-                    if killArray:
-                        return dataset, float((time.time() - startTime)), False, perc
-                    working = True
-                except:
-                    time.sleep(0.5)
-
-    # count number of each type of filter
-    typeArray = np.loadtxt(os.path.join(directory, 'filter_type.txt'))
-    typeArray = np.atleast_1d(typeArray)
-    unique, counts = np.unique(typeArray, return_counts=True)
-    countdict = dict(zip(unique, counts))
-    if 0 not in countdict.keys():
-        countdict[0] = 0
-    if 1 not in countdict.keys():
-        countdict[1] = 0
-    if 2 not in countdict.keys():
-        countdict[2] = 0
-    if 3 not in countdict.keys():
-        countdict[3] = 0
-    # print final results
-    if not GUI:
-        print("{0}% of pixels using optimal filters"
-              .format(round(countdict[3] / float(len(typeArray)) * 100, 2)))
-        print("{0}% of pixels using default template with noise as filter"
-              .format(round(countdict[2] / float(len(typeArray)) * 100, 2)))
-        print("{0}% of pixels using calculated template as filter"
-              .format(round(countdict[1] / float(len(typeArray)) * 100, 2)))
-        print("{0}% of pixels using default template as filter"
-              .format(round(countdict[0] / float(len(typeArray)) * 100, 2)))
-
-    endTime = time.time()
-    # log final results
-    with open(os.path.join(directory, "log_file.txt"), 'a') as logfile:
-        logfile.write(os.linesep + "File list that was itterated over: " + os.linesep)
-        for fileName in fileList0:
-            logfile.write(("{0} " + os.linesep).format(fileName))
-        logfile.write(os.linesep + " computation time: {0} minutes"
-                      .format((endTime - startTime) / 60.0))
-        logfile.write((os.linesep + "{0}% of pixels using optimal filters " + os.linesep)
-                      .format(round(countdict[3] / float(len(typeArray)) * 100, 2)))
-        logfile.write(("{0}% of pixels using default template with noise as filter " +
-                       os.linesep)
-                      .format(round(countdict[2] / float(len(typeArray)) * 100, 2)))
-        logfile.write(("{0}% of pixels using calculated template as filter " + os.linesep)
-                      .format(round(countdict[1] / float(len(typeArray)) * 100, 2)))
-        logfile.write(("{0}% of pixels using default template as filter " + os.linesep)
-                      .format(round(countdict[0] / float(len(typeArray)) * 100, 2)))
-
-    # return some stuff if GUI is running
-    if GUI:
-        return dataset, float((endTime - startTime)), True, 100
+            killArray = np.loadtxt(os.path.join(mainDirectory, 'kill_processes' +
+                                                str(dataset) + '.txt'))
+            return bool(killArray)
+        except Exception:
+            time.sleep(0.5)
 
 
 def recalculate_filters(directory, filterFunction, isVerbose=False, GUI=False,
@@ -495,16 +509,8 @@ def recalculate_filters(directory, filterFunction, isVerbose=False, GUI=False,
         if GUI:
             perc = round(float(index + 1) / (len(templateArray)) * 100, 1)
             progress_callback.emit((perc, dataset))
-            working = False
-            while not working:
-                try:
-                    killArray = np.loadtxt(os.path.join(mainDirectory, 'kill_processes' +
-                                                        str(dataset) + '.txt'))
-                    if killArray:
-                        return dataset, float((time.time() - startTime)), False, perc
-                    working = True
-                except:
-                    time.sleep(0.5)
+            if killRequested(mainDirectory, dataset):
+                return dataset, float((time.time() - startTime)), False, perc
 
     if GUI and (success < (index + 1)):
         perc = round(float(success) / (len(templateArray)) * 100, 2)
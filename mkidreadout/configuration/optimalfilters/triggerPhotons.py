@@ -21,6 +21,35 @@ def calcThreshold(phase,nSigma=2.5,nSamples=5000):
     return threshold
 
         
+def applyDeadtime(peakIndices, deadtime=10):
+    '''
+    Enforce a trigger deadtime: keeps the first trigger and then every trigger that is more than
+    deadtime ticks after the last one kept. Rejected triggers don't extend the deadtime.
+    The chain of kept triggers is found by pointer doubling so there is no loop over the triggers.
+
+    INPUTS:
+    peakIndices - sorted indices of candidate triggers
+    deadtime - trigger deadtime in ticks (us)
+
+    OUTPUTS:
+    indices of the triggers that survive the deadtime
+    '''
+    peakIndices = np.asarray(peakIndices)
+    nPeaks = len(peakIndices)
+    if nPeaks < 2 or deadtime <= 0:
+        return peakIndices
+    # first trigger out of the deadtime of each trigger, nPeaks (a sink) if there is none
+    nextPeak = np.append(np.searchsorted(peakIndices, peakIndices + deadtime, side='right'), nPeaks)
+    kept = np.zeros(nPeaks + 1, dtype=bool)
+    kept[0] = True
+    step = 1
+    while step <= nPeaks:  # after each pass kept holds every trigger less than 2*step jumps from the first
+        kept[nextPeak[kept]] = True
+        nextPeak = nextPeak[nextPeak]
+        step *= 2
+    return peakIndices[kept[:-1]]
+
+
 def sigmaTrigger(data,nSigmaTrig=7.,deadtime=10):
     '''
     Find photon pulses using a sigma trigger
@@ -34,72 +63,143 @@ def sigmaTrigger(data,nSigmaTrig=7.,deadtime=10):
         peakIndices - indices of detected pulses in phase stream
         peakHeights - heights of detected pulses (in same units as input data)
     '''
-    data = np.array(data)
+    data = np.asarray(data)
     med = np.median(data)
-    trigMask = data > (med + np.std(data)*nSigmaTrig)
-    if np.sum(trigMask) > 0:
-        peakIndices = np.where(trigMask)[0]
-
-        i = 0
-        p = peakIndices[i]
-        while p < peakIndices[-1]:
-            peakIndices = peakIndices[np.logical_or(peakIndices-p > deadtime , peakIndices-p <= 0)]#apply deadtime
-            i+=1
-            if i < len(peakIndices):
-                p = peakIndices[i]
-            else:
-                p = peakIndices[-1]
-    else:
+    peakIndices = applyDeadtime(np.flatnonzero(data > (med + np.std(data)*nSigmaTrig)), deadtime)
+    if len(peakIndices) == 0:
         return {'peakIndices':np.array([]),'peakHeights':np.array([])}
-        
-        
     peakHeights = data[peakIndices] 
     return {'peakIndices':peakIndices,'peakHeights':peakHeights}
 
+
+class TriggerEngine(object):
+    '''
+    Derivative and threshold trigger on negative going pulses, matching the firmware trigger:
+        -at least nNegDerivChecks-negDerivLenience of the nNegDerivChecks slopes leading up to a
+            sample are negative (<= 0)
+        -the nPosDerivChecks slopes after it are positive
+        -the sample is below threshold
+        -followed by a deadtime
+
+    The derivative signs of the stream are computed once and kept as a cumulative sum, so the
+    number of negative slopes in any window is a single subtraction. The derivative conditions only
+    depend on (nNegDerivChecks, negDerivLenience, nPosDerivChecks) and are cached, so evaluating a grid
+    of thresholds reuses them and only compares the few candidate samples against each threshold.
+    '''
+    def __init__(self, data, bNegativePulses=True):
+        '''
+        INPUTS:
+        data - phase timestream (filtered or raw)
+        bNegativePulses - pulses are negative going, otherwise the data is flipped
+        '''
+        self.data = np.asarray(data, dtype=float) if bNegativePulses else -np.asarray(data, dtype=float)
+        self.bNegativePulses = bNegativePulses
+        negDeriv = np.diff(self.data) <= 0
+        self._negDerivCumsum = np.concatenate(([0], np.cumsum(negDeriv, dtype=np.int32)))
+        self._candidates = {}
+        self._median = None
+        self._std = None
+
+    @property
+    def median(self):
+        if self._median is None:
+            self._median = np.median(self.data)
+        return self._median
+
+    @property
+    def std(self):
+        if self._std is None:
+            self._std = np.std(self.data)
+        return self._std
+
+    def sigmaThreshold(self, nSigmaThreshold):
+        ''' threshold nSigmaThreshold standard deviations below the median '''
+        return self.median - nSigmaThreshold*self.std
+
+    def derivCandidates(self, nNegDerivChecks=10, negDerivLenience=1, nPosDerivChecks=2):
+        ''' Sorted indices of the samples that meet the derivative conditions '''
+        key = (nNegDerivChecks, negDerivLenience, nPosDerivChecks)
+        if key not in self._candidates:
+            c = self._negDerivCumsum
+            stop = len(self.data) - nPosDerivChecks  # need nPosDerivChecks slopes after the sample
+            if stop <= nNegDerivChecks:
+                self._candidates[key] = np.array([], dtype=int)
+                return self._candidates[key]
+            idx = slice(nNegDerivChecks, stop)
+            nNeg = c[idx] - c[:stop - nNegDerivChecks]  # negative slopes before each sample
+            nNegAfter = c[nNegDerivChecks + nPosDerivChecks:stop + nPosDerivChecks] - c[idx]
+            cond = (nNeg >= nNegDerivChecks - negDerivLenience) & (nNegAfter == 0)
+            self._candidates[key] = np.flatnonzero(cond) + nNegDerivChecks
+        return self._candidates[key]
+
+    def trigger(self, threshold=None, nSigmaThreshold=3., nNegDerivChecks=10, negDerivLenience=1,
+                nPosDerivChecks=2, deadtime=10):
+        '''
+        Indices of the triggered pulses
+
+        INPUTS:
+        threshold - trigger threshold in the units of data (for negative going pulses). Defaults to
+            nSigmaThreshold below the median
+        deadtime - trigger deadtime in ticks (us)
+        '''
+        if threshold is None:
+            threshold = self.sigmaThreshold(nSigmaThreshold)
+        candidates = self.derivCandidates(nNegDerivChecks, negDerivLenience, nPosDerivChecks)
+        return applyDeadtime(candidates[self.data[candidates] < threshold], deadtime)
+
+    def peakDict(self, peakIndices):
+        ''' detectPulses style output for peakIndices '''
+        if len(peakIndices) == 0:
+            return {'peakIndices':np.array([]),'peakHeights':np.array([])}
+        peakHeights = self.data[peakIndices] if self.bNegativePulses else -self.data[peakIndices]
+        return {'peakIndices':peakIndices,'peakHeights':peakHeights}
+
+    def grid(self, sigmaThreshList=(3.,), nNegDerivChecksList=(10,), negDerivLenienceList=(1,),
+             nPosDerivChecks=2, deadtime=10):
+        '''
+        Triggers for every combination of the parameter lists, in nested loop order
+        (sigma threshold outermost). Yields ((sigmaThresh, nNegDerivChecks, negDerivLenience), peakIndices)
+        '''
+        for sigmaThresh in sigmaThreshList:
+            threshold = self.sigmaThreshold(sigmaThresh)
+            for nNegDerivChecks in nNegDerivChecksList:
+                for negDerivLenience in negDerivLenienceList:
+                    peakIndices = self.trigger(threshold, nNegDerivChecks=nNegDerivChecks,
+                                               negDerivLenience=negDerivLenience,
+                                               nPosDerivChecks=nPosDerivChecks, deadtime=deadtime)
+                    yield (sigmaThresh, nNegDerivChecks, negDerivLenience), peakIndices
+
+
 def detectPulses(data,threshold=None,nSigmaThreshold=3.,deadtime=10,nNegDerivChecks=10,negDerivLenience=1,bNegativePulses = True):
     #deadtime in ticks (us)
-    if bNegativePulses:
-        data = np.array(data)
-    else:
-        data = -np.array(data) #flip to negative pulses
-
-    if threshold is None:
-        threshold = np.median(data)-nSigmaThreshold*np.std(data)
-    derivative = np.diff(data)
-    peakHeights = []
-    t = 0
-    negDeriv = derivative <= 0
-    posDeriv = np.logical_not(negDeriv)
-   
-    triggerBooleans = data[nNegDerivChecks:-2] < threshold
-
-    negDerivChecksSum = np.zeros(len(negDeriv[0:-nNegDerivChecks-1]))
-    for i in range(nNegDerivChecks):
-        negDerivChecksSum += negDeriv[i:i-nNegDerivChecks-1]
-    peakCondition0 = negDerivChecksSum >= nNegDerivChecks-negDerivLenience
-    peakCondition1 = np.logical_and(posDeriv[nNegDerivChecks:-1],posDeriv[nNegDerivChecks+1:])
-    peakCondition01 = np.logical_and(peakCondition0,peakCondition1)
-    peakBooleans = np.logical_and(triggerBooleans,peakCondition01)
-        
-    try:
-        peakIndices = np.where(peakBooleans)[0]+nNegDerivChecks
-        i = 0
-        p = peakIndices[i]
-        while p < peakIndices[-1]:
-            peakIndices = peakIndices[np.logical_or(peakIndices-p > deadtime , peakIndices-p <= 0)]#apply deadtime
-            i+=1
-            if i < len(peakIndices):
-                p = peakIndices[i]
-            else:
-                p = peakIndices[-1]
-    except IndexError:
-        return {'peakIndices':np.array([]),'peakHeights':np.array([])}
-        
-    if bNegativePulses:
-        peakHeights = data[peakIndices]
-    else:
-        peakHeights = -data[peakIndices] #flip back to positive sign
-    return {'peakIndices':peakIndices,'peakHeights':peakHeights}
+    engine = TriggerEngine(data, bNegativePulses=bNegativePulses)
+    peakIndices = engine.trigger(threshold, nSigmaThreshold=nSigmaThreshold, nNegDerivChecks=nNegDerivChecks,
+                                 negDerivLenience=negDerivLenience, deadtime=deadtime)
+    return engine.peakDict(peakIndices)
+
+def anyPulses(data, nSigmaThreshold=3., nNegDerivChecks=10, negDerivLenience=1, nPosDerivChecks=2):
+    '''
+    Checks every row of data for a detectPulses trigger (negative pulses, threshold from the row's own
+    median and std) in one vectorized pass, for screening many noise windows at once
+
+    INPUTS:
+    data - [nWindows, nSamples] array of phase windows
+
+    OUTPUTS:
+    boolean array, True for the windows that would trigger
+    '''
+    data = np.atleast_2d(data)
+    nSamples = data.shape[-1]
+    stop = nSamples - nPosDerivChecks
+    if stop <= nNegDerivChecks:
+        return np.zeros(len(data), dtype=bool)
+    threshold = np.median(data, axis=-1)[:, np.newaxis] - nSigmaThreshold*np.std(data, axis=-1)[:, np.newaxis]
+    c = np.zeros(data.shape, dtype=np.int32)
+    np.cumsum(np.diff(data, axis=-1) <= 0, axis=-1, out=c[:, 1:])
+    nNeg = c[:, nNegDerivChecks:stop] - c[:, :stop - nNegDerivChecks]
+    nNegAfter = c[:, nNegDerivChecks + nPosDerivChecks:stop + nPosDerivChecks] - c[:, nNegDerivChecks:stop]
+    trigger = (nNeg >= nNegDerivChecks - negDerivLenience) & (nNegAfter == 0) & (data[:, nNegDerivChecks:stop] < threshold)
+    return trigger.any(axis=-1)
 
 def optimizeTrigCond(data, nPeaks, sigmaThreshList=[3.], nNegDerivChecksList=[10], negDerivLenienceList=[1], bNegativePulses=True):
     minSigma = 1000
@@ -107,18 +207,19 @@ def optimizeTrigCond(data, nPeaks, sigmaThreshList=[3.], nNegDerivChecksList=[10
     optNNegDerivChecks = 0
     optNegDerivLenience = 0
     optPeakDict = {'peakIndices':np.array([]), 'peakHeights':np.array([])} 
-    for sigmaThresh in sigmaThreshList:
-        for nNegDerivChecks in nNegDerivChecksList:
-            for negDerivLenience in negDerivLenienceList:
-                peakDict = detectPulses(data, nSigmaThreshold=sigmaThresh, nNegDerivChecks=nNegDerivChecks, negDerivLenience=negDerivLenience, bNegativePulses=bNegativePulses)
-                if(len(peakDict['peakIndices'])>=nPeaks):
-                    sigma = np.std(peakDict['peakHeights'])
-                    if(sigma<minSigma):
-                        minSigma = sigma
-                        optSigmaThresh = sigmaThresh
-                        optNNegDerivChecks = nNegDerivChecks
-                        optNegDerivLenience = negDerivLenience
-                        optPeakDict = peakDict
+    engine = TriggerEngine(data, bNegativePulses=bNegativePulses)
+    for (sigmaThresh, nNegDerivChecks, negDerivLenience), peakIndices in engine.grid(sigmaThreshList,
+                                                                                       nNegDerivChecksList,
+                                                                                       negDerivLenienceList):
+        if(len(peakIndices)>=nPeaks):
+            peakDict = engine.peakDict(peakIndices)
+            sigma = np.std(peakDict['peakHeights'])
+            if(sigma<minSigma):
+                minSigma = sigma
+                optSigmaThresh = sigmaThresh
+                optNNegDerivChecks = nNegDerivChecks
+                optNegDerivLenience = negDerivLenience
+                optPeakDict = peakDict
 
     return optSigmaThresh, optNNegDerivChecks, optNegDerivLenience, minSigma, optPeakDict
 
@@ -167,3 +268,65 @@ def findSigmaThresh(data, initSigmaThresh=2., tailSlack=0., isPlot=False):
     sigmaThresh = (threshold-np.median(data))/np.std(data)
     return threshold, sigmaThresh
 
+
+def benchmark(data, sigmaThreshList=(2., 2.5, 3., 3.5, 4., 5.), nNegDerivChecksList=(5, 8, 10, 12, 15),
+              negDerivLenienceList=(0, 1, 2), nRepeats=3):
+    '''
+    Times the trigger on a phase stream: a single detectPulses call, the parameter grid evaluated with one
+    call per combination, and the same grid through a shared TriggerEngine (what optimizeTrigCond uses)
+
+    INPUTS:
+    data - phase timestream, ideally a long recorded one
+    nRepeats - best of this many runs is reported
+
+    OUTPUTS:
+    dictionary of the best times in seconds
+    '''
+    import time
+
+    def best(func):
+        times = []
+        for i in range(nRepeats):
+            tic = time.time()
+            func()
+            times.append(time.time() - tic)
+        return min(times)
+
+    def bruteGrid():
+        for sigmaThresh in sigmaThreshList:
+            for nNegDerivChecks in nNegDerivChecksList:
+                for negDerivLenience in negDerivLenienceList:
+                    detectPulses(data, nSigmaThreshold=sigmaThresh, nNegDerivChecks=nNegDerivChecks,
+                                 negDerivLenience=negDerivLenience)
+
+    def sharedGrid():
+        for params, peakIndices in TriggerEngine(data).grid(sigmaThreshList, nNegDerivChecksList,
+                                                            negDerivLenienceList):
+            pass
+
+    nCombos = len(sigmaThreshList)*len(nNegDerivChecksList)*len(negDerivLenienceList)
+    times = {'detectPulses': best(lambda: detectPulses(data)), 'bruteGrid': best(bruteGrid),
+             'sharedGrid': best(sharedGrid)}
+    print('{} samples, {} pulses at the default trigger'.format(len(data), len(detectPulses(data)['peakIndices'])))
+    print('detectPulses: {:.3f} s'.format(times['detectPulses']))
+    print('{} combination grid, one detectPulses per combination: {:.3f} s'.format(nCombos, times['bruteGrid']))
+    print('{} combination grid, shared TriggerEngine: {:.3f} s ({:.1f}x)'.format(
+        nCombos, times['sharedGrid'], times['bruteGrid']/times['sharedGrid']))
+    return times
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) > 1:
+        # recorded phase stream, .npz files are the ones processData reads
+        phase = np.load(sys.argv[1])
+        if hasattr(phase, 'keys'):
+            phase = phase[list(phase.keys())[0]]
+    else:
+        print('usage: python triggerPhotons.py phasestream.npz, using a simulated stream')
+        rng = np.random.RandomState(0)
+        phase = rng.normal(0, .05, 2*10**6)
+        pulse = -np.exp(-np.arange(200)/20.)*(1 - np.exp(-np.arange(200)/2.))
+        for start in rng.randint(0, len(phase) - 200, 4000):
+            phase[start:start + 200] += pulse*rng.uniform(.5, 1.5)
+    benchmark(np.asarray(phase, dtype=float).ravel())
@@ -405,8 +405,12 @@ class StartQt4(QMainWindow):
     def savevalues(self):
         self.freqList[self.resnum] = self.resfreq
         self.attenList[self.resnum] = self.atten
-        self.metadata_out.set(self.resID, atten=self.atten, freq=self.resfreq,
-                              reviewed=True, save=True)
+        self.metadata_out.set(self.resID, atten=self.atten, freq=self.resfreq, reviewed=True)
+        # only this resonator is written, on top of whatever other tools have saved to the file since
+        outFile = self.metadata_out.file
+        with sweepdata.SweepMetadata.updating(outFile, source='' if os.path.exists(outFile) else
+                                              self.metadata.file) as sd:
+            sd.set(self.resID, atten=self.atten, freq=self.resfreq, reviewed=True)
 
         msg = " ....... Saved to file:  resnum={} resID={} resfreq={} atten={}"
         getLogger(__name__).info(msg.format(self.resnum, self.resID, self.resfreq, self.atten))
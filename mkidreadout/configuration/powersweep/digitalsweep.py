@@ -8,6 +8,8 @@ It takes a list of board numbers, a templarconfig.cfg file, and a file prefix fo
 Usage:
 From command line
 $ python digitalsweep.py 220 221 -c /home/data/MEC/20180530/templarconf.cfg -o /home/data/MEC/20180530/HypatiaFL7b
+Add -t to write the widesweeps as text instead of binary .npy files (see widesweep/wsformat.py)
+Add -r to resume an interrupted sweep, skipping roaches that already have a widesweep file
 
 From python
 >>> digWS = DigitalWideSweep([220,221], 'hightemplar.cfg', '/home/data/MEC/20180330/example')
@@ -19,6 +21,7 @@ Note: Power in dBm is approximately -(resAtten + 12). (so a res atten of 65 will
 
 
 import ConfigParser
+import os
 import sys
 import traceback
 import warnings
@@ -28,11 +31,12 @@ import numpy as np
 from PyQt4 import QtCore
 
 from mkidreadout.channelizer.RoachStateMachine import RoachStateMachine
+from mkidreadout.configuration.widesweep import freqlists, stitch, wsformat
 
 
 class DigitalWideSweep(QtCore.QObject):
 
-    def __init__(self, roachNums=None, defaultValues=None, outputPath=None,debug=False):
+    def __init__(self, roachNums=None, defaultValues=None, outputPath=None,debug=False, textOutput=False):
         '''
         Initialize DigitalWideSweep object
         
@@ -46,11 +50,14 @@ class DigitalWideSweep(QtCore.QObject):
                          If there is no '/' in outputPath then it's assumed to be just a file prefix
                          If outputPath ends in '/' then it's assumed to be just a file path
             debug - If True, initialize the roach to sweep state. 
+            textOutput - If True, write widesweeps as text files instead of binary .npy files (see wsformat)
         '''
         super(QtCore.QObject, self).__init__()
         #if roachNums is None or len(roachNums) ==0:
         #    roachNums = range(10)
         self.debug=debug
+        self.textOutput=textOutput
+        self.stitcher=None      # stitches the widesweeps of the roaches as they finish
         self.roachNums = np.unique(roachNums)       # sorts and removes duplicates
         self.numRoaches = len(self.roachNums)       # (int) number of roaches connected
         self.config = ConfigParser.ConfigParser()
@@ -146,51 +153,80 @@ class DigitalWideSweep(QtCore.QObject):
             try:
                 calData = self.calibrateWSdata(roachNum, commandData)
                 self.writeWSdata(roachNum, calData)
+                self.stitchWSdata(roachNum, calData)
             except IndexError:
                 pass
             self.quitQApp()
 
 
     def calibrateWSdata(self, roachNum, data):
+        """
+        Scale each tone's sweep so its magnitude matches the previous (lower frequency) tone where their sweeps
+        overlap
+
+        The correction for tone ch+1 relative to tone ch is the median ratio of their magnitudes over the overlap
+        region. These are computed for all adjacent pairs at once and chained with a cumulative product.
+
+        INPUTS:
+            roachNum - the roach number
+            data - dictionary from the sweep with 'I', 'Q' [nTones, nSteps], 'freqList' and 'freqOffsets'
+        OUTPUTS:
+            calData - copy of data with I and Q scaled. Raises an IndexError if some tone doesn't overlap the next
+        """
         overlap_tolerance=1. # say that any tone less than 1Hz away is the same frequency
 
-        I=data['I']
-        Q=data['Q']
+        I=np.asarray(data['I'])
+        Q=np.asarray(data['Q'])
         A = (I**2. + Q**2.)**0.5
-        #toneCorrections=[]
-        corr=1.
-        for ch in range(len(A)-1):
-            tone2_min = data['freqList'][ch+1] + data['freqOffsets'][0]
-            tones1 = data['freqOffsets'] + data['freqList'][ch]
-            overlap_arg=np.where(np.isclose(tones1, [tone2_min]*len(data['freqOffsets']), atol = overlap_tolerance))[0][0]
-            
-            tone_corrs = 1.0*A[ch][overlap_arg:] / A[ch+1][:-1*overlap_arg]
-            #toneCorrections.append(np.median(tone_corrs))
-            corr=np.median(tone_corrs)
-            data['I'][ch+1] = data['I'][ch+1]*corr
-            data['Q'][ch+1] = data['Q'][ch+1]*corr
-            A[ch+1]*=corr
-
-        return data
+        freqList = np.asarray(data['freqList'])
+        freqOffsets = np.asarray(data['freqOffsets'])
+        nSteps = len(freqOffsets)
+
+        # first step of each tone at the start frequency of the next tone
+        tones1 = freqList[:-1, np.newaxis] + freqOffsets
+        tone2_min = freqList[1:, np.newaxis] + freqOffsets[0]
+        isOverlap = np.isclose(tones1, tone2_min, atol=overlap_tolerance)
+        if not isOverlap.any(axis=1).all():
+            raise IndexError('Tone sweeps do not overlap')
+        overlap_arg = np.argmax(isOverlap, axis=1)
+
+        # A[ch][overlap_arg:] / A[ch+1][:-overlap_arg] for every tone, padded with nan
+        steps = np.arange(nSteps)
+        inOverlap = steps < nSteps - overlap_arg[:, np.newaxis]
+        shifted = np.minimum(overlap_arg[:, np.newaxis] + steps, nSteps - 1)
+        tone_corrs = np.where(inOverlap, A[np.arange(len(A) - 1)[:, np.newaxis], shifted] / A[1:], np.nan)
+        corr = np.cumprod(np.append(1., np.nanmedian(tone_corrs, axis=1)))
+
+        calData = dict(data)
+        calData['I'] = I*corr[:, np.newaxis]
+        calData['Q'] = Q*corr[:, np.newaxis]
+        return calData
+
+
+    def wsFileName(self, roachNum, filePrefix=None):
+        """
+        The widesweep file for roachNum. filePrefix is prepended to the name (ie. 'raw_')
+        """
+        ext = wsformat.TEXT_EXT if self.textOutput else wsformat.BINARY_EXT
+        if filePrefix is None: filePrefix=''
+        return self.outPath+'/'+filePrefix+self.outPrefix+'digWS_r'+str(roachNum)+ext
 
 
     def writeWSdata(self, roachNum, data, filePrefix=None):
+        """
+        Save the sweep of roachNum as a widesweep file (binary unless self.textOutput, see wsformat)
+
+        OUTPUTS:
+            widesweepFN - the file written
+        """
         roachArg = np.where(np.asarray(self.roachNums) == roachNum)[0][0]
         #freqFN = self.roaches[roachArg].config.get('Roach '+str(roachNum),'freqfile')
         #path=freqFN.rsplit('/',1)[0]
-        widesweepFN = self.outPath+'/'+self.outPrefix+'digWS_r'+str(roachNum)+'.txt'
-        if filePrefix is not None:
-            widesweepFN = self.outPath+'/'+filePrefix+self.outPrefix+'digWS_r'+str(roachNum)+'.txt'
-        
+        widesweepFN = self.wsFileName(roachNum, filePrefix)
 
-        I=data['I'].flatten()
-        Q=data['Q'].flatten()
-        freqs = np.tile(data['freqOffsets'], len(data['freqList'])) + np.repeat(data['freqList'], len(data['freqOffsets']))
-        args = np.argsort(freqs)
-        args=np.sort(args)  # actually, don't sort them for now
-        
-        outData = np.asarray([ freqs[args]/1.E9, I[args], Q[args]]).T
-        #print outData.shape
+        I=np.ravel(data['I'])
+        Q=np.ravel(data['Q'])
+        freqs = (np.asarray(data['freqList'])[:, np.newaxis] + data['freqOffsets']).ravel()    # tone by tone, not sorted
 
         header='Widesweep with Digital Readout:\n'+\
                'Roach#: '+str(roachNum)+'\n'+\
@@ -201,11 +237,53 @@ class DigitalWideSweep(QtCore.QObject):
                'Res atten: '+str(self.roaches[roachArg].roachController.attenList[0])+'\n'+\
                'DAC atten: '+str(self.roaches[roachArg].config.getfloat('Roach '+str(roachNum),'dacatten_start'))+'\n'+\
                'ADC atten: '+str(self.roaches[roachArg].config.getfloat('Roach '+str(roachNum),'adcatten'))
-        np.savetxt(widesweepFN, outData, fmt="%.9f %.9f %.9f",header=header)
+        wsformat.saveWideSweep(widesweepFN, freqs/1.E9, I, Q, header=header, text=self.textOutput)
+        return widesweepFN
         
 
+    def stitchWSdata(self, roachNum, data):
+        """
+        Add the calibrated sweep of roachNum to the stitched widesweep of every roach that's finished so far, so the
+        feedline (or array) is one file as soon as the last roach is done (see stitch.WideSweepStitcher)
+
+        OUTPUTS:
+            stitchedFN - the stitched widesweep file
+        """
+        freqs = np.asarray(data['freqList'])[:, np.newaxis] + data['freqOffsets']
+        self.getStitcher().add(roachNum, freqs/1.E9, data['I'], data['Q'])
+        self.stitcher.stitch()
+        return self.stitcher.fileName
+
+
+    def addSweptWSfile(self, roachNum):
+        """
+        Add the calibrated widesweep file that roachNum wrote in an earlier run to the stitcher (ie. when resuming),
+        so the stitched widesweep includes the roaches that aren't swept again. The tones are split where the
+        frequency decreases (see stitch.segmentLengths)
+
+        OUTPUTS:
+            True if the file was found and added
+        """
+        widesweepFN = self.wsFileName(roachNum)
+        if not os.path.isfile(widesweepFN):
+            print 'Roach '+str(roachNum)+' has no calibrated widesweep to stitch: '+widesweepFN
+            return False
+        data = wsformat.loadWideSweep(widesweepFN, mmap=False)
+        self.getStitcher().add(roachNum, data[:, 0], data[:, 1], data[:, 2], segLens=stitch.segmentLengths(data[:, 0]))
+        return True
+
+
+    def getStitcher(self):
+        """ The stitcher of this session's widesweeps, created on first use """
+        if self.stitcher is None:
+            ext = wsformat.TEXT_EXT if self.textOutput else wsformat.BINARY_EXT
+            self.stitcher = stitch.WideSweepStitcher(self.outPath+'/'+self.outPrefix+'digWS_stitched'+ext,
+                                                     text=self.textOutput)
+        return self.stitcher
+
+
     def startWS(self, roachNums=None, startFreqs=None, endFreqs=None, lo_step=None, DACatten=None, ADCatten=None,
-                makeNewFreqs=True, **kwargs):
+                makeNewFreqs=True, resume=False, **kwargs):
         """
         This function starts a widesweep on the roaches specified
         
@@ -217,6 +295,9 @@ class DigitalWideSweep(QtCore.QObject):
             DACatten - 
             ADCatten - 
             makeNewFreqs - If true, then generate a new random freq file
+            resume - If true, skip the roaches that already have a widesweep file (ie. from a sweep that was interrupted)
+                     Each roach's sweep is written as soon as it finishes. The skipped roaches' calibrated
+                     widesweeps are stitched with the new ones
             **kwargs - additional keywords for makeRandomFreqList() and atten from saveFreqList()
         """
         if not roachNums:
@@ -226,11 +307,15 @@ class DigitalWideSweep(QtCore.QObject):
 
         self.numDoneSweeping=0
         threadsToStart=[]
+        nResumed=0
         for i, roach_i in enumerate(roachNums):
             roachArg = np.where(np.asarray(self.roachNums) == roach_i)[0][0]
             DAC_freqResolution = self.roaches[roachArg].roachController.params['dacSampleRate']/(self.roaches[roachArg].roachController.params['nDacSamplesPerCycle']*self.roaches[roachArg].roachController.params['nLutRowsToUse'])
             if self.roachThreads[roachArg].isRunning():
                 print 'Roach '+str(roach_i)+' is busy'
+            elif resume and os.path.isfile(self.wsFileName(roach_i, 'raw_')):
+                print 'Roach '+str(roach_i)+' already swept: '+self.wsFileName(roach_i, 'raw_')
+                if self.addSweptWSfile(roach_i): nResumed+=1
             else: 
                 freqFN = self.roaches[roachArg].config.get('Roach '+str(roach_i),'freqfile')
                 LO = self.roaches[roachArg].config.getfloat('Roach '+str(roach_i),'lo_freq')
@@ -279,6 +364,8 @@ class DigitalWideSweep(QtCore.QObject):
                 self.roaches[roachArg].addCommands(RoachStateMachine.SWEEP)        # add command to roach queue
                 threadsToStart.append(self.roachThreads[roachArg])
 
+        if nResumed>0:
+            self.stitcher.stitch()  # in case none of the roaches are swept again
         for t in threadsToStart:
             t.start()
             self.execQApp+=1
@@ -293,36 +380,9 @@ class DigitalWideSweep(QtCore.QObject):
         data = np.asarray([resIDs, freqs, attens]).T
         np.savetxt(outfilename, data, fmt="%4i %10.1f %4i")
     
-    def makeRandomFreqSideband(self, startFreq, endFreq, nChannels, toneBandwidth, freqResolution):
-        if nChannels <1:
-            return np.asarray([],dtype=np.int)
-        #if nChannels==1:
-        #    return np.asarray([startFreq])
-        avgSpacing = (endFreq - startFreq)/nChannels
-        freqs = np.linspace(startFreq, endFreq, nChannels, False)+avgSpacing/2.
-        freqs+= np.random.rand(len(freqs)) * avgSpacing - avgSpacing/2.
-        
-        #Correct doubles
-        for arg in range(len(freqs)-1):
-            if (freqs[arg+1] - freqs[arg]) <toneBandwidth:
-                if arg==0: f_low =startFreq - toneBandwidth + freqResolution
-                else: f_low = freqs[arg -1]
-                if arg>=(len(freqs)-2): f_high = endFreq + toneBandwidth - freqResolution
-                else: f_high = freqs[arg+2]
-                
-                f_spacing = (f_high - f_low) / 3.0
-                if f_spacing>=toneBandwidth:       #push the two tones between f_high and f_low
-                    freqs[arg]=f_low+f_spacing
-                    freqs[arg+1]=f_low+2.0*f_spacing
-                elif (f_high - f_low) /2.0 >= toneBandwidth:   #push one tone halfway between f_high and f_low
-                    freqs[arg]=(f_high - f_low)/2.0
-                    freqs[arg+1] = freqs[arg]
-                else:                                       #remove both tones
-                    freqs[arg] = f_low
-                    freqs[arg+1]=f_low
-        freqs=np.unique(freqs)
-        
-        return freqs
+    def makeRandomFreqSideband(self, startFreq, endFreq, nChannels, toneBandwidth, freqResolution=None):
+        """ See freqlists.makeRandomFreqSideband(). freqResolution isn't used any more """
+        return freqlists.makeRandomFreqSideband(startFreq, endFreq, nChannels, toneBandwidth)
     
     def makeRandomFreqList(self, startFreq, endFreq, toneBandwidth=512.0E3, minNominalFreqSpacing=800.0E3):
         """
@@ -334,6 +394,11 @@ class DigitalWideSweep(QtCore.QObject):
             toneBandwidth - minimum distance between freqs to avoid bandwidth overlap
             nominalFreqSpacing - nominal avg distance between freqs. May be forced to go larger to cover freq range
                                  Needs to be at least toneBandwidth+100.*freqResolution
+        
+        OUTPUTS:
+            freqList - the tones. A sideband too narrow for its share of the channels at toneBandwidth spacing
+                       gets fewer tones (see freqlists.makeRandomFreqSideband()), so there can be fewer than nChannels
+            LO, maxSpan - LO frequency and the span each tone has to sweep
         """
         #todo create a frequencylist object
         #todo move into frequencylist object
@@ -390,6 +455,10 @@ if __name__ == "__main__":
         filePrefix=args[indx+1]
         try: args = args[:indx]+args[indx+2:]
         except IndexError:args = args[:indx]
+    textOutput = '-t' in args     # write text widesweep files instead of binary
+    if textOutput: args.remove('-t')
+    resume = '-r' in args         # skip roaches that were already swept
+    if resume: args.remove('-r')
     roachNums = np.asarray(args, dtype=np.int)
     print defaultValues,roachNums, filePrefix
     
@@ -406,8 +475,8 @@ if __name__ == "__main__":
 
     #startFreqs = [5.5E9]
     #stopFreqs=[7.5E9]
-    digWS = DigitalWideSweep(roachNums, defaultValues,filePrefix,debug=debug)
-    digWS.startWS(roachNums=None, startFreqs=startFreqs, endFreqs=stopFreqs,DACatten=None, ADCatten=None,resAtten=65,makeNewFreqs=False)
+    digWS = DigitalWideSweep(roachNums, defaultValues,filePrefix,debug=debug,textOutput=textOutput)
+    digWS.startWS(roachNums=None, startFreqs=startFreqs, endFreqs=stopFreqs,DACatten=None, ADCatten=None,resAtten=65,makeNewFreqs=False,resume=resume)
 
 
 
@@ -13,12 +13,11 @@ Author: Neelay Fruitwala
 
 """
 
-#TODO modernize to use Roach2Controls instead of functionality from adcSnapCheck imported as adcSnap
-from __future__ import print_function
 # TODO modernize to use Roach2Controls instead of functionality from adcSnapCheck imported as adcSnap
 from __future__ import print_function
 
 import ConfigParser
+import multiprocessing
 import os
 import sys
 import threading
@@ -30,22 +29,64 @@ import numpy as np
 import scipy.optimize as spo
 
 from mkidreadout.channelizer.Roach2Controls import Roach2Controls
-# TODO modernize to use Roach2Controls instead of functionality from adcSnapCheck imported as adcSnap
-# TODO modernize to use Roach2Controls instead of functionality from adcSnapCheck imported as adcSnap
-from __future__ import print_function, print_function
 
-import ConfigParser
-import os
-import sys
-import threading
-import time
 
-import SDR.Projects.FirmwareTests.darkDebug.adcSnapCheck as adcSnap
-import matplotlib.pyplot as plt
-import numpy as np
-import scipy.optimize as spo
+def fitLogQuadratic(rows, cols, sbSups, gridShape):
+    """
+    Closed form fit of a circular gaussian peak, sbSup = scale*exp(-((row-row0)**2+(col-col0)**2)/width**2),
+    to the sampled SB suppressions of every tone at once. In log space it is the linear model
+        log(sbSup) = a + b*row + c*col + d*(row**2 + col**2)
+    which is solved for all tones with batched least squares on the normal equations.
+
+    INPUTS:
+        rows, cols: [nTones, nSamples] phase and I/Q ratio indices of the sampled points
+        sbSups: [nTones, nSamples] SB suppressions (dB) at the sampled points
+        gridShape: (nPhases, nIQRatios) shape of the search space
+    OUTPUTS:
+        centers: [nTones, 2] fitted (row, col) location of the peak
+        good: [nTones] boolean. False where the fit isn't a peak inside the search space
+    """
+    scale = np.array(gridShape, dtype=float) - 1
+    scale[scale == 0] = 1
+    r = rows/scale[0]  # unit scaled coordinates keep the normal equations well conditioned
+    c = cols/scale[1]
+    valid = sbSups > 0  # log is only defined for positive suppression
+    logSup = np.log(np.where(valid, sbSups, 1.))
+
+    A = np.stack((np.ones_like(r), r, c, r**2 + c**2), axis=-1)*valid[..., np.newaxis]
+    AtA = np.einsum('tni,tnj->tij', A, A) + 1.e-9*np.eye(4)
+    Aty = np.einsum('tni,tn->ti', A, logSup*valid)
+    coeffs = np.linalg.solve(AtA, Aty[..., np.newaxis])[..., 0]
+
+    d = coeffs[:, 3]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        centers = np.column_stack((-coeffs[:, 1]/(2*d)*scale[0], -coeffs[:, 2]/(2*d)*scale[1]))
+    good = (d < 0) & (np.sum(valid, axis=1) >= 4) & np.all(np.isfinite(centers), axis=1)
+    good &= np.all((centers >= 0) & (centers <= scale), axis=1)
+    return centers, good
+
+
+def fitExpDecay(args):
+    """
+    Fits a 2D exponential decay to the sampled SB suppressions of one tone with curve_fit.
+    Module level so it can be run in a process pool.
 
-from mkidreadout.channelizer.Roach2Controls import Roach2Controls
+    INPUTS:
+        args: (xdata, ydata, gridShape) tuple. xdata is the [2, nSamples] (row, col) sample locations
+    OUTPUTS:
+        fitParams (row0, col0, scale, width), or None if the fit failed
+    """
+    xdata, ydata, gridShape = args
+
+    def expDecay(x, x0r, x0c, scale, width):
+        return scale*np.exp(-np.sqrt((x[0]-x0r)**2+(x[1]-x0c)**2)/width)
+
+    try:
+        fitParams, pcov = spo.curve_fit(expDecay, xdata, ydata, [10, 10, 40, 15],
+                                        bounds=([0, 0, 30, 2], [gridShape[0], gridShape[1], 50, 20]), method='trf')
+        return fitParams
+    except (RuntimeError, ValueError):
+        return None
 
 
 class SBOptimizer:
@@ -173,17 +214,44 @@ class SBOptimizer:
         adcSnap.loadDelayCal(self.roach.fpga,delayLut2)
         adcSnap.loadDelayCal(self.roach.fpga,delayLut3)
         
-    def gridSearchOptimizerFit(self, phases=np.arange(-25, 25), iqRatios=np.arange(0.8, 1.75, 0.02), sideband='upper', threshold=38, weightDecayDist=1, nAvgs=5, saveNPZ=False):
+    def measureSBSuppression(self, freqLocs, sbLocs, nAvgs, spectrum):
+        """
+        Averages nAvgs ADC snapshot spectra into a preallocated buffer and returns the SB suppression
+        at each tone
+
+        INPUTS:
+            freqLocs: spectrum index of each tone
+            sbLocs: spectrum index of each tone's sideband image
+            nAvgs: number of snapshots to average
+            spectrum: buffer of length nSamples the averaged spectrum (dB) is written to
+        OUTPUTS:
+            SB suppression (dB) at each tone
+        """
+        spectrum[:] = 0
+        for k in range(nAvgs):
+            snapDict = self.takeAdcSnap()
+            specDict = adcSnap.streamSpectrum(snapDict['iVals'], snapDict['qVals'])
+            spectrum += specDict['spectrumDb']
+        spectrum /= nAvgs
+        return spectrum[freqLocs] - spectrum[sbLocs]
+
+    def gridSearchOptimizerFit(self, phases=np.arange(-25, 25), iqRatios=np.arange(0.8, 1.75, 0.02), sideband='upper', threshold=38, weightDecayDist=1, nAvgs=5, saveNPZ=False,
+                               nProcesses=None):
         """
         Determines optimal phase/iq offsets for each tone in comb simultaneosly. Treats all tones as independent. For each tone,
-        samples the SB suppression at a few random points in phase/iq offset search space, then fits a 2D exponential decay. Takes
+        samples the SB suppression at a few random points in phase/iq offset search space, then fits a 2D peak. Takes
         additional samples both near and far from the peak, refitting after each sample until an above-threshold point is found. Threshold
         decreases with each iteration.
 
+        All tones are fit at once each iteration with a closed form quadratic fit to the log SB suppression (see fitLogQuadratic).
+        Tones where that doesn't give a peak inside the search space fall back to fitting a 2D exponential decay with curve_fit,
+        farmed out to a process pool.
+
         INPUTS:
             phases - list of phases in search space
             iqRatios - list of IQ ratios in search space
             threshold - starting SB suppression completion threshold
+            nProcesses - size of the process pool for the fallback curve fits. Default is the number of CPUs
 
         OUTPUTS:
             self.finalPhaseList - list of optimal phases
@@ -199,7 +267,9 @@ class SBOptimizer:
         else:
             raise Exception('Specify a valid sideband (either upper or lower)!')
 
-        sampledSBSups = np.zeros((len(freqList), len(phases), len(iqRatios)))
+        nFreqs = len(freqList)
+        gridShape = (len(phases), len(iqRatios))
+        sampledSBSups = np.zeros((nFreqs,) + gridShape)
         sampledSBSups[:] = np.nan
         
         nSamples = 4096.
@@ -208,178 +278,131 @@ class SBOptimizer:
         quantFreqsMHz = np.round(quantFreqsMHz*nSamples/sampleRate)*sampleRate/nSamples
         snapDict = self.takeAdcSnap()
         specDict = adcSnap.streamSpectrum(snapDict['iVals'], snapDict['qVals'])        
-        findFreq = lambda freq: np.where(specDict['freqsMHz']==freq)[0][0]
         print('quantFreqsMHz', quantFreqsMHz)
         print('spectDictFreqs', specDict['freqsMHz'])
         print('nSamples', specDict['nSamples'])
-        freqLocs = np.asarray(map(findFreq, quantFreqsMHz))
+        freqLocs = np.searchsorted(specDict['freqsMHz'], quantFreqsMHz)
+        if np.any(specDict['freqsMHz'][np.clip(freqLocs, 0, specDict['nSamples']-1)] != quantFreqsMHz):
+            raise ValueError('Tone frequencies not found in spectrum')
         sbLocs = -1*freqLocs + len(specDict['freqsMHz'])
+        spectrum = np.zeros(specDict['nSamples'])  # reused for every averaged measurement
 
         #take initial spectrum
         self.loadLUT(sideband)
-        initialSpectrum = np.zeros(specDict['nSamples'])
-        for k in range(nAvgs):
-            snapDict = self.takeAdcSnap()
-            specDict = adcSnap.streamSpectrum(snapDict['iVals'], snapDict['qVals'])
-            initialSpectrum += specDict['spectrumDb']
-        initialSpectrum /= nAvgs
+        self.measureSBSuppression(freqLocs, sbLocs, nAvgs, spectrum)
+        initialSpectrum = spectrum.copy()
 
         #specifies the probability distribution from which to sample points in phase, IQ ratio, search space
-        weights = np.ones((len(freqList), len(phases), len(iqRatios)))
+        weights = np.ones((nFreqs,) + gridShape)
 
         print('weightShape', np.shape(weights))
 
-        #normalize weights within each frequency
-        normWeights = np.transpose(np.transpose(np.reshape(weights,(len(freqList),-1)))/np.sum(weights, axis=(1,2)))
-        normWeights = np.reshape(normWeights, np.shape(weights))
-        
-        sbSupIndList = np.zeros((len(freqList), 2), dtype=np.int) #points currently being sampled at each frequency (in I/Q ratio, phase search space
-        flatInds = np.arange(len(phases)*len(iqRatios))
-        curSupList = np.zeros(len(freqList)) #list of last-sampled SB suppression at each frequency, averaged over nAvgs
-        curRawSupList = np.zeros((len(freqList), nAvgs)) #unaveraged list of SB suppressions
-        phaseList = np.zeros(len(freqList)) #list of phase offsets being sampled at each frequency
-        iqRatioList = np.ones(len(freqList)) #list of I/Q offsets being sampled at each frequency
-        finalPhaseList = np.zeros(len(freqList)) #list of optimal phase offsets
-        finalIQRatioList = np.ones(len(freqList)) #list of optimal I/Q amplitude offsets
-        finalSBSupList = np.zeros(len(freqList)) #list of SB suppressions at optimal values
-        foundMaxList = np.zeros(len(freqList)) #list of booleans indicating whether above-threshold value has been found
+        sampledRows = np.zeros((nFreqs, 0), dtype=np.int) #phase index of every point sampled at each frequency
+        sampledCols = np.zeros((nFreqs, 0), dtype=np.int) #I/Q ratio index of every point sampled at each frequency
+        sampledVals = np.zeros((nFreqs, 0)) #SB suppressions at the sampled points, averaged over nAvgs
+        finalPhaseList = np.zeros(nFreqs) #list of optimal phase offsets
+        finalIQRatioList = np.ones(nFreqs) #list of optimal I/Q amplitude offsets
+        finalSBSupList = np.zeros(nFreqs) #list of SB suppressions at optimal values
+        foundMaxList = np.zeros(nFreqs) #list of booleans indicating whether above-threshold value has been found
+        fitCenters = np.zeros((nFreqs, 2)) #last good (row, col) fit of the SB suppression peak at each frequency
         counter = 0
-        
-        #functions used for fitting
-        def gaussian(x, x0r, x0c, scale, width):
-            return scale*np.exp(-((x[0]-x0r)**2+(x[1]-x0c)**2)/width**2)
-
-        def expDecay(x, x0r, x0c, scale, width):
-            return scale*np.exp(-np.sqrt((x[0]-x0r)**2+(x[1]-x0c)**2)/width)
+        toneInds = np.arange(nFreqs)
+
+        def samplePoints():
+            """ draw one point per frequency from the normalized weights, vectorized inverse CDF sampling """
+            cdf = np.cumsum(weights.reshape(nFreqs, -1), axis=1)
+            u = np.random.random(nFreqs)*cdf[:, -1]
+            flatInd = np.sum(cdf <= u[:, np.newaxis], axis=1)
+            return np.unravel_index(flatInd, gridShape)
+
+        def measure(rows, cols):
+            self.loadLUT(sideband, phases[rows], iqRatios[cols])
+            curSupList = self.measureSBSuppression(freqLocs, sbLocs, nAvgs, spectrum)
+            sampledSBSups[toneInds, rows, cols] = curSupList
+            weights[toneInds, rows, cols] = 0
+            return curSupList
 
         #sample initial points
         for i in range(7):
-            for j in range(len(freqList)):
-                if i==0:
-                    sbSupInd = np.zeros(2, dtype=np.int)
-                    sbSupInd[0] = np.where(phases<=0.01)[0][0]
-                    print(iqRatios)
-                    sbSupInd[1] = np.where(iqRatios-1<=0.001)[0][0]
-                else:
-                    flatInd = np.random.choice(flatInds, p=normWeights[j,:].flatten())
-                    sbSupInd = np.unravel_index(flatInd, np.shape(sampledSBSups[j]))
-                phaseList[j] = phases[sbSupInd[0]]
-                iqRatioList[j] = iqRatios[sbSupInd[1]]
-                sbSupIndList[j] = np.asarray(sbSupInd, dtype=np.int)
-                
-            self.loadLUT(sideband, phaseList, iqRatioList)
-
-            for k in range(nAvgs):
-                snapDict = self.takeAdcSnap()
-                specDict = adcSnap.streamSpectrum(snapDict['iVals'], snapDict['qVals'])
-                curRawSupList[:,k] = specDict['spectrumDb'][freqLocs]-specDict['spectrumDb'][sbLocs]
-
-            curSupList = np.mean(curRawSupList, axis=1)
-            
-            for j in range(len(freqList)):
-                print(j, sbSupIndList[j,0], sbSupIndList[j,1])
-                sampledSBSups[j, sbSupIndList[j,0], sbSupIndList[j,1]] = curSupList[j]
-                weights[j, sbSupIndList[j,0], sbSupIndList[j,1]] = 0
-                    
-            normWeights = np.transpose(np.transpose(np.reshape(weights,(len(freqList),-1)))/np.sum(weights, axis=(1,2)))
-            normWeights = np.reshape(normWeights, np.shape(weights))
-            
+            if i==0:
+                rows = np.full(nFreqs, np.where(phases<=0.01)[0][0], dtype=np.int)
+                print(iqRatios)
+                cols = np.full(nFreqs, np.where(iqRatios-1<=0.001)[0][0], dtype=np.int)
+            else:
+                rows, cols = samplePoints()
+            curSupList = measure(rows, cols)
+            sampledRows = np.column_stack((sampledRows, rows))
+            sampledCols = np.column_stack((sampledCols, cols))
+            sampledVals = np.column_stack((sampledVals, curSupList))
+
+        rowCoords = np.arange(gridShape[0])[np.newaxis, :, np.newaxis]
+        colCoords = np.arange(gridShape[1])[np.newaxis, np.newaxis, :]
+        pool = None
+
+        try:
+            while np.any(foundMaxList==0):
+                # choose points to sample, based on probability distribution specified by 'weights'
+                rows, cols = samplePoints()
+
+                # load in new offsets and take ADC snap
+                curSupList = measure(rows, cols)
+                sampledRows = np.column_stack((sampledRows, rows))
+                sampledCols = np.column_stack((sampledCols, cols))
+                sampledVals = np.column_stack((sampledVals, curSupList))
 
-
-        fitParams = [10, 10, 40, 15]
-        rowCoords = np.tile(np.arange(np.shape(sampledSBSups[0])[0]),(np.shape(sampledSBSups[0])[1],1))
-        rowCoords = np.transpose(rowCoords)
-        colCoords = np.tile(np.arange(np.shape(sampledSBSups[0])[1]),(np.shape(sampledSBSups[0])[0],1))
-
-        while np.any(foundMaxList==0):
-            nFailedFits = 0
-            # choose points to sample, based on probability distribution specified by 'weights'
-            for j in range(len(freqList)):
-                if False: #foundMaxList[j]==1:
-                    phaseList[j] = finalPhaseList[j]
-                    iqRatioList[j] = finalIQRatioList[j]
-                    sbSupIndList[j] = np.array([np.where(phases==finalPhaseList[j])[0][0], np.where(iqRatios==finalIQRatioList[j])[0][0]])
-
-                else:
-                    flatInd = np.random.choice(flatInds, p=normWeights[j,:].flatten())
-                    sbSupInd = np.unravel_index(flatInd, np.shape(sampledSBSups[j]))
-                    phaseList[j] = phases[sbSupInd[0]]
-                    iqRatioList[j] = iqRatios[sbSupInd[1]]
-                    sbSupIndList[j] = np.asarray(sbSupInd)
-
-            # load in new offsets and take ADC snap 
-            self.loadLUT(sideband, phaseList, iqRatioList)
-            
-            for k in range(nAvgs):
-                snapDict = self.takeAdcSnap()
-                specDict = adcSnap.streamSpectrum(snapDict['iVals'], snapDict['qVals'])
-                curRawSupList[:,k] = specDict['spectrumDb'][freqLocs]-specDict['spectrumDb'][sbLocs]
-
-            curSupList = np.mean(curRawSupList, axis=1)
-            
-            for j in range(len(freqList)):
-                sampledSBSups[j, sbSupIndList[j,0], sbSupIndList[j,1]] = curSupList[j]
-                
                 # determine whether any sampled SB suppressions are above threshold
-                if(np.any(sampledSBSups[j]>=threshold)):
-                    foundMaxList[j]=1
-                    optSBSupIndFlat = np.nanargmax(sampledSBSups[j])
-                    optSBSupInd = np.unravel_index(optSBSupIndFlat, np.shape(sampledSBSups[j]))
-                    finalPhaseList[j] = phases[optSBSupInd[0]]
-                    finalIQRatioList[j] = iqRatios[optSBSupInd[1]]
-                    finalSBSupList[j] = sampledSBSups[j, optSBSupInd[0], optSBSupInd[1]]
-                
-                #calculate new weights
+                maxSBSups = np.nanmax(sampledSBSups.reshape(nFreqs, -1), axis=1)
+                found = maxSBSups >= threshold
+                foundMaxList[found] = 1
+                optSBSupIndFlat = np.nanargmax(sampledSBSups[found].reshape(-1, gridShape[0]*gridShape[1]), axis=1)
+                optRows, optCols = np.unravel_index(optSBSupIndFlat, gridShape)
+                finalPhaseList[found] = phases[optRows]
+                finalIQRatioList[found] = iqRatios[optCols]
+                finalSBSupList[found] = maxSBSups[found]
 
-                validSBLocs = np.where(np.isnan(sampledSBSups[j])==0) #coordinates of sampled points
-                xdata = np.array([validSBLocs[0],validSBLocs[1]])
-                ydata = np.array(sampledSBSups[j,validSBLocs[0],validSBLocs[1]])
-                # print 'xdata', xdata
-                # print 'ydata', ydata
-                
-                # fit exponential decay to all sampled points
-                try:
-                    fitParams, pcov = spo.curve_fit(expDecay, xdata, ydata, fitParams, 
-                        bounds=([0, 0, 30, 2], [np.shape(sampledSBSups[0])[0], np.shape(sampledSBSups[0])[1], 50, 20]), method='trf')
-                
-                    # print 'fitParams', fitParams
-                    # print 'fitting errors', np.sqrt(np.diag(pcov))
-
-                    rowDist = rowCoords - fitParams[0]
-                    colDist = colCoords - fitParams[1]
-                    weightDecay = np.random.choice([25,weightDecayDist]) #choose whether to sample close to or far away from fit center
-                    weights[j] = np.exp(-(rowDist**2+colDist**2)/weightDecay**2)
-
-                except RuntimeError:
-                    nFailedFits += 1
-                    pass
-                
-                weights[j, validSBLocs]=0 #set weights to 0 at previously sampled points
-            
-            normWeights = np.transpose(np.transpose(np.reshape(weights,(len(freqList),-1)))/np.sum(weights, axis=(1,2)))
-            normWeights = np.reshape(normWeights, np.shape(weights))
-            
-            counter += 1
-            
-            threshold -= 0.5
-
-            print('Number of Failed Fits', nFailedFits)
-            print('Number past threshold', sum(foundMaxList))
-            print('threshold', threshold)
-            print(counter, 'iterations')
-            print('finalSBSupList', finalSBSupList)
-            #plt.imshow(normWeights)
-            #plt.colorbar()
-            #plt.show()
+                #calculate new weights
+                centers, goodFit = fitLogQuadratic(sampledRows, sampledCols, sampledVals, gridShape)
+                fitCenters[goodFit] = centers[goodFit]
+                badFits = np.where(~goodFit)[0]
+                nFailedFits = 0
+                if len(badFits):
+                    # fall back to fitting exponential decay to all sampled points
+                    if pool is None:
+                        pool = multiprocessing.Pool(nProcesses)
+                    fitArgs = [(np.array([sampledRows[j], sampledCols[j]]), sampledVals[j], gridShape) for j in badFits]
+                    for j, fitParams in zip(badFits, pool.map(fitExpDecay, fitArgs)):
+                        if fitParams is None:
+                            nFailedFits += 1
+                            goodFit[j] = False
+                        else:
+                            fitCenters[j] = fitParams[:2]
+                            goodFit[j] = True
+
+                weightDecay = np.random.choice([25, weightDecayDist], nFreqs) #choose whether to sample close to or far away from fit center
+                rowDist = rowCoords - fitCenters[:, 0, np.newaxis, np.newaxis]
+                colDist = colCoords - fitCenters[:, 1, np.newaxis, np.newaxis]
+                newWeights = np.exp(-(rowDist**2+colDist**2)/weightDecay[:, np.newaxis, np.newaxis]**2)
+                weights[goodFit] = newWeights[goodFit]  # keep the old weights where the fit failed
+                weights[~np.isnan(sampledSBSups)] = 0 #set weights to 0 at previously sampled points
+
+                counter += 1
+
+                threshold -= 0.5
+
+                print('Number of Failed Fits', nFailedFits)
+                print('Number past threshold', sum(foundMaxList))
+                print('threshold', threshold)
+                print(counter, 'iterations')
+                print('finalSBSupList', finalSBSupList)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
 
         #take final spectrum
         self.loadLUT(sideband, finalPhaseList, finalIQRatioList)
-        finalSpectrum = np.zeros(specDict['nSamples'])
-        for k in range(nAvgs):
-            snapDict = self.takeAdcSnap()
-            specDict = adcSnap.streamSpectrum(snapDict['iVals'], snapDict['qVals'])
-            finalSpectrum += specDict['spectrumDb']
-        finalSpectrum /= nAvgs
+        self.measureSBSuppression(freqLocs, sbLocs, nAvgs, spectrum)
+        finalSpectrum = spectrum.copy()
 
         if sideband=='lower':
             self.finalPhaseListLow = finalPhaseList
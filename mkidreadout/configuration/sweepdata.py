@@ -1,7 +1,12 @@
+import fcntl
+import os
+from contextlib import contextmanager
+
 import matplotlib.pyplot as plt
 import numpy as np
 
 from mkidcore.corelog import getLogger
+from mkidreadout.configuration.widesweep import stitch, sweepstore
 
 # flags
 ISGOOD = 0b1
@@ -15,6 +20,16 @@ LOCUT = 1e9
 
 A_RANGE_CUTOFF = 6e9
 
+# Binary SweepMetadata files (.npz) hold a structured 'table' with this schema, the format 'version' and 'wsatten'.
+# Bump the version when the schema changes and keep reading the older ones in SweepMetadata._load_binary
+METADATA_VERSION = 1
+METADATA_EXT = '.npz'
+METADATA_DTYPE = np.dtype([('resID', np.int64), ('flag', np.int64), ('wsfreq', np.float64), ('mlfreq', np.float64),
+                           ('mlatten', np.float64), ('freq', np.float64), ('atten', np.float64),
+                           ('ml_isgood_score', np.float64), ('ml_isbad_score', np.float64)])
+_METADATA_ATTRS = ('resIDs', 'flag', 'wsfreq', 'mlfreq', 'mlatten', 'freq', 'atten', 'ml_isgood_score',
+                   'ml_isbad_score')  # SweepMetadata attribute for each METADATA_DTYPE field
+
 
 def genResIDsForFreqs(freqs, flnum):
     # TODO where does this live
@@ -30,13 +45,28 @@ def bandfor(lo):
     return 'a' if lo < A_RANGE_CUTOFF else 'b'
 
 
+@contextmanager
+def metadata_lock(file):
+    """Hold an exclusive lock on metadata file (via file.lock) so tools don't clobber each other's changes"""
+    with open(file + '.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
 class FreqSweep(object):
     def __init__(self, file):
+        """file is a power sweep .npz or the store of a sweep being taken (see widesweep.sweepstore)"""
         self.file = file
-        data = np.load(self.file)
+        if os.path.isdir(self.file):
+            data = sweepstore.loadSweepStore(self.file)  # only the attenuations that are complete
+        else:
+            data = np.load(self.file)
         self.atten = data['atten']  # 1d [nAttens] dB
 
-        flip = np.diff(self.atten)[0] < 0
+        flip = self.atten.size > 1 and np.diff(self.atten)[0] < 0
 
         self.freqs = data['freqs']  # 2d [nTones, nLOsteps] Hz
 
@@ -67,7 +97,6 @@ class FreqSweep(object):
         attenlast = atten + 1 if amax is None else np.abs(self.atten - amax).argmin()
         attenlast = max(atten + 1, attenlast)
 
-        freqs = self.freqs.ravel().copy()
         iVals = self.i[atten:attenlast].squeeze()
         qVals = self.q[atten:attenlast].squeeze()
         if qVals.ndim > 2:
@@ -75,36 +104,20 @@ class FreqSweep(object):
             getLogger(__name__).info(msg.format(qVals.shape[0], self.atten[atten:attenlast]))
             iVals = iVals.mean(0)
             qVals = qVals.mean(0)
-        iVals = iVals.ravel().copy()
-        qVals = qVals.ravel().copy()
-
-        mags = np.sqrt(iVals ** 2 + qVals ** 2)
-
-        deltas = np.diff(freqs)
-        boundaryInds = np.where(deltas < 0)[0]
-        boundaryDeltas = -deltas[boundaryInds]
-        nOverlapPoints = (boundaryDeltas / self.freqStep).astype(int) + 1
-        boundaryInds = boundaryInds + 1
-
-        for i in range(len(boundaryInds)):
-            lfMags = mags[boundaryInds[i] - nOverlapPoints[i]: boundaryInds[i]]
-            hfMags = mags[boundaryInds[i]: boundaryInds[i] + nOverlapPoints[i]]
-            hfWeights = np.linspace(0, 1, num=nOverlapPoints[i], endpoint=False)
-            lfWeights = 1 - hfWeights
-            # set mags to average the overlap regions
-            mags[boundaryInds[i]: boundaryInds[i] + nOverlapPoints[i]] = lfWeights * lfMags + hfWeights * hfMags
-            mags[boundaryInds[i] - nOverlapPoints[i]: boundaryInds[i]] = np.nan  # set one side of overlap to 0
-            freqs[boundaryInds[i] - nOverlapPoints[i]: boundaryInds[i]] = np.nan
-
-        mags = mags[~np.isnan(mags)]
-        freqs = freqs[~np.isnan(freqs)]
-
-        iVals = mags
+        stitched = stitch.stitchSegments(self.freqs, iVals, qVals)  # one segment per tone
+
+        freqs = stitched[:, 0]
+        iVals = np.sqrt(stitched[:, 1] ** 2 + stitched[:, 2] ** 2)
         qVals = np.zeros_like(iVals)
         return np.transpose([freqs, iVals, qVals])
 
 
 class SweepMetadata(object):
+    """
+    Per resonator sweep results for a feedline. Text files (the older format) are still read and written, files
+    ending in METADATA_EXT are binary, e.g. SweepMetadata(file='FL1_metadata.txt').save(file='FL1_metadata.npz')
+    converts one
+    """
     def __init__(self, resid=None, wsfreq=None, flag=None, mlfreq=None, mlatten=None,
                  ml_isgood_score=None, ml_isbad_score=None, file='',
                  wsatten=np.nan):
@@ -112,6 +125,8 @@ class SweepMetadata(object):
         #TODO add channel, range (a|b)
         self.file = file
         self.feedline = None
+        self._lockedfile = None
+        self._indexed = None  # the resIDs array _order and _sortedIDs were built for
 
         self.resIDs = resid
         self.wsfreq = wsfreq
@@ -167,17 +182,61 @@ class SweepMetadata(object):
         plt.legend()
         plt.show(False)
 
+    @classmethod
+    @contextmanager
+    def updating(cls, file, source=''):
+        """
+        Load, modify and save file while holding its lock, so concurrent updates from other tools aren't lost.
+        file is the path as is, it's locked and written without filling in {feedline}
+
+        with SweepMetadata.updating(file) as sd:
+            sd.set(resID, atten=atten)
+
+        INPUTS:
+            file - the metadata file to update
+            source - load from this file instead, e.g. to derive file from another one. file needn't exist then
+        """
+        with metadata_lock(file):
+            sd = cls(file=source or file)
+            sd.file = file
+            sd._lockedfile = file
+            try:
+                yield sd
+                sd.vet()
+                sd._write(file)  # the path that is locked, save() would format it
+            finally:
+                sd._lockedfile = None
+
+    def rows(self, resIDs):
+        """
+        Index of resIDs (scalar or array) in the metadata arrays, found with a sorted index that's rebuilt whenever
+        self.resIDs is replaced
+
+        OUTPUTS:
+            rows - row of each resID (meaningless where not found)
+            found - mask of the resIDs that are in the metadata
+        """
+        if self._indexed is not self.resIDs:
+            self._order = np.argsort(self.resIDs, kind='mergesort')
+            self._sortedIDs = self.resIDs[self._order]
+            self._indexed = self.resIDs
+        resIDs = np.asarray(resIDs)
+        if not self._sortedIDs.size:
+            return np.zeros(resIDs.shape, dtype=int), np.zeros(resIDs.shape, dtype=bool)
+        pos = np.searchsorted(self._sortedIDs, resIDs).clip(max=self._sortedIDs.size - 1)
+        return self._order[pos], self._sortedIDs[pos] == resIDs
+
     def set(self, resID, atten=None, freq=None, save=False, reviewed=False):
-        mask = resID == self.resIDs
-        if not mask.any():
+        row, found = self.rows(resID)
+        if not found:
             getLogger(__name__).warning('Unable to set values for unknown resID: {}'.format(resID))
             return False
         if atten is not None:
-            self.atten[mask] = atten
+            self.atten[row] = atten
         if freq is not None:
-            self.freq[mask] = freq
+            self.freq[row] = freq
         if reviewed:
-            self.flag[mask] |= ISREVIEWED
+            self.flag[row] |= ISREVIEWED
         if save:
             self.save()
         return True
@@ -198,18 +257,27 @@ class SweepMetadata(object):
         return np.array([self.resIDs, self.flag, self.wsfreq, self.mlfreq, self.mlatten, self.freq,
                          self.atten, self.ml_isgood_score, self.ml_isbad_score])
 
+    def totable(self):
+        """The metadata as a structured array with METADATA_DTYPE"""
+        table = np.empty(self.resIDs.size, dtype=METADATA_DTYPE)
+        for name, attr in zip(METADATA_DTYPE.names, _METADATA_ATTRS):
+            table[name] = getattr(self, attr)
+        return table
+
     def update_from_roach(self, resIDs, freqs=None, attens=None):
+        """Set the freqs and/or attens of resIDs (in any order). Unknown resIDs are skipped"""
+        resIDs = np.asarray(resIDs)
         if attens is not None:
             assert resIDs.size == attens.size
         if freqs is not None:
             assert resIDs.size == freqs.size
-        for r in resIDs:
-            #TODO vectorize!
-            use = self.resIDs == r
-            if attens is not None:
-                self.atten[use] = attens[use]
-            if freqs is not None:
-                self.freq[use] = freqs[use]
+        rows, found = self.rows(resIDs)
+        if not found.all():
+            getLogger(__name__).warning('Unable to set values for {} unknown resIDs'.format((~found).sum()))
+        if attens is not None:
+            self.atten[rows[found]] = np.asarray(attens)[found]
+        if freqs is not None:
+            self.freq[rows[found]] = np.asarray(freqs)[found]
 
     def lomask(self, lo):
         return ((self.flag & ISGOOD) & (~np.isnan(self.mlfreq)) & (np.abs(self.mlfreq - lo) < LOCUT)).astype(bool)
@@ -235,10 +303,27 @@ class SweepMetadata(object):
         return header.format(self.feedline, self.wsatten)
 
     def save(self, file=''):
+        """
+        Save to file (self.file by default), binary if it ends in METADATA_EXT, text otherwise. The file is written
+        under its lock and then renamed into place, so readers never see a partial file
+        """
         sf = file.format(feedline=self.feedline) if file else self.file.format(feedline=self.feedline)
         self.vet()
-        np.savetxt(sf, self.toarray().T, fmt="%8d %1u %16.7f %16.7f %5.1f %16.7f %5.1f %6.4f %6.4f",
-                   header=self.genheader())
+        if self._lockedfile == sf:  # already held by updating()
+            self._write(sf)
+        else:
+            with metadata_lock(sf):
+                self._write(sf)
+
+    def _write(self, sf):
+        tmp = sf + '.tmp'
+        with open(tmp, 'wb') as f:
+            if sf.endswith(METADATA_EXT):
+                np.savez(f, version=METADATA_VERSION, wsatten=self.wsatten, table=self.totable())
+            else:
+                np.savetxt(f, self.toarray().T, fmt="%8d %1u %16.7f %16.7f %5.1f %16.7f %5.1f %6.4f %6.4f",
+                           header=self.genheader())
+        os.rename(tmp, sf)
 
     def templar_data(self, lo):
         aResMask = slice(None,None) #self.lomask(lo)  #TODO URGENT add range assignment to each resonator
@@ -266,6 +351,24 @@ class SweepMetadata(object):
         self.feedline = resID2fl(self.resIDs[0])
 
     def _load(self):
+        if self.file.endswith(METADATA_EXT):
+            self._load_binary()
+        else:
+            self._load_text()
+
+    def _load_binary(self):
+        with np.load(self.file.format(feedline=self.feedline)) as npz:
+            version = int(npz['version'])
+            if version > METADATA_VERSION:
+                raise ValueError('{} has metadata version {}, only up to {} is supported'.format(self.file, version,
+                                                                                                METADATA_VERSION))
+            table = npz['table']
+            self.wsatten = float(npz['wsatten'])
+        for name, attr in zip(METADATA_DTYPE.names, _METADATA_ATTRS):
+            setattr(self, attr, table[name].copy())
+        self._vet()
+
+    def _load_text(self):
         d = np.loadtxt(self.file.format(feedline=self.feedline), unpack=True)
         # TODO convert to load metadata from file
         try:
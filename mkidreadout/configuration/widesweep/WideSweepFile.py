@@ -1,4 +1,3 @@
-import math
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -6,6 +5,8 @@ from matplotlib.backends.backend_pdf import PdfPages
 from scipy import signal
 from scipy.interpolate import UnivariateSpline
 
+from mkidreadout.configuration.widesweep import peakfinding, wsformat
+
 
 def peaks(y, nsig, m=2, returnDict=False):
     """
@@ -25,48 +26,12 @@ def peaks(y, nsig, m=2, returnDict=False):
     calculated using ROBUST_SIGMA (see Goddard routines online). Then
     peaks which are NSIG above the sigma of all peaks are selected.
 
+    See peakfinding.peaks, which does the work, and peakfinding.PeakStream
+    to find the peaks while the spectrum is being taken.
     """
 
     print "begin peaks with nsig, m=", nsig, m
-    d0 = y - np.roll(y, -1)
-    d1 = y - np.roll(y, 1)
-    pk = np.arange(y.size)[np.logical_and(d0 > 0, d1 > 0)]
-    npk = pk.size
-    yp = y[pk]
-    # reject outliers more than m=2 sigma from median
-    delta = np.abs(yp - np.median(yp))
-    mdev = np.median(delta)
-    s = delta / mdev if mdev else 0
-    ypGood = y[np.where(s < m)]  # using a subset of y
-    mn = ypGood.mean()
-    sig = ypGood.std()
-    big = pk[yp > mn + nsig * sig]
-
-    # to remove multiple identifications of the same peak (not collisions)
-    minPeakDist = 60
-    cluster = []
-    clusters = []
-    for pks in range(len(big) - 1):
-        dist = abs(big[pks] - big[pks + 1])
-        cluster.append(pks)
-        if dist > minPeakDist:
-            clusters.append(cluster)
-            cluster = []
-
-    indrem = []
-    for c in range(len(clusters)):
-        try:
-            trueind = np.argmax(y[big[clusters[c]]])
-            falseind = np.where(big[clusters[c]] != big[clusters[c]][trueind])[0]
-            indrem = np.concatenate((indrem, np.array(clusters[c])[falseind]))
-        except ValueError:
-            pass
-    big = np.delete(big, indrem)
-
-    if returnDict:
-        return {"big": big, "pk": pk, "yp": yp, "m": m}
-    else:
-        return big
+    return peakfinding.peaks(y, nsig, m=m, returnDict=returnDict)
 
 
 class WideSweepFile(object):
@@ -76,6 +41,8 @@ class WideSweepFile(object):
     The first seven lines are header information.
     Each remaining line is frequency, I, sigma_I, Q, sigma_Q
 
+    Binary widesweeps (see wsformat) are memory mapped instead of parsed.
+
     """
     def __init__(self,fileName):
         file = open(fileName,'r')
@@ -94,9 +61,7 @@ class WideSweepFile(object):
         (self.Iz2,self.Izsd2) = 0.000, 0.000
         (self.Qz2,self.Qzsd2) = 0.000, 0.000
         file.close()
-        try:
-            self.data1 = np.loadtxt(fileName)
-        except: self.data1 = np.loadtxt(fileName, skiprows=3)
+        self.data1 = wsformat.loadWideSweep(fileName)
         self.loadedFileName=fileName
         self.x = self.data1[:,0]
         self.n = len(self.x)
@@ -136,21 +101,9 @@ class WideSweepFile(object):
         self.fptStd = np.sqrt(np.average((self.fptCenters-self.fptAverage)**2, 
                                       weights=self.fptHg[0]))
         thresh = self.fptAverage - threshSigma*self.fptStd
-        ind = np.arange(len(values))[values < thresh]
-        self.threshIntervals = interval()
-        for i in ind-1:
-            self.threshIntervals = threshIntervals | interval[i-0.6,i+0.6]
-        self.peaks = np.zeros(len(threshIntervals))
-
-        iPeak = 0
-        for threshInterval in self.threshIntervals:
-            i0 = int(math.ceil(self.threshInterval[0]))
-            i1 = int(math.ceil(self.threshInterval[1]))
-            peak = np.average(self.x[i0:i1],weights=np.abs(values[i0:i1]))
-            self.peaks[iPeak] = peak
-            x0 = self.x[i0]
-            x1 = self.x[i1]
-            iPeak += 1
+        starts, stops = peakfinding.thresholdRuns(values, thresh)
+        self.threshIntervals = np.column_stack((starts, stops))
+        self.peaks = peakfinding.weightedRunCenters(self.x, np.abs(values), starts, stops)
 
     def filter(self, order=4, rs=40, wn=0.1):
         b,a = signal.cheby2(order, rs, wn, btype="high", analog=False)
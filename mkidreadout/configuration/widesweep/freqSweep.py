@@ -31,6 +31,8 @@ from mkidreadout.utils.readDict import readDict
 from mkidreadout.channelizer.Roach2Controls import Roach2Controls
 from mkidreadout.channelizer.maxAttens import maxAttens
 from mkidreadout.channelizer.reinitADCDAC import reinitADCDAC
+from mkidreadout.configuration.widesweep import sweepstore
+from mkidreadout.configuration.widesweep.freqlists import makeRandomFreqSideband
 
 
 def setupMultRoaches4FreqSweep(roachNums, freqFN='rfFreqs.txt', defineLUTs=False):
@@ -166,6 +168,9 @@ def generateWidesweepFreqList(FPGAparams, outputFN='rfFreqs.txt', resAtten=65, a
         lo_hole: freq hole around LO that we should avoid
         tone_BW: bandwidth around tone to avoid crosstalk in FFT/DDS
         minNominalFreqSpacing: The number of tones should be <= alias_BW/minNominalFreqSpacing. Will be clipped to the number of channels supported by the firmware. 
+
+    If a sideband is too narrow for its share of the tones at tone_BW spacing it gets fewer (see
+    freqlists.makeRandomFreqSideband()), so the list can be shorter than the number of channels.
     """
     try:
         params = readDict()             
@@ -186,8 +191,8 @@ def generateWidesweepFreqList(FPGAparams, outputFN='rfFreqs.txt', resAtten=65, a
         avgSpacing=0.
     lo=0.
     
-    freqs_low=makeRandomFreqSideband(0.-alias_BW/2.+freqResolution/2., -lo_hole/2.-freqResolution/2., np.ceil(nChannels/2.), tone_BW, freqResolution)
-    freqs_high=makeRandomFreqSideband(lo_hole/2.+freqResolution/2., alias_BW/2.-freqResolution/2., np.floor(nChannels/2.), tone_BW, freqResolution)
+    freqs_low=makeRandomFreqSideband(0.-alias_BW/2.+freqResolution/2., -lo_hole/2.-freqResolution/2., np.ceil(nChannels/2.), tone_BW)
+    freqs_high=makeRandomFreqSideband(lo_hole/2.+freqResolution/2., alias_BW/2.-freqResolution/2., np.floor(nChannels/2.), tone_BW)
     freqs = np.append(freqs_low, freqs_high)
     
     resIDs=np.asarray(range(len(freqs)))
@@ -195,38 +200,6 @@ def generateWidesweepFreqList(FPGAparams, outputFN='rfFreqs.txt', resAtten=65, a
     data = np.asarray([resIDs, freqs, attens]).T
     np.savetxt(outputFN, data, fmt="%4i %10.1f %4i")
 
-def makeRandomFreqSideband(startFreq, endFreq, nChannels, toneBandwidth, freqResolution):
-    if nChannels <1:
-        return np.asarray([],dtype=np.int)
-    #if nChannels==1:
-    #    return np.asarray([startFreq])
-    avgSpacing = (endFreq - startFreq)/nChannels
-    freqs = np.linspace(startFreq, endFreq, nChannels, False)+avgSpacing/2.
-    freqs+= np.random.rand(len(freqs)) * avgSpacing - avgSpacing/2.
-    
-    #Correct doubles
-    for arg in range(len(freqs)-1):
-        if (freqs[arg+1] - freqs[arg]) <toneBandwidth:
-            if arg==0: f_low =startFreq - toneBandwidth + freqResolution
-            else: f_low = freqs[arg -1]
-            if arg>=(len(freqs)-2): f_high = endFreq + toneBandwidth - freqResolution
-            else: f_high = freqs[arg+2]
-            
-            f_spacing = (f_high - f_low) / 3.0
-            if f_spacing>=toneBandwidth:       #push the two tones between f_high and f_low
-                freqs[arg]=f_low+f_spacing
-                freqs[arg+1]=f_low+2.0*f_spacing
-            elif (f_high - f_low) /2.0 >= toneBandwidth:   #push one tone halfway between f_high and f_low
-                freqs[arg]=(f_high - f_low)/2.0
-                freqs[arg+1] = freqs[arg]
-            else:                                       #remove both tones
-                freqs[arg] = f_low
-                freqs[arg+1]=f_low
-    freqs=np.unique(freqs)  #sort and remove duplicates
-    
-    return freqs
-
-
 def mecSlowPowerSweeps(freqList='rfFreqs.txt', defineLUTs=False, outputFN='psData.npz', startDacAtten=11.5, endDacAtten=41.5,attenStep=1):
     rNums=[236, 237, 238, 239, 220, 221, 222, 223, 232, 233, 228, 229, 224, 225]
     maxAttens(rNums,'/home/mecvnc/MKIDReadout/mkidreadout/channelizer/darknessfpga.param')
@@ -261,7 +234,7 @@ def mecSlowPowerSweeps(freqList='rfFreqs.txt', defineLUTs=False, outputFN='psDat
 
 
 
-def takeMultPowerSweeps(roachNums, startFreqs=None, endFreqs=None, startDacAtten=1, endDacAtten=None, attenStep=1., loStepQ=1, nOverlap=10, freqList='rfFreqs.txt', defineLUTs=False, outputFN='psData.npz'):
+def takeMultPowerSweeps(roachNums, startFreqs=None, endFreqs=None, startDacAtten=1, endDacAtten=None, attenStep=1., loStepQ=1, nOverlap=10, freqList='rfFreqs.txt', defineLUTs=False, outputFN='psData.npz', resume=False):
     """
     calls takePowerSweep() in different threads so that multiple roaches freq sweep simultaneously
 
@@ -277,7 +250,7 @@ def takeMultPowerSweeps(roachNums, startFreqs=None, endFreqs=None, startDacAtten
     if outputFN is None: outputFN='psData.npz'
     threads = []
     for i, rNum in enumerate(roachNums):
-        t=threading.Thread(target=takePowerSweep, args=(rNum,startFreqs[i],endFreqs[i],startDacAtten, endDacAtten, attenStep, loStepQ, nOverlap, freqList, defineLUTs, outputFN,))
+        t=threading.Thread(target=takePowerSweep, args=(rNum,startFreqs[i],endFreqs[i],startDacAtten, endDacAtten, attenStep, loStepQ, nOverlap, freqList, defineLUTs, outputFN, resume,))
         threads.append(t)
         t.start()
     for t in threads:
@@ -297,10 +270,15 @@ def takeMultPowerSweeps(roachNums, startFreqs=None, endFreqs=None, startDacAtten
     
 
 
-def takePowerSweep(rNum, startFreq=3.5E9, endFreq=6.E9, startDacAtten=1, endDacAtten=None, attenStep=1., loStepQ=1, nOverlap=10, freqList='rfFreqs.txt', defineLUTs=False, outputFN='psData.npz'):
+def takePowerSweep(rNum, startFreq=3.5E9, endFreq=6.E9, startDacAtten=1, endDacAtten=None, attenStep=1., loStepQ=1, nOverlap=10, freqList='rfFreqs.txt', defineLUTs=False, outputFN='psData.npz', resume=False):
     """
     Do a power sweep!
 
+    If outputFN is given each (dacAtten, LO sweep) block is written to a SweepStore (see sweepstore.py) in
+    outputFN with '_blocks' instead of '.npz' as soon as it's taken, so only one block is held in memory and the
+    store can be read with sweepstore.loadSweepStore() (or sweepdata.FreqSweep) while the sweep is running.
+    Without outputFN the sweep is only kept in memory.
+
     INPUTS:
         rNum - roach Number
         startFreq - [Hz]
@@ -313,9 +291,12 @@ def takePowerSweep(rNum, startFreq=3.5E9, endFreq=6.E9, startDacAtten=1, endDacA
         freqList - passed on to setupRoach4FreqSweep()
         defineLUTs - passed on to setupRoach4FreqSweep()
         outputFN - if not None, passed on to FreqSweep.savePowerSweep(). "_rNum" is added automatically to the name
+        resume - If True, continue the sweep in the existing store, skipping the blocks that are done. A sweep that
+                 was already finished and saved isn't saved again
 
     OUTPUTS:
-        I_vals - [ADC units] 3d array with dimensions [nAttens, nTones, nLOsteps]. 
+        I_vals - [ADC units] 3d array with dimensions [nAttens, nTones, nLOsteps]. Memory mapped from the store if
+                 there is one
         Q_vals - 
         freqList - [Hz] 2d array with dimensions [nTones, nLOsteps].
         attens - [dB] 1d array with dimensions [nAtten]. This is the absolute attenuation for each tone
@@ -362,13 +343,22 @@ def takePowerSweep(rNum, startFreq=3.5E9, endFreq=6.E9, startDacAtten=1, endDacA
         print 'nLOSteps: '+str(loSpan/loStep)
         print ''
 
-        outputFN = outputFN.rsplit('.npz',1)[0]+'_'+str(rNum)+'.npz'
+        if outputFN is not None: outputFN = outputFN.rsplit('.npz',1)[0]+'_'+str(rNum)+'.npz'
+        attens = attenList - roachController.globalDacAtten + resAtten
+        nTones = len(dacQuantizedFreqList)
+        # None until the first sweep tells us the number of LO steps, unless we're resuming
+        store = None
+        if outputFN is not None:
+            storeFN = sweepstore.storeName(outputFN)
+            store = sweepstore.SweepStore.openOrCreate(storeFN, attens, nTones, nSweeps, None, resume)
+        I_vals = Q_vals = freq_list = None  # only used without a store
         
         #Now start powersweeping!
         newADCAtten=30. #Arbitrary first guess
-        I_vals = []
-        Q_vals=[]
         for i, dacAtten in enumerate(attenList):
+            if store is not None and store.isDone(i):
+                print "Roach "+str(rNum)+": "+str(i+1)+' of '+str(len(attenList))+' dacAttens already done'
+                continue
             dacAtten1 = np.floor(dacAtten*2)/4.
             dacAtten2 = np.ceil(dacAtten*2)/4.
             roachController.changeAtten(1,dacAtten1)
@@ -376,10 +366,9 @@ def takePowerSweep(rNum, startFreq=3.5E9, endFreq=6.E9, startDacAtten=1, endDacA
             newADCAtten = roachController.getOptimalADCAtten(newADCAtten)
             print "Roach "+str(rNum)+": "+str(i+1)+' of '+str(len(attenList))+' dacAttens'
 
-            I_list = []
-            Q_list = []
-            freq_list = []
             for j in range(nSweeps):
+                if store is not None and store.isDone(i, j):
+                    continue
                 #loStart = startFreq + (endFreq-startFreq)*(j+1.)/(nSweeps+1.) - sweepSpan/2. - toneSpan_low
                 loStart = min(endFreq,startFreq) - toneSpan_low
                 if j>0: loStart+= 1.0*j/(nSweeps -1.)*(freqSpan - sweepSpan)
@@ -387,24 +376,31 @@ def takePowerSweep(rNum, startFreq=3.5E9, endFreq=6.E9, startDacAtten=1, endDacA
                 loEnd = loStart+loSpan
                 iqData = roachController.performIQSweep(loStart/1.e6, loEnd/1.e6, loStep/1.e6)
                 #iqData = roachController.performIQSweep(loStart/1.e6, (loStart+5*loStep)/1.e6, loStep/1.e6)
-                I_list.append(iqData['I'])
-                Q_list.append(iqData['Q'])
-                freq_list.append( np.repeat([dacQuantizedFreqList+loStart],len(iqData['freqOffsets']),0).T + 
-                                  np.repeat([iqData['freqOffsets']], len(dacQuantizedFreqList),0))
-                
-            I_list = np.reshape(I_list, (nSweeps*len(dacQuantizedFreqList), -1))
-            Q_list = np.reshape(Q_list, (nSweeps*len(dacQuantizedFreqList), -1))
-            I_vals.append(I_list)
-            Q_vals.append(Q_list)
-            if outputFN is not None:
-                freqs2save = np.reshape(freq_list, (nSweeps*len(dacQuantizedFreqList), -1))
-                atten2save = np.asarray([attenList[i]- roachController.globalDacAtten + resAtten])
-                FreqSweep.savePowerSweep(outputFN, np.asarray([I_list]), np.asarray([Q_list]), freqs2save, atten2save)
-
-        I_vals = np.reshape(I_vals, (len(attenList), nSweeps*len(dacQuantizedFreqList), -1))
-        Q_vals = np.reshape(Q_vals, (len(attenList), nSweeps*len(dacQuantizedFreqList), -1))
-        freq_list = np.reshape(freq_list, (nSweeps*len(dacQuantizedFreqList), -1))
-        attens = attenList - roachController.globalDacAtten + resAtten
+                freqs = (dacQuantizedFreqList+loStart)[:, np.newaxis] + iqData['freqOffsets']
+                if outputFN is None:
+                    if I_vals is None:
+                        shape = (len(attens), nSweeps*nTones, len(iqData['freqOffsets']))
+                        I_vals = np.full(shape, np.nan)
+                        Q_vals = np.full(shape, np.nan)
+                        freq_list = np.full(shape[1:], np.nan)
+                    rows = slice(j*nTones, (j+1)*nTones)
+                    I_vals[i, rows] = iqData['I']
+                    Q_vals[i, rows] = iqData['Q']
+                    freq_list[rows] = freqs
+                    continue
+                if store is None:
+                    store = sweepstore.SweepStore.create(storeFN, attens, nTones, nSweeps, len(iqData['freqOffsets']))
+                store.putBlock(i, j, iqData['I'], iqData['Q'], freqs)
+
+        if store is not None:
+            I_vals = store.I
+            Q_vals = store.Q
+            freq_list = store.freqs
+            if store.saved:
+                print "Roach "+str(rNum)+": "+outputFN+' already saved'
+            else:
+                FreqSweep.savePowerSweep(outputFN, I_vals, Q_vals, freq_list, attens)
+                store.markSaved()
 
         #Put attenuators back to normal
         dacAtten1 = np.floor(roachController.globalDacAtten*2)/4.
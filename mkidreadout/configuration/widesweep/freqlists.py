@@ -0,0 +1,36 @@
+"""
+Random frequency lists for widesweeps
+
+A widesweep places nChannels tones across a sideband and sweeps each one until it reaches the next. The tones are
+a jittered grid: one tone in each of nChannels equal slots, placed randomly within the slot but at least
+toneBandwidth from the tones in the neighbouring slots. The whole list is drawn at once, there are no collisions
+to correct afterwards.
+
+Usage:
+    freqs = makeRandomFreqSideband(4.5E9, 5.5E9, 512, 512.E3)  # fewer than 512 if they don't fit
+"""
+import numpy as np
+
+
+def makeRandomFreqSideband(startFreq, endFreq, nChannels, toneBandwidth):
+    """
+    Random, sorted tone frequencies between startFreq and endFreq with no two tones closer than toneBandwidth
+
+    INPUTS:
+        startFreq, endFreq - sideband edges
+        nChannels - number of tones. Reduced to the number that fit if the sideband is too narrow for them all
+        toneBandwidth - minimum distance between tones
+    OUTPUTS:
+        freqs - array of up to nChannels frequencies
+    """
+    nChannels = int(nChannels)
+    span = endFreq - startFreq
+    if nChannels < 1 or span < 0:
+        return np.asarray([], dtype=np.int)
+    if toneBandwidth > 0:
+        nChannels = max(1, min(nChannels, int(span/toneBandwidth)))
+    avgSpacing = span/float(nChannels)
+    jitter = max(avgSpacing - toneBandwidth, 0.)  # keeps neighbouring tones toneBandwidth apart
+    freqs = startFreq + (np.arange(nChannels) + 0.5)*avgSpacing
+    freqs += (np.random.rand(nChannels) - 0.5)*jitter
+    return freqs
@@ -0,0 +1,207 @@
+"""
+Peak finding for widesweep spectra
+
+The functions here work on whole arrays with no python loops over peaks. PeakStream finds the same peaks
+as peaks() from a spectrum that arrives in chunks (e.g. as a widesweep is acquired), finding the local
+maxima as the chunks come in.
+
+peaks() follows the logic of peaks.pro:
+    1. find every local maximum of the spectrum
+    2. keep the maxima more than nsig sigma above a robust mean. The maxima more than m median deviations
+       from their median are rejected and the mean and sigma are taken over y at the positions of the
+       remaining ones in the list of maxima, i.e. over points at the start of the spectrum rather than the
+       maxima themselves. That's what the original WideSweepFile.peaks did and it's kept so the peaks
+       don't change
+    3. merge detections closer than minPeakDist points, keeping the largest of each cluster
+"""
+import numpy as np
+
+MIN_PEAK_DIST = 60  # detections of the same peak are closer than this many points
+
+
+def localMaxima(y):
+    """
+    Indices of the points of y larger than both their neighbors. Like np.roll, the first and last points
+    are neighbors
+    """
+    y = np.asarray(y)
+    return np.flatnonzero((y > np.roll(y, -1)) & (y > np.roll(y, 1)))
+
+
+def peakThreshold(yp, y, nsig, m=2):
+    """
+    The value local maxima yp must exceed to be a peak: mean + nsig*std of y at the indices into yp of
+    the maxima within m median deviations of their median. See step 2 in the module docstring
+
+    INPUTS:
+        yp - values of the local maxima
+        y - the spectrum, or at least its first len(yp) points
+    """
+    yp = np.asarray(yp)
+    delta = np.abs(yp - np.median(yp))
+    mdev = np.median(delta)
+    good = np.flatnonzero(delta / mdev < m) if mdev else np.flatnonzero(0 < m)  # just y[0] when mdev is 0
+    ypGood = np.asarray(y)[good]
+    return ypGood.mean() + nsig * ypGood.std()
+
+
+def mergeClusters(big, values, minPeakDist=MIN_PEAK_DIST):
+    """
+    Remove multiple identifications of the same peak (not collisions)
+
+    Sorted peak indices are split into clusters wherever consecutive peaks are more than minPeakDist apart
+    and only the largest peak (the first, for ties) of each cluster is kept. As in the original loop, the
+    peaks after the last gap are never merged.
+
+    INPUTS:
+        big - sorted array of peak indices
+        values - value of each peak
+        minPeakDist - clusters are separated by more than this many points
+    OUTPUTS:
+        big - the merged peak indices
+    """
+    big = np.asarray(big)
+    values = np.asarray(values)
+    ends = np.flatnonzero(np.abs(np.diff(big)) > minPeakDist)  # last peak of every closed cluster
+    if len(ends) == 0:
+        return big
+    nClosed = ends[-1] + 1
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    clusterMax = np.maximum.reduceat(values[:nClosed], starts)
+    clusterId = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, nClosed)))
+    isMax = np.flatnonzero(values[:nClosed] == clusterMax[clusterId])
+    firstMax = isMax[np.concatenate(([True], np.diff(clusterId[isMax]) > 0))]
+    return np.concatenate((big[firstMax], big[nClosed:]))
+
+
+def selectPeaks(pk, yp, y, nsig, m=2, minPeakDist=MIN_PEAK_DIST, returnDict=False):
+    """
+    Steps 2 and 3 of peaks() given the local maxima pk, their values yp and the spectrum y (or at least
+    its first len(yp) points)
+    """
+    pk = np.asarray(pk)
+    yp = np.asarray(yp)
+    if len(pk) == 0:
+        big = pk
+    else:
+        significant = yp > peakThreshold(yp, y, nsig, m)
+        big = mergeClusters(pk[significant], yp[significant], minPeakDist)
+    if returnDict:
+        return {"big": big, "pk": pk, "yp": yp, "m": m}
+    else:
+        return big
+
+
+def peaks(y, nsig, m=2, returnDict=False, minPeakDist=MIN_PEAK_DIST):
+    """
+    Find the peaks in a vector (spectrum) which lie nsig above the standard deviation of all peaks in
+    the spectrum. See the module docstring
+
+    INPUTS:
+        y - vector in which to locate peaks
+        nsig - number of sigma above the standard deviation of all peaks to search
+        m - maxima more than m median deviations from the median are excluded from the statistics
+        returnDict - also return the local maxima
+        minPeakDist - detections closer than this are merged
+    OUTPUTS:
+        vector holding indices of peak locations in y, or if returnDict a dictionary with keys
+        big - the peak indices, pk - all local maxima, yp - y at pk, m
+    """
+    y = np.asarray(y)
+    pk = localMaxima(y)
+    return selectPeaks(pk, y[pk], y, nsig, m, minPeakDist, returnDict)
+
+
+class PeakStream(object):
+    """
+    peaks() of a spectrum that arrives in chunks
+
+    Usage:
+        stream = PeakStream()
+        for chunk in chunks:
+            stream.update(chunk)
+        big = stream.peaks(nsig)  # same as peaks(np.concatenate(chunks), nsig)
+
+    A copy of the chunks is kept because the threshold statistics of peaks() are taken over the first
+    points of the spectrum, see the module docstring.
+    """
+    def __init__(self):
+        self.n = 0  # number of points seen
+        self._chunks = []
+        self._pk = []
+        self._yp = []
+        self._head = np.zeros(0)  # first two points
+        self._tail = np.zeros(0)  # last two points
+
+    def update(self, chunk):
+        """
+        Add the next chunk of the spectrum. Every point with both neighbors seen so far is classified
+        """
+        chunk = np.array(chunk, dtype=float).ravel()  # a copy, the caller may reuse its buffer
+        if len(chunk) == 0:
+            return
+        self._chunks.append(chunk)
+        y = np.concatenate((self._tail, chunk))
+        offset = self.n - len(self._tail)  # index in the spectrum of y[0]
+        interior = np.flatnonzero((y[1:-1] > y[2:]) & (y[1:-1] > y[:-2])) + 1
+        self._pk.append(interior + offset)
+        self._yp.append(y[interior])
+        if len(self._head) < 2:
+            self._head = np.concatenate((self._head, chunk[:2 - len(self._head)]))
+        self._tail = y[-2:]
+        self.n += len(chunk)
+
+    def localMaxima(self):
+        """
+        All the local maxima seen so far and their values, including the first and last points which
+        wrap around (as in localMaxima())
+        """
+        pk = np.concatenate(self._pk + [np.zeros(0, dtype=int)]).astype(int)
+        yp = np.concatenate(self._yp + [np.zeros(0)])
+        if self.n == 0:
+            return pk, yp
+        first, last = self._head[0], self._tail[-1]
+        if first > self._head[-1] and first > last:  # neighbors of point 0 are point 1 and the last point
+            pk, yp = np.append(0, pk), np.append(first, yp)
+        if self.n > 1 and last > self._tail[0] and last > first:  # and of the last point, n-2 and point 0
+            pk, yp = np.append(pk, self.n - 1), np.append(yp, last)
+        return pk, yp
+
+    def peaks(self, nsig, m=2, returnDict=False, minPeakDist=MIN_PEAK_DIST):
+        """
+        peaks() of everything seen so far. See peaks() for the arguments
+        """
+        pk, yp = self.localMaxima()
+        y = np.concatenate(self._chunks + [np.zeros(0)])[:len(yp)]
+        return selectPeaks(pk, yp, y, nsig, m, minPeakDist, returnDict)
+
+
+def thresholdRuns(values, thresh):
+    """
+    Group the points of values below thresh into runs of consecutive points
+
+    OUTPUTS:
+        starts, stops - the points of run i are values[starts[i]:stops[i]]
+    """
+    below = np.flatnonzero(np.asarray(values) < thresh)
+    if len(below) == 0:
+        return below, below
+    breaks = np.flatnonzero(np.diff(below) > 1)
+    starts = below[np.concatenate(([0], breaks + 1))]
+    stops = below[np.concatenate((breaks, [len(below) - 1]))] + 1
+    return starts, stops
+
+
+def weightedRunCenters(x, weights, starts, stops):
+    """
+    np.average(x[start:stop], weights=weights[start:stop]) for every run, with np.add.reduceat
+    """
+    x = np.asarray(x, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+    if len(starts) == 0:
+        return np.zeros(0)
+    idx = np.ravel(np.column_stack((starts, stops)))
+    # sums over [start, stop) are the even elements of reduceat. Pad so stop can be len(x)
+    sumXW = np.add.reduceat(np.append(x * weights, 0), idx)[::2]
+    sumW = np.add.reduceat(np.append(weights, 0), idx)[::2]
+    return sumXW / sumW
@@ -2,6 +2,7 @@ import sys
 
 import matplotlib.pyplot as plt
 import numpy as np
+from mkidreadout.configuration.widesweep import wsformat
 from mkidreadout.configuration.widesweep.digitalWS import DigitalWideSweep
 
 from mkidreadout.channelizer.RoachStateMachine import RoachStateMachine
@@ -63,9 +64,9 @@ def plotWS(widesweepFN, roachNums):
     
     plt.figure()
     for i, rNum in enumerate(roachNums):
-        fn= widesweepFN+str(rNum)+'.txt'
+        fn= wsformat.findWideSweepFile(widesweepFN+str(rNum))
         
-        data=np.loadtxt(fn)
+        data=wsformat.loadWideSweep(fn)
         s21 = np.log10(data[:,1]**2. + data[:,2]**2.)
         freqs = data[:,0]
 
@@ -0,0 +1,137 @@
+"""
+Stitching widesweeps
+
+A widesweep is taken as many segments (one per tone, LO sweep or roach) whose frequency ranges overlap at the edges.
+stitchSegments() merges them into one [nPoints, 3] array of freq, I, Q sorted by frequency:
+    - segments are ordered by their first frequency
+    - where a segment overlaps the end of the previous one, the n overlapping points of the previous segment are
+      dropped and the first n points of this segment get a magnitude that fades linearly from the previous
+      segment's to this one's. The phase of this segment is kept, different tones have unrelated phases
+    - the points are sorted once
+A point at exactly the last frequency of the previous segment counts as overlapping, so two segments that only
+share an endpoint keep one point there. The older stitching loops this replaces kept both.
+This is done for every segment at once. WideSweepStitcher collects the sweeps of several roaches as they finish and
+writes the stitched feedline (or array) to a single memory mapped widesweep file (see wsformat) that WideAna,
+wsfitml etc. load directly.
+
+Usage:
+    stitcher = WideSweepStitcher('digWS_stitched.npy')
+    stitcher.add(220, freqs, I, Q)  # [nTones, nSteps] arrays
+    stitcher.stitch()
+    stitcher.add(221, freqs2, I2, Q2)
+    data = stitcher.stitch()  # memmap [nPoints, 3]
+"""
+import numpy as np
+
+from mkidreadout.configuration.widesweep import wsformat
+
+
+def segmentLengths(freqs):
+    """ Lengths of the runs of increasing frequency in freqs, ie. tone sweeps raveled back to back """
+    breaks = np.flatnonzero(np.diff(freqs) < 0) + 1
+    return np.diff(np.concatenate(([0], breaks, [len(freqs)])))
+
+
+def stitchSegments(freqs, I, Q, segLens=None):
+    """
+    Merge overlapping sweep segments into one sweep. See the module docstring
+
+    INPUTS:
+        freqs, I, Q - [nSegments, nSteps] arrays with one segment per row, or 1d arrays of segments back to back.
+                      The freqs of each segment must increase
+        segLens - the length of each segment of 1d arrays. By default they're split where freqs decrease
+    OUTPUTS:
+        stitched - [nPoints, 3] array of freq, I, Q. A shared endpoint of two segments appears once
+    """
+    freqs = np.asarray(freqs, dtype=float)
+    I = np.asarray(I, dtype=float).ravel()
+    Q = np.asarray(Q, dtype=float).ravel()
+    if freqs.ndim == 2:
+        segLens = np.full(freqs.shape[0], freqs.shape[1], dtype=int)
+    elif segLens is None:
+        segLens = segmentLengths(freqs)
+    freqs = freqs.ravel()
+    segLens = np.asarray(segLens, dtype=int)
+    segLens = segLens[segLens > 0]
+    nSegs = len(segLens)
+    if nSegs == 0:
+        return np.zeros((0, 3))
+
+    # segment of each point, and segments (by rank) in order of their first freq
+    starts = np.concatenate(([0], np.cumsum(segLens)[:-1]))
+    order = np.argsort(freqs[starts], kind='mergesort')
+    rank = np.empty(nSegs, dtype=int)
+    rank[order] = np.arange(nSegs)
+    pointRank = np.repeat(rank, segLens)
+    pos = np.arange(len(freqs)) - np.repeat(starts, segLens)  # index of each point in its segment
+    rankStarts = starts[order]
+    rankLens = segLens[order]
+    rankLast = freqs[rankStarts + rankLens - 1]
+
+    # points overlapping the previous segment, limited to the length of the previous segment
+    prevLast = np.concatenate(([-np.inf], rankLast[:-1]))
+    nOverlap = np.bincount(pointRank, weights=freqs <= prevLast[pointRank], minlength=nSegs).astype(int)
+    nOverlap[1:] = np.minimum(nOverlap[1:], rankLens[:-1])
+
+    mags = np.sqrt(I**2 + Q**2)
+    fade = np.flatnonzero(pos < nOverlap[pointRank])
+    fadeRank = pointRank[fade]
+    partner = rankStarts[fadeRank - 1] + rankLens[fadeRank - 1] - nOverlap[fadeRank] + pos[fade]
+    weight = pos[fade] / nOverlap[fadeRank].astype(float)
+    # when overlaps are more than half a segment, a partner can itself be faded with the segment before it. Fading
+    # from the faded magnitude chains through the segments in order, the loop runs once per link in the longest chain
+    fadedMags = mags.copy()
+    for _ in range(nSegs):
+        fadeMags = (1 - weight) * fadedMags[partner] + weight * mags[fade]
+        if np.array_equal(fadeMags, fadedMags[fade]):
+            break
+        fadedMags[fade] = fadeMags
+    nonzero = mags[fade] > 0  # points with no phase get the faded magnitude as I
+    scale = fadeMags / np.where(nonzero, mags[fade], 1)
+    I = I.copy()
+    Q = Q.copy()
+    I[fade] = np.where(nonzero, I[fade] * scale, fadeMags)
+    Q[fade] = np.where(nonzero, Q[fade] * scale, 0)
+
+    # drop the points of each segment that the next one overlaps and sort
+    nNext = np.append(nOverlap[1:], 0)
+    keep = np.flatnonzero(pos < (rankLens - nNext)[pointRank])
+    keep = keep[np.argsort(freqs[keep], kind='mergesort')]
+    return np.column_stack((freqs[keep], I[keep], Q[keep]))
+
+
+class WideSweepStitcher(object):
+    """
+    Stitch the sweeps of several roaches into one widesweep as they come in
+
+    INPUTS:
+        fileName - if given, stitch() writes the result here (see wsformat) and returns it memory mapped
+        text - passed on to wsformat.saveWideSweep()
+    """
+    def __init__(self, fileName=None, text=None):
+        self.fileName = fileName
+        self.text = text
+        self.sweeps = {}
+
+    def add(self, key, freqs, I, Q, segLens=None):
+        """
+        Add the sweep of key (ie. a roach number), replacing any sweep already added for key. The arguments are the
+        same as stitchSegments()
+        """
+        freqs = np.asarray(freqs, dtype=float)
+        if freqs.ndim == 2:
+            segLens = np.full(freqs.shape[0], freqs.shape[1], dtype=int)
+        elif segLens is None:
+            segLens = segmentLengths(freqs)
+        self.sweeps[key] = (freqs.ravel(), np.ravel(I), np.ravel(Q), np.asarray(segLens, dtype=int))
+
+    def stitch(self):
+        """ Stitch every sweep added so far. Returns the [nPoints, 3] freq, I, Q array """
+        keys = sorted(self.sweeps)
+        freqs, I, Q, segLens = [np.concatenate([self.sweeps[k][i] for k in keys]) for i in range(4)]
+        stitched = stitchSegments(freqs, I, Q, segLens)
+        if self.fileName is None:
+            return stitched
+        wsformat.saveWideSweep(self.fileName, stitched[:, 0], stitched[:, 1], stitched[:, 2],
+                               header='Stitched widesweep: ' + ', '.join(str(k) for k in keys), text=self.text)
+        return wsformat.loadWideSweep(self.fileName)
@@ -0,0 +1,139 @@
+"""
+On disk store for sweeps taken one block at a time
+
+takePowerSweep() takes a power sweep one (attenuation, LO sweep) block at a time. A SweepStore is a directory of
+memory mapped .npy files with the same layout FreqSweep.savePowerSweep() uses:
+    I, Q - [nAttens, nSweeps*nTones, nSteps]
+    freqs - [nSweeps*nTones, nSteps] Hz
+    atten - [nAttens] dB
+    done - [nAttens, nSweeps] set once a block's data is flushed to disk
+so
+    - nothing but the current block is held in memory
+    - a crash or abort only loses the block being taken
+    - a resumed sweep skips the blocks that are done
+    - readers can use the attenuations that are complete while the sweep is still running (loadSweepStore())
+Once the finished sweep is saved to its output file markSaved() leaves a 'saved' file in the store, so resuming
+a finished sweep doesn't save it again
+"""
+import os
+import shutil
+
+import numpy as np
+
+from mkidcore.corelog import getLogger
+
+STORE_FILES = ('I', 'Q', 'freqs', 'atten', 'done')
+SAVED_FILE = 'saved'
+
+
+def storeName(fileName):
+    """ The store directory used while taking the sweep that ends up in fileName """
+    return os.path.splitext(fileName)[0] + '_blocks'
+
+
+class SweepStore(object):
+    def __init__(self, path, mode='r'):
+        """
+        Open an existing store
+
+        INPUTS:
+            path - store directory
+            mode - 'r' to read, 'r+' to add blocks
+        """
+        self.path = path
+        for name in STORE_FILES:
+            setattr(self, name, np.load(os.path.join(path, name + '.npy'), mmap_mode=mode))
+        self.nAttens, self.nSweeps = self.done.shape
+        self.nTones = self.I.shape[1] // self.nSweeps
+        self.nSteps = self.I.shape[2]
+
+    @classmethod
+    def create(cls, path, attens, nTones, nSweeps, nSteps):
+        """ Make a new, empty store at path, replacing any store already there """
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        attens = np.asarray(attens, dtype=float)
+        shapes = {'I': (len(attens), nSweeps * nTones, nSteps), 'Q': (len(attens), nSweeps * nTones, nSteps),
+                  'freqs': (nSweeps * nTones, nSteps), 'atten': attens.shape, 'done': (len(attens), nSweeps)}
+        for name in STORE_FILES:
+            dtype = bool if name == 'done' else np.float64
+            data = np.lib.format.open_memmap(os.path.join(path, name + '.npy'), mode='w+', dtype=dtype,
+                                             shape=shapes[name])
+            if name == 'atten':
+                data[:] = attens
+            elif name != 'done':
+                data[:] = np.nan
+            data.flush()
+            del data
+        return cls(path, mode='r+')
+
+    @classmethod
+    def openOrCreate(cls, path, attens, nTones, nSweeps, nSteps, resume=False):
+        """
+        The store at path if resuming and it was made for the same sweep, otherwise a new one. Raises a ValueError
+        rather than replace a store made for a different sweep when resuming
+
+        nSteps may be None if it isn't known yet. Then it isn't checked and None is returned instead of a new store
+        """
+        if resume and os.path.isdir(path):
+            store = cls(path, mode='r+')
+            if (np.array_equal(store.atten, np.asarray(attens, dtype=float)) and
+                    (store.nTones, store.nSweeps) == (nTones, nSweeps) and nSteps in (None, store.nSteps)):
+                getLogger(__name__).info('Resuming {}: {} of {} blocks done'.format(path, store.done.sum(),
+                                                                                   store.done.size))
+                return store
+            raise ValueError('{} is from a different sweep. Move it or start over with resume=False'.format(path))
+        if nSteps is None:
+            return None
+        return cls.create(path, attens, nTones, nSweeps, nSteps)
+
+    def isDone(self, iAtten, iSweep=None):
+        """ If block (iAtten, iSweep) is done. Without iSweep, if every sweep at iAtten is """
+        if iSweep is None:
+            return self.done[iAtten].all()
+        return self.done[iAtten, iSweep]
+
+    @property
+    def complete(self):
+        return self.done.all()
+
+    def putBlock(self, iAtten, iSweep, I, Q, freqs):
+        """
+        Write the [nTones, nSteps] I, Q and freqs of one block, then mark it done. The data is flushed first so
+        a block is never marked done before its data is on disk
+        """
+        rows = slice(iSweep * self.nTones, (iSweep + 1) * self.nTones)
+        self.I[iAtten, rows] = I
+        self.Q[iAtten, rows] = Q
+        self.freqs[rows] = freqs
+        for data in (self.I, self.Q, self.freqs):
+            data.flush()
+        self.done[iAtten, iSweep] = True
+        self.done.flush()
+
+    @property
+    def saved(self):
+        """ If markSaved() was called after the sweep was complete """
+        return os.path.isfile(os.path.join(self.path, SAVED_FILE))
+
+    def markSaved(self):
+        """ Record that the complete sweep was saved to its output file """
+        open(os.path.join(self.path, SAVED_FILE), 'w').close()
+
+    def completeAttens(self):
+        """ Indices of the attenuations with every sweep done """
+        return np.flatnonzero(self.done.all(axis=1))
+
+
+def loadSweepStore(path):
+    """
+    The complete attenuations of the sweep in store path, which may still be being taken, as a dictionary with the
+    keys of a FreqSweep.savePowerSweep() file (I, Q, freqs, atten). I and Q are memory mapped unless some
+    attenuations aren't done yet
+    """
+    store = SweepStore(path)
+    if store.complete:
+        return {'I': store.I, 'Q': store.Q, 'freqs': store.freqs, 'atten': store.atten}
+    use = store.completeAttens()
+    return {'I': store.I[use], 'Q': store.Q[use], 'freqs': store.freqs, 'atten': store.atten[use]}
@@ -1,6 +1,7 @@
 import numpy as np
 
 from mkidreadout.configuration import sweepdata
+from mkidreadout.configuration.widesweep import stitch, wsformat
 
 
 class WSFitMLData(object):
@@ -21,9 +22,13 @@ class WSFitMLData(object):
         self.effective_atten = []
 
         for fn in self.filenameList:
-            sd = sweepdata.FreqSweep(fn)
-            freqs, iVals, qVals = sd.oldwsformat(*attenrange).T
-            self.effective_atten.append(sd.oldwsformat_effective_atten(*attenrange))
+            if fn.endswith('.npz'):
+                sd = sweepdata.FreqSweep(fn)
+                freqs, iVals, qVals = sd.oldwsformat(*attenrange).T
+                self.effective_atten.append(sd.oldwsformat_effective_atten(*attenrange))
+            else:  # an already stitched widesweep file
+                freqs, iVals, qVals = wsformat.loadWideSweep(fn).T
+                self.effective_atten.append(float(wsformat.loadHeader(fn).get('Res atten', np.nan)))
             self.boundaryInds = np.append(self.boundaryInds, len(self.freqs))
             self.freqs = np.append(self.freqs, freqs)
             self.iVals = np.append(self.iVals, iVals)
@@ -60,30 +65,19 @@ class WSFitMLData(object):
                 self.allPeakLocs = np.append(self.allPeakLocs, peakLocs)
     
     def stitchDigitalData(self):
-        deltas = np.diff(self.freqs)
-        boundaryInds = np.where(deltas<0)[0]
-        boundaryDeltas = -deltas[boundaryInds]
-        nOverlapPoints = (boundaryDeltas/self.freqStep).astype(int) + 1
-        boundaryInds = boundaryInds + 1
-
-        for i in range(len(boundaryInds)):
-            lfMags = self.mags[boundaryInds[i] - nOverlapPoints[i] : boundaryInds[i]]
-            hfMags = self.mags[boundaryInds[i] : boundaryInds[i] + nOverlapPoints[i]]
-            hfWeights = np.linspace(0, 1, num=nOverlapPoints[i], endpoint=False)
-            lfWeights = 1 - hfWeights
-            self.mags[boundaryInds[i] : boundaryInds[i] + nOverlapPoints[i]] = lfWeights*lfMags + hfWeights*hfMags #set mags to average the overlap regions
-            self.mags[boundaryInds[i] - nOverlapPoints[i] : boundaryInds[i]] = np.nan #set one side of overlap to 0
-            self.freqs[boundaryInds[i] - nOverlapPoints[i] : boundaryInds[i]] = np.nan
+        """Stitch the segments (runs of increasing freq) of the sweep together with stitch.stitchSegments()"""
+        stitched = stitch.stitchSegments(self.freqs, self.mags, np.zeros_like(self.mags))
         
         # stitching I/Q data not yet implemented so get rid of it for now
         self.iVals = None
         self.qVals = None
 
-        self.mags = self.mags[~np.isnan(self.mags)]
+        self.mags = stitched[:, 1]
         self.magsdb = 20*np.log10(self.mags)
-        self.freqs = self.freqs[~np.isnan(self.freqs)]
+        self.freqs = stitched[:, 0]
     
-    def saveData(self, fn):
+    def saveData(self, fn, text=None):
+        """ Save as a widesweep file, binary unless fn ends in .txt or text is True (see wsformat) """
         iVals = self.iVals
         qVals = self.qVals
 
@@ -91,5 +85,5 @@ class WSFitMLData(object):
             iVals = self.mags
             qVals = np.zeros(len(iVals))
 
-        np.savetxt(fn, np.transpose([self.freqs, iVals, qVals]), fmt='%0.9f %0.5f %0.5f')
+        wsformat.saveWideSweep(fn, self.freqs, iVals, qVals, text=text, fmt='%0.9f %0.5f %0.5f')
 
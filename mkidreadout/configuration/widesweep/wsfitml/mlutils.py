@@ -2,6 +2,7 @@ from math import fabs
 
 import numpy as np
 from matplotlib import pylab as plt
+from mkidreadout.configuration.widesweep import wsformat
 from mkidreadout.configuration.widesweep.wsfitml.params import *
 from scipy.interpolate import UnivariateSpline
 
@@ -16,7 +17,7 @@ def load_raw_wide_sweep(WideSweepFile, span=-1):
     if span ==-1:
         span=[0,-1]
     print 'loading raw widesweep data from %s' % WideSweepFile
-    data = np.loadtxt(WideSweepFile, skiprows=3)
+    data = wsformat.loadWideSweep(WideSweepFile)
 
     freqs = data[span[0]:span[1],0]
     Is = data[span[0]:span[1],1]
@@ -51,7 +52,15 @@ def calc_mag(Is, Qs):
     return mag
 
 def find_local_min(mag,center,width =10):
-    minima = np.argmin(mag[center-width:center+width]) + center-width
+    """
+    Index of the minimum of mag in the 2*width points around center. center may be an array, in which case
+    all the windows are searched at once. Windows that would run off either end of mag are moved inside it
+    """
+    mag = np.asarray(mag)
+    width = min(width, len(mag)//2)
+    starts = np.clip(np.asarray(center) - width, 0, len(mag) - 2*width)
+    windows = starts[..., np.newaxis] + np.arange(2*width)
+    minima = np.argmin(mag[windows], axis=-1) + starts
     return minima
 
 def check_close(array, value, atol=5):
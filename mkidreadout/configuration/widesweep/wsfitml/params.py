@@ -13,6 +13,8 @@ baseFile = ('.').join(rawsweepfile.split('.')[:-1])
 mlFile = datadir + baseFile + '-ml.txt'
 print mlFile
 splineS_factor = 0.01
+fit_maxfev = 1000   # max function evaluations of each scraps fit in scfit
+fit_collision_residual = 10000   # refit as two resonators above this residual
 
 train_raw_sweep_files = ['Faceless_FL2.txt']#,'Faceless_FL3.txt','Faceless_FL4.txt']#'Faceless_FL1.txt',
 train_man_peak_files = ['Faceless_FL2-freqs-all.txt']#, 'Faceless_FL3-freqs-all.txt', 'Faceless_FL4-freqs-all.txt']# 'Faceless_FL1-freqs-all.txt'
@@ -7,6 +7,7 @@ import scraps as scr
 from matplotlib import pylab as plt
 
 import mlutils as ws
+from mkidreadout.configuration.Analysis.fitservice import FitCache, fitWindows
 # from params import fspan, wind_width, end_score, datadir, rawsweepfile, manpeakfile, fitpeakfile, splineS_factor
 from mkidreadout.configuration.widesweep.wsfitml.params import *
 
@@ -15,7 +16,7 @@ np.set_printoptions(threshold=np.nan)
 print 'time to run:\t',
 print datetime.now() - startTime
 
-def fitres(data):
+def fitres(data, maxfev=fit_maxfev, collisionResidual=fit_collision_residual):
     fileDataDicts=[]
 
     pwr = -60
@@ -33,11 +34,11 @@ def fitres(data):
 
     for res in resList:
         res.load_params(scr.cmplxIQ_params)
-        kwargs={'maxfev':1000}
+        kwargs={'maxfev':maxfev}
         res.do_lmfit(scr.cmplxIQ_fit, **kwargs)
         residual = sum(res.residualI**2+res.residualQ**2)
         
-        if residual > 10000:
+        if residual > collisionResidual:
             'It looks like theres two peaks'
             res.load_params(scr.cmplxIQ_params_cols)
             # kwargs={'maxfev':2000}
@@ -110,23 +111,30 @@ def remove_slice(freqs,continuum, Is,Qs,center,width, extra_reach=20):
     return freqs,continuum, Is,Qs
 
 def getPeakIndx(resList,freqs_orig, mag_orig):
+    return peakIndxFromFreqs(fitFreqs(resList), freqs_orig, mag_orig)
+
+def fitFreqs(resList):
     res = resList[0]
-    freqs_orig = np.around(freqs_orig, decimals=5)
+    f0s = [res.lmfit_vals[res.lmfit_labels.index('f0')]]
+    if len(res.lmfit_vals) > 11:
+        f0s.append(res.lmfit_vals[res.lmfit_labels.index('f02')])
+    return f0s
 
-    f0_ind = res.lmfit_labels.index('f0')
-    center1 = np.around(res.lmfit_vals[f0_ind], decimals=5)
-    center1 = ws.find_nearest(freqs_orig,center1)
-    center1 = ws.find_local_min(mag_orig,center1)
+def fitPeakFreqs(freqs, Is, Qs, **fitParams):
+    """fitservice worker: fit one window and return the fitted resonance frequencies (one, or two if a
+    collision fit was needed). fitParams are passed on to fitres"""
+    return fitFreqs(fitres([freqs, Is, Qs], **fitParams))
 
-    if len(res.lmfit_vals) > 11:
-        f02_ind = res.lmfit_labels.index('f02')
-        center2 = np.around(res.lmfit_vals[f02_ind], decimals=5)
-        center2 = ws.find_nearest(freqs_orig,center2)
-        center2 = ws.find_local_min(mag_orig,center2)
+def peakIndxFromFreqs(f0s, freqs_orig, mag_orig):
+    freqs_orig = np.around(freqs_orig, decimals=5)
 
-        return np.asarray([center1, center2])
+    nearest = [ws.find_nearest(freqs_orig, np.around(f0, decimals=5)) for f0 in f0s]
+    centers = ws.find_local_min(mag_orig, np.asarray(nearest))
+
+    if len(centers) > 1:
+        return np.asarray(centers)
     else:
-        return center1
+        return centers[0]
 
 # def reduce_to_span(data, span=-1):
 #     if span ==-1:
@@ -136,7 +144,12 @@ def getPeakIndx(resList,freqs_orig, mag_orig):
 #
 #     return data
 
-def find_peaks(data, savefile):
+def find_peaks(data, savefile, nProcesses=None, cacheFile=None):
+    """
+    Pick the deepest dip, cut a window around it out of the sweep and repeat until no dip is deeper than
+    end_score. Which windows are cut doesn't depend on the fits, so the windows are all chosen first
+    and then fit together across a process pool (see fitservice.fitWindows), cached in cacheFile
+    """
     startTime = datetime.now()
 
     freqs, Is, Qs, mag, continuum = data
@@ -146,58 +159,39 @@ def find_peaks(data, savefile):
 
     mag_adj = mag-continuum
 
-    peaks = []
+    windows = []
     end_criteria=False
     while not end_criteria:
         if0 = np.argmin(mag_adj)
 
-        newfreqs, newIs, newQs = getWindowVals(freqs,Is,Qs,if0,wind_width)
-
-        # plt.plot(mag_adj)
-        # plt.show()
-
-        print 'if0', if0, freqs[if0]
-        resList = fitres([newfreqs, newIs, newQs])
-        # plotResList(resList)
+        windows.append(getWindowVals(freqs,Is,Qs,if0,wind_width))
 
-        peak_locs = getPeakIndx(resList, freqs_orig, mag_orig)
-        print peak_locs, start_ind
-
-        peak_locs = peak_locs + start_ind
-        print peak_locs, type(peak_locs)
-        if type(peak_locs)!=np.int64:
-            for p in range(2):
-                peaks.append(peak_locs[p])
-        else:
-            peaks.append(peak_locs)
-
-        print peaks
-        np.savetxt(savefile, peaks, fmt='%i', delimiter=',')
-
-        # plt.plot(mag_adj)
-        # plt.show()
         freqs, continuum, Is, Qs = remove_slice(freqs,continuum, Is,Qs,if0,wind_width)
 
-        # Is, Qs = smooth_local(continuum, Is, Qs, if0)
-
         mag = ws.calc_mag(Is, Qs)
 
         mag_adj = mag-continuum
-        # plt.plot(mag_adj)
-        # plt.show()
-
-        # av_mag_adj = -1*np.median(np.sqrt(abs(mag_adj)))
 
-        sys.stdout.write("peaks found: %i\nadjusted depth: %f\t end point: %f\n" % (len(peaks), min(mag_adj), end_score))
+        sys.stdout.write("windows found: %i\nadjusted depth: %f\t end point: %f\n" % (len(windows), min(mag_adj), end_score))
         sys.stdout.flush()
 
         end_criteria = min(mag_adj) > end_score
 
+    cache = FitCache(cacheFile) if cacheFile else None
+    fits = fitWindows(fitPeakFreqs, windows, nProcesses=nProcesses, cache=cache,
+                      fitParams={'maxfev': fit_maxfev, 'collisionResidual': fit_collision_residual})
+
+    peaks = []
+    for f0s in fits:
+        if f0s is None:
+            continue
+        peak_locs = np.atleast_1d(peakIndxFromFreqs(f0s, freqs_orig, mag_orig)) + start_ind
+        peaks.extend(peak_locs)
+    np.savetxt(savefile, peaks, fmt='%i', delimiter=',')
+
     # remove duplicates
     peaks =list(set(peaks))
 
-    # plt.plot(mag_adj)
-
     print 'time to run:\t',
     print datetime.now() - startTime
 
@@ -210,7 +204,8 @@ def get_peaks(data):
     if path.isfile(datadir+fitpeakfile):
         peaks = ws.load_peaks(datadir+fitpeakfile)
     else:
-        peaks = find_peaks(data, savefile=datadir+fitpeakfile)
+        peaks = find_peaks(data, savefile=datadir+fitpeakfile,
+                           cacheFile=datadir+path.splitext(fitpeakfile)[0]+'-cache.pkl')
 
     return peaks
 
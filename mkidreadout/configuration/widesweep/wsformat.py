@@ -0,0 +1,119 @@
+"""
+Reading and writing widesweep files
+
+A widesweep is an [nPoints, 3] array of frequency, I and Q. The binary format is a float64 .npy file, which
+np.load memory maps so a large sweep opens immediately and is only read from disk as it's used. The text
+header of the old format is written next to it in headerFileName(). The text format (np.savetxt with an
+optional '#' header) can still be read and written.
+
+Usage:
+    saveWideSweep('digWS_r220.npy', freqs, I, Q, header='Roach#: 220')
+    data = loadWideSweep('digWS_r220.npy')  # memmap, data[:,0] are the freqs
+    loadHeader('digWS_r220.npy')['Roach#']
+"""
+import os
+
+import numpy as np
+
+BINARY_EXT = '.npy'
+TEXT_EXT = '.txt'
+TEXT_FMT = '%.9f %.9f %.9f'
+
+
+def isBinary(fileName):
+    return os.path.splitext(fileName)[1].lower() == BINARY_EXT
+
+
+def headerFileName(fileName):
+    """ The text header of binary widesweep fileName """
+    return os.path.splitext(fileName)[0] + '_header.txt'
+
+
+def findWideSweepFile(baseName):
+    """ baseName with the binary extension if that file exists, otherwise with the text extension """
+    if os.path.isfile(baseName + BINARY_EXT):
+        return baseName + BINARY_EXT
+    return baseName + TEXT_EXT
+
+
+def saveWideSweep(fileName, freqs, I, Q, header='', text=None, fmt=TEXT_FMT):
+    """
+    Write a widesweep
+
+    INPUTS:
+        fileName - output file
+        freqs, I, Q - 1d arrays of the same length
+        header - text header. Lines are '#' comments in a text file, or go in headerFileName() for a binary one
+        text - If True write text with np.savetxt, if False a binary .npy file. None decides from the
+               extension of fileName
+        fmt - np.savetxt format for text files
+
+    The sweep is written to a temporary file that is renamed to fileName once it's complete, so fileName only
+    exists when it holds a whole sweep (digitalsweep resumes on that) and readers of an older version of it, like
+    a memory map, aren't affected
+    """
+    if text is None:
+        text = not isBinary(fileName)
+    tmpName = os.path.join(os.path.dirname(fileName), '.tmp_' + os.path.basename(fileName))  # keeps the extension
+    try:
+        if text:
+            np.savetxt(tmpName, np.transpose([freqs, I, Q]), fmt=fmt, header=header)
+        else:
+            data = np.lib.format.open_memmap(tmpName, mode='w+', dtype=np.float64, shape=(len(freqs), 3))
+            data[:, 0] = freqs
+            data[:, 1] = I
+            data[:, 2] = Q
+            data.flush()
+            del data
+            if header:
+                with open(headerFileName(fileName), 'w') as f:
+                    f.write(header + '\n')
+        os.rename(tmpName, fileName)
+    except:
+        if os.path.exists(tmpName):
+            os.remove(tmpName)
+        raise
+
+
+def loadWideSweep(fileName, mmap=True):
+    """
+    Read a widesweep written by saveWideSweep() (or the older text formats, including ones with an
+    uncommented 3 line header)
+
+    INPUTS:
+        fileName - binary or text widesweep
+        mmap - memory map binary files read only instead of reading them into memory
+    OUTPUTS:
+        data - [nPoints, 3] array of freq, I, Q
+    """
+    if isBinary(fileName):
+        return np.load(fileName, mmap_mode='r' if mmap else None)
+    try:
+        return np.loadtxt(fileName)
+    except ValueError:
+        return np.loadtxt(fileName, skiprows=3)
+
+
+def loadHeader(fileName):
+    """
+    The 'key: value' lines of the header of a widesweep file as a dictionary of strings. Empty if there
+    isn't one
+    """
+    if isBinary(fileName):
+        if not os.path.isfile(headerFileName(fileName)):
+            return {}
+        with open(headerFileName(fileName)) as f:
+            lines = f.readlines()
+    else:
+        lines = []
+        with open(fileName) as f:
+            for line in f:
+                if not line.startswith('#'):
+                    break
+                lines.append(line[1:])
+    header = {}
+    for line in lines:
+        key, sep, value = line.partition(':')
+        if sep:
+            header[key.strip()] = value.strip()
+    return header
@@ -22,6 +22,7 @@ import argparse
 import json
 import os
 import sys
+import threading
 import time
 from datetime import datetime
 from functools import partial
@@ -38,11 +39,12 @@ import mkidreadout.config
 import mkidreadout.configuration.sweepdata as sweepdata
 import mkidreadout.hardware.hsfw
 from mkidcore.corelog import create_log, getLogger
-from mkidcore.fits import CalFactory, combineHDU, summarize
+from mkidcore.fits import CalFactory, summarize
 from mkidcore.objects import Beammap
 from mkidreadout.channelizer.Roach2Controls import Roach2Controls
 from mkidreadout.hardware.lasercontrol import LaserControl
 from mkidreadout.hardware.telescope import Palomar, Subaru
+from mkidreadout.readout.fitswriter import FitsWriter
 from mkidreadout.readout.guiwindows import DitherWindow, PixelHistogramWindow, PixelTimestreamWindow, TelescopeWindow
 from mkidreadout.readout.packetmaster import Packetmaster
 from mkidreadout.utils.utils import interpolateImage
@@ -65,10 +67,162 @@ def build_hbox(things, stretch=True):
     return h
 
 
+class ImageHistory(object):
+    """
+    Fixed capacity ring buffer of the last N photon count images
+
+    The frames live in a single preallocated [N, nBands, nRows, nCols] array along with their start times and
+    exposure times. Plain images are stored as a single band, wavelength binned cubes keep all their bands so
+    the display can switch or sum bands without integrating again. Appending overwrites the oldest slot so
+    it's O(1) and nothing is reallocated while observing. The queries only gather the requested pixels so the
+    timestream/histogram windows and the pixel labels never have to stack the whole image list.
+
+    Wherever a bands argument is taken it may be None (all bands), an int, a slice or a list of band indices.
+    """
+
+    def __init__(self, capacity=600, shape=None, dtype=np.float32, maxBytes=512*2**20):
+        """
+        INPUTS:
+            capacity - maximum number of frames to keep
+            shape - (nRows, nCols) or (nBands, nRows, nCols) of the images. If None it's set by the first
+                    appended image
+            dtype - storage type of the buffer
+            maxBytes - the capacity is reduced so the buffer never takes more memory than this
+        """
+        self.maxCapacity = int(max(capacity, 1))
+        self.maxBytes = maxBytes
+        self.capacity = self.maxCapacity
+        self.dtype = dtype
+        self.frames = None
+        self.timestamps = np.zeros(self.capacity)
+        self.exptimes = np.zeros(self.capacity)
+        self._next = 0  # slot the next frame is written to
+        self._count = 0  # number of valid frames
+        if shape is not None:
+            self._allocate(shape)
+
+    def _allocate(self, shape):
+        shape = tuple(shape) if len(shape) == 3 else (1,) + tuple(shape)
+        frameBytes = np.dtype(self.dtype).itemsize * int(np.prod(shape))
+        self.capacity = int(max(min(self.maxCapacity, self.maxBytes // frameBytes), 1))
+        self.frames = np.zeros((self.capacity,) + shape, dtype=self.dtype)
+        self.timestamps = np.zeros(self.capacity)
+        self.exptimes = np.zeros(self.capacity)
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def shape(self):
+        """ (nBands, nRows, nCols) of the stored frames """
+        return None if self.frames is None else self.frames.shape[1:]
+
+    @property
+    def nBands(self):
+        return 0 if self.frames is None else self.frames.shape[1]
+
+    def bandIndices(self, bands=None):
+        """ Array of the band indices selected by bands """
+        allBands = np.arange(self.nBands)
+        return allBands if bands is None else np.atleast_1d(allBands[bands])
+
+    def clear(self):
+        self._next = 0
+        self._count = 0
+
+    def append(self, image, timestamp=None, exptime=1.):
+        """
+        Copy an image into the oldest slot. The buffer is (re)allocated if the image shape changes
+
+        INPUTS:
+            image - 2D array of photon counts or a 3D [nBands, nRows, nCols] wavelength cube
+            timestamp - unix time of the start of the exposure. Defaults to now
+            exptime - exposure time of the image in seconds
+        """
+        image = np.asarray(image)
+        if image.ndim == 2:
+            image = image[np.newaxis]
+        if self.frames is None or image.shape != self.shape:
+            self._allocate(image.shape)
+        self.frames[self._next] = image
+        self.timestamps[self._next] = time.time() if timestamp is None else timestamp
+        self.exptimes[self._next] = exptime
+        self._next = (self._next + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def _slots(self, nFrames=None):
+        """ Buffer indices of the last nFrames images, oldest first """
+        if nFrames is None or nFrames > self._count:
+            nFrames = self._count
+        return (np.arange(self._next - nFrames, self._next)) % self.capacity
+
+    def latest(self, bands=None):
+        """ Returns the newest [nBands, nRows, nCols] frame or None. A view (no copy) unless bands is a list """
+        if not self._count:
+            return None
+        frame = self.frames[(self._next - 1) % self.capacity]
+        if bands is None:
+            return frame
+        return frame[bands:bands + 1] if isinstance(bands, int) else frame[bands]
+
+    def times(self, nFrames=None):
+        """ Start times of the last nFrames images, oldest first """
+        return self.timestamps[self._slots(nFrames)]
+
+    def integrationTime(self, nFrames=None):
+        """ Total exposure time of the last nFrames images """
+        return self.exptimes[self._slots(nFrames)].sum()
+
+    def pixelHistory(self, pixelList, nFrames=None, bands=None):
+        """
+        Counts of each pixel in the last nFrames images, summed over the selected bands
+
+        INPUTS:
+            pixelList - [nPix, 2] array of (x, y) pixel coordinates
+            nFrames - number of frames. Default is all of them
+            bands - bands to sum. Default is all of them
+        OUTPUTS:
+            [nFrames, nPix] array, oldest frame first
+        """
+        pixelList = np.asarray(pixelList, dtype=int).reshape(-1, 2)
+        if not self._count or not len(pixelList):
+            return np.zeros((0, len(pixelList)), dtype=self.dtype)
+        slots = self._slots(nFrames)[:, np.newaxis, np.newaxis]
+        bandInds = self.bandIndices(bands)[np.newaxis, np.newaxis, :]
+        y = pixelList[np.newaxis, :, 1, np.newaxis]
+        x = pixelList[np.newaxis, :, 0, np.newaxis]
+        return self.frames[slots, bandInds, y, x].sum(axis=2)
+
+    def pixelSums(self, pixelList, nFrames=None, bands=None):
+        """ Summed counts of the pixels in pixelList for each of the last nFrames images, oldest first """
+        return self.pixelHistory(pixelList, nFrames, bands).sum(axis=1)
+
+    def pixelSum(self, pixelList, nFrames=1, bands=None):
+        """ Total counts of the pixels in pixelList over the last nFrames images """
+        return self.pixelHistory(pixelList, nFrames, bands).sum()
+
+    def mean(self, nFrames=None, bands=None):
+        """ Average image, summed over bands, of the last nFrames images, or None if the buffer is empty """
+        if not self._count:
+            return None
+        bandInds = self.bandIndices(bands)
+        image = np.zeros(self.shape[1:])
+        for slot in self._slots(nFrames):
+            image += self.frames[slot, bandInds].sum(axis=0)
+        return image / len(self._slots(nFrames))
+
+
 class LiveImageFetcher(QtCore.QObject):  # Extends QObject for use with QThreads
     """
     This class fetches images from PacketMaster for the live view and fits files
 
+    A single loop services one or more ImageCubes, each with its own integration time. The thread blocks
+    in ImageCube.wait(), which releases the GIL, on whichever image is due next. In continuous mode
+    packetmaster starts the next integration as soon as one completes so frames follow each other without
+    dead time, otherwise a new integration is started as soon as the previous image has been read.
+
     SIGNALS
         newImage - emits when an image is avaialble
         finished - emits when self.search is set to False
@@ -76,51 +230,113 @@ class LiveImageFetcher(QtCore.QObject):  # Extends QObject for use with QThreads
     newImage = QtCore.pyqtSignal(object)
     finished = QtCore.pyqtSignal()
 
-    def __init__(self, sharedim, inttime=0.1, parent=None):
+    def __init__(self, sharedim, inttime=0.1, continuous=False, parent=None):
         """
         INPUTS:
-            sharedim - ImageCube
-            inttime - the integration time interval
+            sharedim - ImageCube or a list of ImageCubes
+            inttime - the integration time interval, or a list of them, one per ImageCube
+            continuous - integrate back to back instead of starting each integration after a read
             parent - Leave as None so that we can add to new thread
         """
         super(QtCore.QObject, self).__init__(parent)
-        self.imagebuffer = sharedim
-        self.inttime = inttime
+        self.imagebuffers = list(sharedim) if isinstance(sharedim, (list, tuple)) else [sharedim]
+        if not isinstance(inttime, (list, tuple)):
+            inttime = [inttime] * len(self.imagebuffers)
+        self.inttimes = [float(it) for it in inttime]
+        self.continuous = continuous
         self.search = True
+        self._pending = {}  # imagebuffer index: [utc start, time due, deadline] of integrations in progress
+        self._restart = set()
 
-    def update_inttime(self, it):
-        self.inttime = float(it)
+    @property
+    def imagebuffer(self):
+        return self.imagebuffers[0]
+
+    @property
+    def inttime(self):
+        return self.inttimes[0]
+
+    def update_inttime(self, it, index=0):
+        self.inttimes[index] = float(it)
+        self._restart.add(index)
+
+    def _startIntegrations(self):
+        for i, imagebuffer in enumerate(self.imagebuffers):
+            if i in self._pending and i not in self._restart:
+                continue
+            self._restart.discard(i)
+            now = time.time()
+            imagebuffer.startIntegration(integrationTime=self.inttimes[i], continuous=self.continuous)
+            # give up on an image an integration time after it's due, same as waiting a full integration
+            # after sleeping through one
+            self._pending[i] = [now, now + self.inttimes[i], now + 2 * self.inttimes[i]]
+
+    def _waitForImages(self):
+        """ Block (without the GIL) until an image is done or overdue, returns the indices of done images """
+        order = sorted(self._pending, key=lambda i: self._pending[i][1])
+        first = order[0]
+        wake = min([self._pending[first][2]] + [self._pending[i][1] for i in order[1:]])
+        done = []
+        if self.imagebuffers[first].wait(timeout=max(wake - time.time(), 0)):
+            done.append(first)
+        elif time.time() >= self._pending[first][2]:
+            self.imagebuffers[first].cancelIntegration()
+            del self._pending[first]
+            getLogger('Dashboard').debug('Image stream unavailable: no image from {}'.format(
+                self.imagebuffers[first].name))
+        done += [i for i in order[1:] if self.imagebuffers[i].wait(0)]
+        return done
+
+    def _emitImage(self, index):
+        imagebuffer = self.imagebuffers[index]
+        start, due, deadline = self._pending[index]
+        inttime = self.inttimes[index]
+        if self.continuous:
+            self._pending[index] = [due, due + inttime, due + 2 * inttime]
+            while imagebuffer.wait(0):  # only the newest image is kept, skip the ones we fell behind on
+                getLogger('Dashboard').debug('Skipped an image from {}'.format(imagebuffer.name))
+                start, due, deadline = self._pending[index]
+                self._pending[index] = [due, due + inttime, due + 2 * inttime]
+        else:
+            del self._pending[index]
+        data = imagebuffer.readImage()
+        ret = fits.ImageHDU(data=data)
+        ret.header['utcstart'] = datetime.utcfromtimestamp(start).strftime('%Y-%m-%d %H:%M:%S')
+        ret.header['exptime'] = inttime
+        foo = imagebuffer.wavecalID.decode('UTF-8', "backslashreplace")
+        ret.header['wavecal'] = foo
+        ret.header['wmin'] = imagebuffer.wvlStart
+        ret.header['wmax'] = imagebuffer.wvlStop
+        ret.header['shmimage'] = imagebuffer.name
+        if data.ndim == 3:  # wavelength cube, record the bin edges
+            ret.header['nwvlbin'] = data.shape[0]
+            # fits cards can't hold inf, the upper edge of the top edge bin is left out and implied by edgebins
+            ret.header['edgebins'] = bool(imagebuffer.useEdgeBins)
+            for i, edge in enumerate(imagebuffer.wvlBinEdges):
+                if np.isfinite(edge):
+                    ret.header['wbin{}'.format(i)] = edge
+        self.newImage.emit(ret)
 
     def run(self):
         """
-        Infinite loop that keeps checking directory for an image file
-        When it finds an image, it parses it and emits imageComplete signal
-        It only returns files that have timestamps > than the last file's timestamp
+        Infinite loop that keeps integrating images in the shared memory buffers
+        When an image is done it's packaged into an ImageHDU and emitted with the newImage signal
         
         Loop will continue until you set self.search to False. Then it will emit finished signal
-        
-        INPUTS:
-            removeOldFiles - remove .img and .png files after we read them
         """
         self.search = True
+        self._pending = {}
         while self.search:
             try:
-                utc = datetime.utcfromtimestamp(time.time()).strftime('%Y-%m-%d %H:%M:%S')
-                self.imagebuffer.startIntegration(integrationTime=self.inttime)
-                time.sleep(self.inttime) #required as recieveImage holds the GIL with a system call
-                data = self.imagebuffer.receiveImage()
-                ret = fits.ImageHDU(data=data)
-                ret.header['utcstart'] = utc
-                ret.header['exptime'] = self.inttime
-                foo = self.imagebuffer.wavecalID.decode('UTF-8', "backslashreplace")
-                ret.header['wavecal'] = foo
-                ret.header['wmin'] = self.imagebuffer.wvlStart
-                ret.header['wmax'] = self.imagebuffer.wvlStop
-                self.newImage.emit(ret)
+                self._startIntegrations()
+                for i in self._waitForImages():
+                    self._emitImage(i)
             except RuntimeError as e:
                 getLogger('Dashboard').debug('Image stream unavailable: {}'.format(e))
             except Exception:
                 getLogger('Dashboard').error('Problem', exc_info=True)
+        for imagebuffer in self.imagebuffers:
+            imagebuffer.stopIntegration()
         self.finished.emit()
 
 
@@ -129,121 +345,325 @@ class ConvertPhotonsToRGB(QtCore.QObject):
     This class takes 2D arrays of photon counts and converts them into a QImage
     It needs to know how to map photon counts into an RGB color
     Usually just an 8bit grey color [0, 256) but also turns maxxed out pixel red
-    
+
+    A single instance lives in its own thread for the life of the dashboard. Frames are handed over with
+    submit() and the dark, flat and beammap mask are set once with setCalibration(). All the per frame work
+    happens in place in buffers that are only reallocated if the image size changes. The stretch and color
+    packing is a single lookup from (cached) per-count color tables straight into the QImage pixels. Only the newest
+    submitted frame is kept, so if the GUI falls behind stale frames are dropped instead of queued.
+
     SIGNALS
         convertedImage - emits when it's done converting an image
     """
     convertedImage = QtCore.pyqtSignal(object)
+    _frameQueued = QtCore.pyqtSignal()
 
-    def __init__(self, image, minCountCutoff=0, maxCountCutoff=450, stretchMode='log', interpolate=False, makeRed=True,
+    def __init__(self, minCountCutoff=0, maxCountCutoff=450, stretchMode='log', interpolate=False, makeRed=True,
                  parent=None):
         """
         INPUTS:
-            image - 2D numpy array of photon counts with np.nan where beammap failed
             minCountCutoff - anything <= this number of counts will be black
             maxCountCutoff - anything >= this number of counts will be red
             stretchMode - can be log, linear, hist
             interpolate - interpolate over np.nan pixels
+            makeRed - make pixels >= maxCountCutoff red
+            parent - Leave as None so that we can add to new thread
         """
         super(QtCore.QObject, self).__init__(parent)
-        self.image = np.copy(image)
         self.minCountCutoff = minCountCutoff
         self.maxCountCutoff = maxCountCutoff
         self.interpolate = interpolate
         self.makeRed = makeRed
-        self.redPixels = []
         self.stretchMode = stretchMode
+        self.bands = None  # wavelength bands of a cube to sum for display, None for all
+
+        self.dark = None  # float32 dark count rate
+        self.flat = None  # float32 flat weights
+        self.mask = None  # boolean mask of failed beammap pixels
+
+        self.image = None  # float32 calibrated count rate image, the working buffer
+        self._scratch = None
+        self._bad = None
+        self._index = None
+        self._qimages = []
+        self._rgb = []
+        self._rgbIndex = 0
+        self._lutCache = {}  # packed color LUTs for the log and linear stretches
+
+        self._lock = threading.Lock()
+        self._pending = None  # newest frame that hasn't been converted yet
+        self._scheduled = False  # processFrame() is queued in the worker thread
+        self._displaying = False  # the last QImage hasn't been picked up by the GUI yet
+        self.nDropped = 0
+        self._frameQueued.connect(self.processFrame)
+
+    def setCalibration(self, dark=None, flat=None, mask=None):
+        """
+        Precompute the calibration arrays used on every frame
+
+        INPUTS:
+            dark - 2D dark count rate image, [nBands, nRows, nCols] cube or None
+            flat - 2D flat field image, [nBands, nRows, nCols] cube or None
+            mask - 2D boolean array, True where the beammap failed, or None
+        """
+        dark = None if dark is None else np.ascontiguousarray(dark, dtype=np.float32)
+        flat = None if flat is None else np.ascontiguousarray(flat, dtype=np.float32)
+        mask = None if mask is None else np.ascontiguousarray(mask, dtype=bool)
+        with self._lock:
+            self.dark, self.flat, self.mask = dark, flat, mask
+
+    def submit(self, image, exptime=1., **settings):
+        """
+        Hand a new frame to the worker. Called from the GUI thread
+
+        INPUTS:
+            image - 2D numpy array or [nBands, nRows, nCols] cube of photon counts. It isn't copied so don't
+                    modify it afterwards
+            exptime - integration time of the image in seconds
+            settings - any of minCountCutoff, maxCountCutoff, stretchMode, interpolate, makeRed, bands
+        """
+        with self._lock:
+            if self._pending is not None:
+                self.nDropped += 1
+                getLogger('Dashboard').debug('Dropping stale frame. {} dropped so far'.format(self.nDropped))
+            self._pending = (image, exptime, settings)
+            schedule = not (self._scheduled or self._displaying)
+            self._scheduled |= schedule
+        if schedule:
+            self._frameQueued.emit()
+
+    def imageDisplayed(self):
+        """
+        Called by the GUI once it's done with the last convertedImage so the next frame can be converted
+        """
+        with self._lock:
+            self._displaying = False
+            schedule = self._pending is not None and not self._scheduled
+            self._scheduled |= schedule
+        if schedule:
+            self._frameQueued.emit()
+
+    def processFrame(self):
+        """
+        Convert the newest pending frame. Runs in the worker thread
+        """
+        with self._lock:
+            self._scheduled = False
+            if self._pending is None:
+                return
+            image, exptime, settings = self._pending
+            self._pending = None
+            self._displaying = True
+            for k, v in settings.items():
+                setattr(self, k, v)
+            dark, flat, mask = self.dark, self.flat, self.mask
+        try:
+            self.calibrate(image, exptime, dark, flat, mask)
+            self.stretchImage()
+        except Exception:
+            getLogger('Dashboard').error('Problem converting image', exc_info=True)
+            self.imageDisplayed()
+
+    def _allocate(self, shape):
+        self.image = np.zeros(shape, dtype=np.float32)
+        self._scratch = np.zeros(shape, dtype=np.float32)
+        self._bad = np.zeros(shape, dtype=bool)
+        self._index = np.zeros(shape, dtype=np.intp)  # count - minCountCutoff, the LUT index of each pixel
+        self._qimages = []  # two QImages we pack into directly, one may still be in use by the GUI
+        self._rgb = []  # numpy views of the QImage pixel buffers
+        for i in range(2):
+            q_im = QImage(shape[1], shape[0], QImage.Format_RGB32)
+            ptr = q_im.bits()
+            ptr.setsize(q_im.byteCount())
+            self._qimages.append(q_im)
+            self._rgb.append(np.frombuffer(ptr, dtype=np.uint32).reshape(shape))
+
+    def calibrate(self, image, exptime=1., dark=None, flat=None, mask=None):
+        """
+        Turn the photon counts into a dark subtracted, flat fielded count rate in self.image
+
+        Same as CalFactory('avg') on a single image but without any temporaries. Wavelength cubes are
+        calibrated band by band (with a per band dark/flat if they are cubes too) and the bands selected by
+        self.bands are summed.
+
+        INPUTS:
+            image - 2D image or [nBands, nRows, nCols] cube of photon counts
+            exptime - integration time of the image in seconds
+            dark, flat - 2D or matching 3D calibration arrays, or None
+            mask - 2D boolean array of pixels to blank, or None
+        """
+        image = np.asarray(image)
+        if image.ndim == 2:
+            image = image[np.newaxis]
+        if self.image is None or self.image.shape != image.shape[1:]:
+            self._allocate(image.shape[1:])
+        bandInds = np.arange(image.shape[0])
+        if self.bands is not None:
+            bandInds = np.atleast_1d(bandInds[self.bands])
+
+        if not len(bandInds):
+            self.image[:] = 0
+        perBand = lambda cal: cal is not None and cal.ndim == 3 and cal.shape[0] == image.shape[0]
+        for i, b in enumerate(bandInds):
+            out = self.image if i == 0 else self._scratch
+            np.multiply(image[b], 1. / exptime, out=out, casting='unsafe')
+            if perBand(dark):
+                np.subtract(out, dark[b], out=out)
+            if perBand(flat):
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    np.divide(out, flat[b], out=out)
+            if i:
+                self.image += out
+        if dark is not None and dark.ndim == 2:
+            np.subtract(self.image, dark, out=self.image)
+        if flat is not None and flat.ndim == 2:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                np.divide(self.image, flat, out=self.image)
+        if mask is not None:
+            np.copyto(self.image, np.nan, where=mask)
 
     def stretchImage(self):
         """
         map photons to greyscale
+
+        The count rates are rounded to integer counts and clipped to [minCountCutoff, maxCountCutoff] so
+        every stretch is just a 1D lookup table from counts to packed ARGB colors.
         """
-        # first interpolate and find hot pixels
+        # first interpolate
         if self.interpolate:
-            self.image = interpolateImage(self.image)
-        self.image[~np.isfinite(self.image)] = 0  # get rid of np.nan's
+            self.image[:] = interpolateImage(self.image)
+        np.isfinite(self.image, out=self._bad)
+        np.logical_not(self._bad, out=self._bad)
+        np.copyto(self.image, 0, where=self._bad)  # get rid of np.nan's
 
-        self.redPixels = self.image >= self.maxCountCutoff if self.makeRed else []
+        if self.stretchMode == 'histogram equalization':
+            self.minCountCutoff = max(self.minCountCutoff, 1)
+        minCut = int(self.minCountCutoff)
+        maxCut = max(int(self.maxCountCutoff), minCut)
+        np.rint(self.image, out=self.image)
+        self.image.clip(minCut, maxCut, self.image)
+        self.image -= minCut
+        np.copyto(self._index, self.image, casting='unsafe')
 
         if self.stretchMode == 'logarithmic':
-            imageGrey = self.logStretch()
+            minVal = minCut + self._index.min()
+            maxVal = minCut + self._index.max()
+            key = (self.stretchMode, minCut, maxCut, self.makeRed, minVal, maxVal)
+            lut = self._lutCache.get(key)
+            if lut is None:
+                lut = self.packLUT(self.logStretch(minVal, maxVal), maxCut)
         elif self.stretchMode == 'linear':
-            imageGrey = self.linStretch()
+            key = (self.stretchMode, minCut, maxCut, self.makeRed)
+            lut = self._lutCache.get(key)
+            if lut is None:
+                lut = self.packLUT(self.linStretch(), maxCut)
         elif self.stretchMode == 'histogram equalization':
-            imageGrey = self.histEqualization()
+            key = None  # depends on the whole image, never reused
+            lut = self.packLUT(self.histEqualization(), maxCut)
         else:
             raise ValueError('Unknown stretch mode')
 
-        self.makeQPixMap(imageGrey)
+        if key is not None and key not in self._lutCache:
+            if len(self._lutCache) > 64:
+                self._lutCache.clear()
+            self._lutCache[key] = lut
 
-    def logStretch(self):
+        self.makeQPixMap(lut)
+
+    def _counts(self):
+        """ The integer count values [minCountCutoff, maxCountCutoff] that the LUTs are indexed by """
+        minCut = int(self.minCountCutoff)
+        return np.arange(minCut, max(int(self.maxCountCutoff), minCut) + 1, dtype=float)
+
+    def logStretch(self, minVal, maxVal):
         """
         map photon counts to greyscale logarithmically
+
+        INPUTS:
+            minVal, maxVal - min and max counts of the clipped image
+        OUTPUTS:
+            greyscale value for each count in [minCountCutoff, maxCountCutoff]
         """
-        self.image.clip(self.minCountCutoff, self.maxCountCutoff, self.image)
-        maxVal = np.amax(self.image)
-        minVal = np.amin(self.image)
         maxVal = np.amax([minVal + 1, maxVal])
 
         a=10.
-        image2 = 255.*np.log10(a*(self.image-minVal) / (maxVal - minVal) + 1.)/np.log10(a+1.)
+        image2 = 255.*np.log10(a*np.maximum(self._counts()-minVal, 0) / (maxVal - minVal) + 1.)/np.log10(a+1.)
         #image2 = 255. / (np.log10(1 + maxVal - minVal)) * np.log10(1 + self.image - minVal)
         return image2
 
     def linStretch(self):
         """
         map photon count to greyscale linearly (max 255 min 0)
-        """
-        self.image.clip(self.minCountCutoff, self.maxCountCutoff, self.image)
 
+        OUTPUTS:
+            greyscale value for each count in [minCountCutoff, maxCountCutoff]
+        """
         maxVal = self.maxCountCutoff
         minVal = self.minCountCutoff
         maxVal = np.amax([minVal + 1, maxVal])
 
-        image2 = (self.image - minVal) / (1.0 * maxVal - minVal) * 255.
+        image2 = (self._counts() - minVal) / (1.0 * maxVal - minVal) * 255.
         return image2
 
     def histEqualization(self, bins = 256):
         """
         perform a histogram Equalization. This tends to make the contrast better
         
-        if self.logStretch is True the histogram uses logarithmic spaced bins
-        """
-        if self.logStretch:
-            self.minCountCutoff = max(self.minCountCutoff, 1)
+        The histogram uses logarithmic spaced bins. It's built from an integer bincount of the clipped
+        counts so we only ever touch the image once.
 
-        self.image.clip(self.minCountCutoff, self.maxCountCutoff, self.image)
-        maxVal = np.amax(self.image)
+        OUTPUTS:
+            greyscale value for each count in [minCountCutoff, maxCountCutoff]
+        """
+        counts = self._counts()
+        nPerCount = np.bincount(self._index.ravel(), minlength=len(counts))
+        maxVal = counts[np.nonzero(nPerCount)[0][-1]]
 
-        if self.logStretch:
-            bins = np.logspace(np.log10(self.minCountCutoff), np.log10(maxVal), bins)
-        imhist, imbins = np.histogram(self.image.flatten(), bins, density=True)
+        bins = np.logspace(np.log10(self.minCountCutoff), np.log10(maxVal), bins)
+        # same binning as np.histogram: half open bins except the last which includes the right edge
+        inRange = (counts >= bins[0]) & (counts <= bins[-1])
+        binIndex = np.searchsorted(bins, counts[inRange], side='right') - 1
+        binIndex[counts[inRange] == bins[-1]] = len(bins) - 2
+        imhist = np.bincount(binIndex, weights=nPerCount[inRange], minlength=len(bins) - 1)
 
-        cdf = (imhist * np.diff(imbins)).cumsum() * 256
+        cdf = (imhist / max(imhist.sum(), 1)).cumsum() * 256
 
-        image2 = np.interp(self.image.flatten(), imbins[:-1], cdf)
-        image2 = image2.reshape(self.image.shape)
-        image2[self.image <= self.minCountCutoff] = 0
+        image2 = np.interp(counts, bins[:-1], cdf)
+        image2[counts <= self.minCountCutoff] = 0
 
         return image2
 
-    def makeQPixMap(self, image):
+    def packLUT(self, grey, maxCut):
         """
-        This function makes the QImage object
-        
+        Pack a greyscale LUT into RGB32 colors, turning counts >= maxCut red if self.makeRed
+
         INPUTS:
-            image - 2D numpy array of [0,256) grey colors
+            grey - [0,256) grey color for each count in [minCountCutoff, maxCountCutoff]
+            maxCut - the count at or above which pixels are red
         """
-        image2 = image.astype(np.uint32)
-
-        redMask = np.copy(image2)
-        redMask[self.redPixels] = 0
+        grey = np.clip(grey, 0, 255).astype(np.uint32)
+        redMask = grey.copy()
+        if self.makeRed:
+            redMask[self._counts() >= maxCut] = 0
         #           24-32 -> A  16-24 -> R     8-16 -> G      0-8 -> B
-        imageRGB = (255 << 24 | image2 << 16 | redMask << 8 | redMask).flatten()  # pack into RGBA
-        q_im = QImage(imageRGB, self.image.shape[1], self.image.shape[0], QImage.Format_RGB32)
+        return 255 << 24 | grey << 16 | redMask << 8 | redMask  # pack into RGBA
 
-        self.convertedImage.emit(q_im)
+    def makeQPixMap(self, lut):
+        """
+        This function makes the QImage object
 
+        The colors are looked up straight into the pixel buffer of one of two persistent QImages. The GUI
+        acknowledges each image with imageDisplayed() before the next one is converted so the QImage being
+        drawn is never overwritten.
+
+        INPUTS:
+            lut - packed RGB32 color for each count in [minCountCutoff, maxCountCutoff]
+        """
+        q_im = self._qimages[self._rgbIndex]
+        np.take(lut.astype(np.uint32, copy=False), self._index, out=self._rgb[self._rgbIndex])
+        self._rgbIndex ^= 1
+
+        self.convertedImage.emit(q_im)
 
 
 class MKIDDashboard(QMainWindow):
@@ -270,8 +690,8 @@ class MKIDDashboard(QMainWindow):
         # important variables
         self.threadPool = []  # Holds all the threads so they don't get lost. Also, they're garbage collected if they're attributes of self
         self.workers = []  # Holds workder objects corresponding to threads
-        self.imageList = []  # Holds photon count image data
-        self.fitsList = []
+        self.imageHistory = ImageHistory(self.config.dashboard.get('history_length', 600))  # Recent count images
+        self.fitsList = []  # headers of the frames in the current stream file
         self.timeStreamWindows = []  # Holds PixelTimestreamWindow objects
         self.histogramWindows = []  # Holds PixelHistogramWindow objects
         self.selectedPixels = set()  # Holds the pixels currently selected
@@ -298,15 +718,18 @@ class MKIDDashboard(QMainWindow):
         # Initialize PacketMaster8
         getLogger('Dashboard').info('Initializing packetmaster...')
         imgcfg = dict(self.config.dashboard)
-        imgcfg['n_wave_bins']=1
+        imgcfg.setdefault('n_wave_bins', 1)
         self.packetmaster = Packetmaster(len(self.config.roaches), self.config.packetmaster.captureport,
                                          useWriter=not self.offline, sharedImageCfg={'dashboard': imgcfg},
                                          beammap=self.config.beammap, recreate_images=True)
         self.liveimage = self.packetmaster.sharedImages['dashboard']
 
         self.liveimage.startIntegration(integrationTime=1)
-        data = self.liveimage.receiveImage()
-        getLogger('Dahsboard').debug(data)
+        try:
+            data = self.liveimage.receiveImage()
+            getLogger('Dahsboard').debug(data)
+        except RuntimeError as e:
+            getLogger('Dashboard').warning('No test image from packetmaster: {}'.format(e))
 
         # Laser Controller
         getLogger('Dashboard').info('Setting up laser control...')
@@ -394,12 +817,25 @@ class MKIDDashboard(QMainWindow):
 
         # Setup search for image files from cuber
         getLogger('Dashboard').info('Setting up image searcher...')
-        self.imageFetcher = LiveImageFetcher(self.liveimage, self.config.dashboard.inttime, parent=None)
+        self.imageFetcher = LiveImageFetcher(self.liveimage, self.config.dashboard.inttime,
+                                             continuous=self.config.dashboard.get('continuous', False), parent=None)
         fetcherthread = self.startworker(self.imageFetcher, 'imageFetcher')
         fetcherthread.started.connect(self.imageFetcher.run)
         self.imageFetcher.newImage.connect(self.convertImage)
         self.imageFetcher.finished.connect(fetcherthread.quit)
 
+        # Single background writer for the stream and science fits files
+        self.fitsWriter = FitsWriter(maxqueue=self.config.dashboard.get('writer_queue', 64),
+                                     compression=self.config.dashboard.get('stream_compression', 'RICE_1'))
+        self.fitsWriter.start()
+
+        # Single long lived worker for calibrating and converting images to RGB
+        self.imageConverter = ConvertPhotonsToRGB(self.config.dashboard.min_count_rate,
+                                                  self.config.dashboard.max_count_rate, parent=None)
+        self._converterCal = None  # (dark, flat, mask) currently loaded in the converter
+        converterthread = self.startworker(self.imageConverter, 'imageConverter')
+        self.imageConverter.convertedImage.connect(self.updateImage)
+
         # Setup GUI
         getLogger('Dashboard').info('Setting up GUI...')
         self.setWindowTitle(self.config.instrument + ' Dashboard')
@@ -411,6 +847,7 @@ class MKIDDashboard(QMainWindow):
         # Connect to Filter wheel
         self.setFilter(None)
 
+        converterthread.start()
         QtCore.QTimer.singleShot(10, fetcherthread.start)  # start the thread after a second
 
     def update_tcs(self):
@@ -477,7 +914,8 @@ class MKIDDashboard(QMainWindow):
     def addDarkImage(self, photonImage):
         self.darkFactory = CalFactory('dark', images=(photonImage,))
         self.takingDark = False
-        self.darkField = self.darkFactory.generate(fname=self.darkfile, badmask=self.beammapFailed, save=True,
+        self.darkField = self.darkFactory.generate(fname=self.darkfile, save=True,
+                                                   badmask=self._badmask(photonImage.data),
                                                    name=os.path.splitext(os.path.basename(self.darkfile))[0])
         getLogger('Dashboard').info('Finished dark:\n {}'.format(summarize(self.darkField).replace('\n', '\n  ')))
         self.checkbox_darkImage.setChecked(True)
@@ -488,7 +926,8 @@ class MKIDDashboard(QMainWindow):
     def addFlatImage(self, photonImage):
         self.flatFactory = CalFactory('flat', images=(photonImage,), dark=self.darkField)
         self.takingFlat = False
-        self.flatField = self.flatFactory.generate(fname=self.flatfile, badmask=self.beammapFailed, save=True,
+        self.flatField = self.flatFactory.generate(fname=self.flatfile, save=True,
+                                                   badmask=self._badmask(photonImage.data),
                                                    name=os.path.splitext(os.path.basename(self.flatfile))[0])
         getLogger('Dashboard').info('Finished flat:\n {}'.format(summarize(self.flatField).replace('\n', '\n  ')))
         self.checkbox_flatImage.setChecked(True)
@@ -502,21 +941,28 @@ class MKIDDashboard(QMainWindow):
         We also call this function if we change the image processing controls like
             min/max count rate
         
-        Here we set up a converter object to parse the photon counts into an RBG QImage object
-        We do this in a separate thread because it might take a while to process
+        Here we hand the newest image to the converter worker to parse the photon counts into an RBG QImage object
+        It runs in a separate thread because it might take a while to process
         
         INPUTS:
             photonImage - 2D numpy array of photon counts (type np.uint16 if from ImageSearcher object)
         """
+        tconv = lambda x: (datetime.strptime(x, '%Y-%m-%d %H:%M:%S') - datetime(1970, 1, 1)).total_seconds()
+
         # If there's new data, append it
         if photonImage is not None:
             for k, v in self.last_tcs_poll.items():
                 photonImage.header[k] = v
 
-            self.imageList.append(photonImage)
-            self.fitsList.append(photonImage)  #for the stream
+            if not self.fitsList:
+                tstamp = int(tconv(photonImage.header['utcstart']))
+                self.fitsWriter.open(os.path.join(self.config.paths.data, 'stream{}.fits'.format(tstamp)),
+                                     name=str(tstamp))
+            self.fitsWriter.write(photonImage)  #for the stream
+            self.fitsList.append(photonImage.header)
 
-            self.imageList = self.imageList[-1:]  #trust the garbage collector
+            self.imageHistory.append(photonImage.data, timestamp=tconv(photonImage.header['utcstart']),
+                                     exptime=photonImage.header['exptime'])
 
             if self.takingDark:
                 self.addDarkImage(photonImage)
@@ -524,17 +970,15 @@ class MKIDDashboard(QMainWindow):
                 self.addFlatImage(photonImage)
             elif self.observing:
                 self.sciFactory.add_image(photonImage)
-        elif not self.imageList:
+        elif not len(self.imageHistory):
             return
 
-        # If we've got a full set of data package it as a fits file
-        tconv = lambda x: (datetime.strptime(x, '%Y-%m-%d %H:%M:%S') - datetime(1970, 1, 1)).total_seconds()
-        tstart = tconv(self.fitsList[0].header['utcstart']) if self.fitsList else time.time()
+        # If we've got a full set of data finish the stream fits file, the next frame starts a new one
+        tstart = tconv(self.fitsList[0]['utcstart']) if self.fitsList else time.time()
         tstamp = int(time.time())
-        if ((sum([i.header['exptime'] for i in self.fitsList]) >= self.config.dashboard.fitstime) or
+        if ((sum([h['exptime'] for h in self.fitsList]) >= self.config.dashboard.fitstime) or
             (tstamp - tstart) >= self.config.dashboard.fitstime):
-            combineHDU(self.fitsList, fname=os.path.join(self.config.paths.data, 'stream{}.fits.gz'.format(tstamp)),
-                       name=str(tstamp), save=True, threaded=True)
+            self.fitsWriter.close()
             self.fitsList = []
 
         # Get the (average) photon count image
@@ -555,28 +999,52 @@ class MKIDDashboard(QMainWindow):
                 getLogger('Dashboard').warning('Unable to load flat from {}'.format(self.darkfile))
 
 
-        #NB this really could be moved into the ConvertPhotonsToRGB thread
-        cf = CalFactory('avg', images=self.imageList[-1:],
-                        dark=self.darkField if self.checkbox_darkImage.isChecked() else None,
-                        flat=self.flatField if self.checkbox_flatImage.isChecked() else None)
-        image = cf.generate(name='LiveImage', bias=0)
-        image.data[self.beammapFailed] = np.nan
-
-        # Set up worker object and thread
-        converter = ConvertPhotonsToRGB(image.data,
-                                        self.config.dashboard.min_count_rate,
-                                        self.config.dashboard.max_count_rate,
-                                        self.combobox_stretch.currentText(),
-                                        self.checkbox_interpolate.isChecked(),
-                                        not self.checkbox_smooth.isChecked())  # no red pixels if smoothing
-
-        thread = self.startworker(converter, "convertImage_{}".format(len(self.threadPool)))
-        thread.started.connect(converter.stretchImage)
-        converter.convertedImage.connect(lambda x: thread.quit())
-        converter.convertedImage.connect(self.updateImage)
-        thread.finished.connect(partial(self.threadPool.remove, thread))  # delete these when done to avoid mem leak
-        thread.finished.connect(partial(self.workers.remove, converter))
-        thread.start()  # When it's done converting the worker will emit a convertedImage Signal
+        # Only recompute the converter's calibration arrays when the dark, flat or mask objects change
+        cal = (self.darkField if self.checkbox_darkImage.isChecked() else None,
+               self.flatField if self.checkbox_flatImage.isChecked() else None,
+               self.beammapFailed)
+        if self._converterCal is None or any(a is not b for a, b in zip(cal, self._converterCal)):
+            self._converterCal = cal
+            self.imageConverter.setCalibration(dark=self._calData(cal[0]), flat=self._calData(cal[1]), mask=cal[2])
+
+        # The converter keeps only the newest frame so it can't fall behind
+        self.imageConverter.submit(self.imageHistory.latest(), self.imageHistory.integrationTime(1),
+                                   bands=self.displayBands(),
+                                   minCountCutoff=self.config.dashboard.min_count_rate,
+                                   maxCountCutoff=self.config.dashboard.max_count_rate,
+                                   stretchMode=str(self.combobox_stretch.currentText()),
+                                   interpolate=self.checkbox_interpolate.isChecked(),
+                                   makeRed=not self.checkbox_smooth.isChecked())  # no red pixels if smoothing
+
+    def displayBands(self):
+        """
+        The slice of wavelength bands selected for display, or None to use the whole image. Images that
+        aren't wavelength cubes only have one band so the selection is ignored
+        """
+        if self.imageHistory.nBands <= 1:
+            return None
+        start = min(self.spinbox_bandStart.value(), self.imageHistory.nBands - 1)
+        stop = min(self.spinbox_bandStop.value(), self.imageHistory.nBands - 1)
+        return slice(start, max(start, stop) + 1)
+
+    def updateBandLabel(self):
+        edges = self.liveimage.wvlBinEdges
+        start, stop = self.spinbox_bandStart.value(), self.spinbox_bandStop.value()
+        if stop + 1 < len(edges):
+            self.label_bandRange.setText('{:.0f} - {:.0f} nm'.format(edges[start], edges[stop + 1]))
+
+    def _badmask(self, data):
+        """ The beammap failed mask broadcast to the shape of a 2D image or wavelength cube """
+        if self.beammapFailed is None:
+            return None
+        return np.broadcast_to(self.beammapFailed, np.shape(data))
+
+    @staticmethod
+    def _calData(field):
+        """ The data array of a dark or flat that may be an HDU, an HDUList or None """
+        if field is None:
+            return None
+        return field[0].data if isinstance(field, fits.HDUList) else field.data
 
     @property
     def flatfile(self):
@@ -614,6 +1082,7 @@ class MKIDDashboard(QMainWindow):
 
         q_image = q_image.scaledToWidth(q_image.width() * imageScale)
         self.grPixMap.pixmap().convertFromImage(q_image)
+        self.imageConverter.imageDisplayed()  # pixels are copied out, ready for the next frame
 
         # Possibly smooth image
         self.grPixMap.graphicsEffect().setEnabled(self.checkbox_smooth.isChecked())
@@ -779,23 +1248,29 @@ class MKIDDashboard(QMainWindow):
 
     def getPixCountRate(self, pixelList, numImages2Sum=0, applyDark=False):
         """
-        Get the count rate of a list of pixels.
-        Can be slow :( 
-        Might want to move this to a new thread in future...
-        
+        Get the count rate of a list of pixels from the image history buffer, summed over the displayed bands
+
         INPUTS:
             pixelList - a list or numpy array of pixels (not a set)
-            numImages2Sum - average over this many of the last few images. If None, use the number specified on the GUI int Time box
+            numImages2Sum - sum over this many of the last few images. Defaults to 1
+            applyDark - subtract the dark count rate of the pixels
         """
-        if not len(pixelList):
+        if not len(pixelList) or not len(self.imageHistory):
             return 0
         if numImages2Sum < 1:
             numImages2Sum = 1
+        numImages2Sum = min(numImages2Sum, len(self.imageHistory))
 
-        cf=CalFactory('sum', images=self.imageList[-numImages2Sum:], dark=self.darkField if applyDark else None)
-        im = cf.generate(name='pixelcount')
         pixelList = np.asarray(pixelList)
-        return np.sum(np.asarray(im.data)[[pixelList[:, 1], pixelList[:, 0]]])
+        bands = self.displayBands()
+        val = self.imageHistory.pixelSum(pixelList, numImages2Sum, bands)
+        if applyDark and self.darkField is not None:
+            dark = self._calData(self.darkField)
+            if dark.ndim == 3 and dark.shape[0] == self.imageHistory.nBands:
+                dark = dark[self.imageHistory.bandIndices(bands)].sum(axis=0)
+            if dark.ndim == 2:
+                val -= numImages2Sum * np.sum(dark[pixelList[:, 1], pixelList[:, 0]])
+        return val
 
     def updateSelectedPixelLabels(self):
         """
@@ -928,12 +1403,15 @@ class MKIDDashboard(QMainWindow):
             self.button_obs.clicked.disconnect()
             self.packetmaster.stopobs()
             getLogger('Dashboard').info("Stop Obs")
+            # finish the stream file so every frame up to now is on disk
+            self.fitsWriter.close()
+            self.fitsList = []
             if self.sciFactory is not None:
-                self.sciFactory.generate(threaded=True,
-                                         fname=os.path.join(self.config.paths.data,
-                                                            't{}.fits'.format(int(time.time()))),
-                                         name=str(self.textbox_target.text()),
-                                         save=True, header=self.state())
+                self.fitsWriter.submit(self.sciFactory.generate,
+                                       fname=os.path.join(self.config.paths.data,
+                                                          't{}.fits'.format(int(time.time()))),
+                                       name=str(self.textbox_target.text()),
+                                       save=True, header=self.state())
             else:
                 getLogger('Dashboard').critical('sciFactory is None')
             self.textbox_target.setReadOnly(False)
@@ -1233,6 +1711,25 @@ class MKIDDashboard(QMainWindow):
         # don't bother remaking the current image because it requires taking a new one for a
         # difference to be seen
 
+        # wavelength bands of the live cube to show, summed. Switching only redraws from the history buffer
+        nBands = self.liveimage.nWvlBins
+        self.spinbox_bandStart = QSpinBox()
+        self.spinbox_bandStart.setRange(0, nBands - 1)
+        self.spinbox_bandStart.setValue(0)
+        self.spinbox_bandStop = QSpinBox()
+        self.spinbox_bandStop.setRange(0, nBands - 1)
+        self.spinbox_bandStop.setValue(nBands - 1)
+        self.spinbox_bandStart.valueChanged.connect(self.spinbox_bandStop.setMinimum)
+        self.spinbox_bandStop.valueChanged.connect(self.spinbox_bandStart.setMaximum)
+        self.label_bandRange = QLabel()
+        for spinbox in (self.spinbox_bandStart, self.spinbox_bandStop):
+            spinbox.setEnabled(nBands > 1)
+            spinbox.valueChanged.connect(lambda x: self.updateBandLabel())
+            spinbox.valueChanged.connect(convertSS)
+        spinbox_minLambda.valueChanged.connect(lambda x: self.updateBandLabel())
+        spinbox_maxLambda.valueChanged.connect(lambda x: self.updateBandLabel())
+        self.updateBandLabel()
+
         # Checkbox for dithering image
         # self.checkbox_dither = QCheckBox('Dither Image')
         # self.checkbox_dither.setChecked(False)
@@ -1305,6 +1802,8 @@ class MKIDDashboard(QMainWindow):
 
         vbox.addWidget(self.checkbox_usewave)
         vbox.addLayout(build_hbox((label_lambdaRange, self.spinbox_minLambda, self.spinbox_maxLambda)))
+        vbox.addLayout(build_hbox((QLabel('Bands'), self.spinbox_bandStart, self.spinbox_bandStop,
+                                   self.label_bandRange)))
 
         vbox.addWidget(self.checkbox_showAllPix)
         vbox.addWidget(self.checkbox_interpolate)
@@ -1427,6 +1926,7 @@ class MKIDDashboard(QMainWindow):
         self.turnOffPhotonCapture()  # stop sending photon packets
 
         self.workers[0].search = False  # stop searching for new images
+        self.fitsWriter.stop()  # write out anything still queued
         del self.grPixMap  # Get segfault if we don't delete this. Something about signals in the queue trying to access deleted objects...
         for thread in self.threadPool:  # They should all be done at this point, but just in case
             thread.quit()
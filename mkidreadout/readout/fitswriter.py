@@ -0,0 +1,198 @@
+"""
+Background fits writer for the dashboard
+
+A single persistent thread owns all the fits output of the dashboard. Live frames are streamed into a
+multi-extension fits file one tile compressed extension at a time as they arrive, instead of being
+held in memory and written (and gzipped) in one go by a new thread every fitstime. Any other slow
+product, like the summed science image at the end of an observation, can be handed to the same thread
+with submit() so it never competes with the live display.
+
+The queue is bounded. If the disk can't keep up write() drops the frame and logs it rather than letting
+frames pile up in memory or blocking the GUI, and the queue depth is logged as it fills. The other
+operations wait for room in the queue. stop() drains everything that was queued; anything handed over
+after it is dropped with a warning.
+"""
+import os
+import threading
+import time
+from Queue import Full, Queue
+
+from astropy.io import fits
+
+from mkidcore.corelog import getLogger
+
+COMPRESSION_TYPES = ('RICE_1', 'GZIP_1', 'GZIP_2', 'HCOMPRESS_1', 'PLIO_1', 'none')
+
+
+class FitsWriter(threading.Thread):
+    """
+    Streams HDUs into multi-extension fits files from a background thread
+
+    Usage:
+        writer = FitsWriter(compression='RICE_1')
+        writer.start()
+        writer.open('stream.fits', name='stream')
+        writer.write(hdu)  # once per frame
+        writer.close()  # finish the file, the next open() starts a new one
+        writer.stop()  # drain the queue and end the thread
+    """
+    def __init__(self, maxqueue=64, compression='RICE_1', blocktimeout=5.):
+        """
+        INPUTS:
+            maxqueue - maximum number of pending operations before write() drops frames
+            compression - tile compression for the frame extensions, one of COMPRESSION_TYPES
+            blocktimeout - warn if open(), close() or submit() have been blocked on a full queue for this many
+                           seconds
+        """
+        super(FitsWriter, self).__init__(name='FitsWriter')
+        self.daemon = True
+        if compression not in COMPRESSION_TYPES:
+            raise ValueError('Unknown compression {}. Use one of {}'.format(compression, COMPRESSION_TYPES))
+        self.compression = compression
+        self.blocktimeout = blocktimeout
+        self.queue = Queue(maxsize=max(int(maxqueue), 1))
+        self.filename = None  # file currently being streamed to, as seen by the writer thread
+        self.nWritten = 0
+        self.nDropped = 0
+        self._hdul = None
+        self._stopped = False
+        self._lastwarn = 0
+
+    @property
+    def depth(self):
+        return self.queue.qsize()
+
+    def _put(self, item, block=True):
+        """ Queue item. Returns False if it was dropped because the writer is stopped or, unless block, full """
+        if self._stopped:
+            getLogger(__name__).warning('Fits writer has been stopped, dropping {}'.format(item[0]))
+            return False
+        depth = self.queue.qsize()
+        if depth >= self.queue.maxsize // 2:
+            if time.time() - self._lastwarn > 1:  # don't flood the log while the disk catches up
+                getLogger(__name__).warning('Fits writer queue is {}/{} full'.format(depth, self.queue.maxsize))
+                self._lastwarn = time.time()
+        else:
+            getLogger(__name__).debug('Fits writer queue depth {}'.format(depth))
+        if not block:
+            try:
+                self.queue.put_nowait(item)
+                return True
+            except Full:
+                self.nDropped += 1
+                getLogger(__name__).warning('Fits writer queue is full, dropped {} ({} so far)'.format(item[0],
+                                                                                                     self.nDropped))
+                return False
+        tic = time.time()
+        while True:
+            try:
+                self.queue.put(item, timeout=self.blocktimeout)
+                break
+            except Full:
+                getLogger(__name__).warning('Fits writer blocked on a full queue for {:.0f} s'.format(time.time() - tic))
+        waited = time.time() - tic
+        if waited > .1:
+            getLogger(__name__).info('Fits writer backpressure held the caller for {:.2f} s'.format(waited))
+        return True
+
+    def open(self, fname, name='', header=None):
+        """
+        Start a new multi-extension fits file. Closes any file that is still open
+
+        INPUTS:
+            fname - path of the file. A suffix is added if it already exists
+            name - stored in the primary header NAME key
+            header - dict of extra keys for the primary header
+        """
+        self._put(('open', (fname, name, dict(header) if header else {})))
+
+    def write(self, hdu):
+        """
+        Append an image HDU to the open file as a (compressed) extension. Never blocks, the frame is dropped
+        (and logged) if the queue is full or the writer has been stopped
+
+        INPUTS:
+            hdu - an ImageHDU or PrimaryHDU. Don't modify it after handing it over
+        OUTPUTS:
+            True if the frame was queued
+        """
+        return self._put(('write', hdu), block=False)
+
+    def close(self):
+        """ Finish the current file. Everything written before the call ends up in it """
+        self._put(('close', None))
+
+    def submit(self, func, *args, **kwargs):
+        """ Run func(*args, **kwargs) in the writer thread after everything already queued """
+        self._put(('call', (func, args, kwargs)))
+
+    def flush(self):
+        """ Block until everything queued so far has been written """
+        self.queue.join()
+
+    def stop(self):
+        """ Close the current file and end the thread once the queue is drained """
+        if self._stopped:
+            return
+        self.close()
+        self._stopped = True  # late puts from other threads are dropped from here on
+        self.queue.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                op, arg = item
+                if op == 'open':
+                    self._open(*arg)
+                elif op == 'write':
+                    self._write(arg)
+                elif op == 'close':
+                    self._close()
+                elif op == 'call':
+                    func, args, kwargs = arg
+                    func(*args, **kwargs)
+            except Exception:
+                getLogger(__name__).error('Fits writer failed on {}'.format(item[0]), exc_info=True)
+            finally:
+                self.queue.task_done()
+
+    def _open(self, fname, name, header):
+        self._close()
+        base, ext = os.path.splitext(fname)
+        i = 1
+        while os.path.exists(fname):  # e.g. a new stream file started in the same second
+            fname = '{}_{}{}'.format(base, i, ext)
+            i += 1
+        primary = fits.PrimaryHDU()  # Primaryhdu empty per fits std.
+        primary.header['filename'] = os.path.basename(fname)
+        primary.header['name'] = os.path.basename(name)
+        primary.header.update(header)
+        primary.writeto(fname)
+        self._hdul = fits.open(fname, mode='append')
+        self.filename = fname
+        getLogger(__name__).debug('Streaming frames to {}'.format(fname))
+
+    def _write(self, hdu):
+        if self._hdul is None:
+            getLogger(__name__).warning('No fits file open, dropping frame')
+            return
+        if self.compression == 'none':
+            ext = fits.ImageHDU(data=hdu.data, header=hdu.header)
+        else:
+            ext = fits.CompImageHDU(data=hdu.data, header=hdu.header, compression_type=self.compression)
+        self._hdul.append(ext)
+        self._hdul.flush()  # only the new extension is written in append mode
+        self.nWritten += 1
+
+    def _close(self):
+        if self._hdul is None:
+            return
+        n = len(self._hdul) - 1
+        self._hdul.close()
+        getLogger(__name__).info('Wrote {} frames to {}'.format(n, self.filename))
+        self._hdul = None
+        self.filename = None
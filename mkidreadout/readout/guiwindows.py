@@ -307,17 +307,17 @@ class PixelTimestreamWindow(QMainWindow):
 
     def plotData(self, **kwargs):
         self.setCheckboxText(currentPix=True)
-        countRate = []
-        countRate_cur = []
+        t, countRate = [], []
+        t_cur, countRate_cur = [], []
         if self.checkbox_plotPix.isChecked():
-            countRate = self.getCountRate()
+            t, countRate = self.getCountRate()
         if self.checkbox_plotCurrentPix.isChecked():
-            countRate_cur = self.getCountRate(True)
+            t_cur, countRate_cur = self.getCountRate(True)
         oldx_lim = self.ax.get_xlim()
         oldy_lim = self.ax.get_ylim()
         self.ax.cla()
-        self.ax.plot(countRate, 'g-')
-        self.ax.plot(countRate_cur, 'c-')
+        self.ax.plot(t, countRate, 'g-')
+        self.ax.plot(t_cur, countRate_cur, 'c-')
         if self.mpl_toolbar._active is None:
             self.ax.relim()
             self.ax.autoscale_view(True, True, True)
@@ -329,22 +329,20 @@ class PixelTimestreamWindow(QMainWindow):
         self.draw()
 
     def getCountRate(self, forCurrentPix=False):
-        imageList = self.parent.imageList  #a list of fits hdu
+        history = self.parent.imageHistory  # ring buffer of recent images
         pixList = self.pixelList
         if forCurrentPix:
             pixList = np.asarray([[p[0], p[1]] for p in self.parent.selectedPixels])
 
-        if len(imageList) > 0 and len(pixList) > 0:
-            x = pixList[:, 0]
-            y = pixList[:, 1]
-            c = np.asarray([i.data for i in imageList])[:, y, x]
+        if len(history) > 0 and len(pixList) > 0:
+            c = history.pixelHistory(pixList, bands=self.parent.displayBands())
             countRate = np.sum(c, axis=1)
             if self.checkbox_normalize.isChecked():
                 numZeroPix = (np.sum(c, axis=0) == 0).sum()
                 if len(pixList) > numZeroPix:
                     countRate /= len(pixList) - numZeroPix
-            return countRate
-        return []
+            return history.times() - history.times(1)[0], countRate
+        return [], []
 
     def addData(self, imageList):
         # countRate = np.sum(np.asarray(image)[self.pixelList[:,1],self.pixelList[:,0]])
@@ -465,20 +463,18 @@ class PixelHistogramWindow(QMainWindow):
     '''    
 
     def getCountRateHist(self, forCurrentPix=False):
-        imageList = self.parent.imageList
+        history = self.parent.imageHistory  # ring buffer of recent images
         pixList = self.pixelList
         if forCurrentPix:
             pixList = np.asarray([[p[0], p[1]] for p in self.parent.selectedPixels])
-        if len(imageList) and len(pixList):
-            x = pixList[:, 0]
-            y = pixList[:, 1]
-            c = np.asarray(imageList[-1].data)[y,x]
+        if len(history) > 0 and len(pixList):
+            c = history.pixelHistory(pixList, 1, self.parent.displayBands())[0]  # newest image, displayed bands
             #countRates = np.sum(c,axis=0)
             #if self.checkbox_normalize.isChecked():
             #    countRates/=len(pixList)
             countRateHist, bin_edges = np.histogram(c, bins=50, range=(0, 2500))
             return countRateHist, bin_edges
-        return []
+        return [], [0]
         
     def addData(self, imageList):
         #countRate = np.sum(np.asarray(image)[self.pixelList[:,1],self.pixelList[:,0]])
@@ -51,7 +51,6 @@ int MKIDShmImage_create(MKID_IMAGE_METADATA *imageMetadata, const char *imgName,
     char doneSemName[STRBUFLEN + 11];
     image_t *imgPtr;
     int i;
-    int depth;
 
     mdPtr = (MKID_IMAGE_METADATA*)openShmFile(imgName, sizeof(MKID_IMAGE_METADATA), 1);
 
@@ -61,19 +60,15 @@ int MKIDShmImage_create(MKID_IMAGE_METADATA *imageMetadata, const char *imgName,
     memcpy(mdPtr, imageMetadata, sizeof(MKID_IMAGE_METADATA)); //copy contents of imageMetadata into shared memory buffer
     outputImage->md = mdPtr;
 
-    // CREATE IMAGE DATA BUFFER
-    if(mdPtr->useEdgeBins==1)
-        depth = mdPtr->nWvlBins + 2;
-    else
-        depth = mdPtr->nWvlBins;
-
-    int imageSize = (mdPtr->nCols)*(mdPtr->nRows)*depth;
+    // CREATE IMAGE DATA BUFFER, integrating frame followed by the done frame
+    size_t imageSize = MKIDShmImage_frameSize(mdPtr);
 
-    imgPtr = (image_t*)openShmFile(mdPtr->imageBufferName, sizeof(image_t)*imageSize, 1);
+    imgPtr = (image_t*)openShmFile(mdPtr->imageBufferName, 2*sizeof(image_t)*imageSize, 1);
     if(imgPtr==NULL)
         return -1;
 
     outputImage->image = imgPtr;
+    outputImage->doneImage = imgPtr + imageSize;
 
     // OPEN SEMAPHORES
     outputImage->takeImageSem = sem_open(mdPtr->takeImageSemName, O_CREAT, S_IRUSR | S_IWUSR, 0);
@@ -100,7 +95,6 @@ int MKIDShmImage_open(MKID_IMAGE *imageStruct, const char *imgName){
     image_t *imgPtr;
     char doneSemName[STRBUFLEN + 11];
     int i;
-    int depth;
 
     // OPEN METADATA BUFFER
     mdPtr = (MKID_IMAGE_METADATA*)openShmFile(imgName, sizeof(MKID_IMAGE_METADATA), 0);
@@ -117,17 +111,13 @@ int MKIDShmImage_open(MKID_IMAGE *imageStruct, const char *imgName){
     imageStruct->md = mdPtr;
 
     // OPEN IMAGE BUFFER 
-    if(mdPtr->useEdgeBins==1)
-        depth = mdPtr->nWvlBins + 2;
-    else
-        depth = mdPtr->nWvlBins;
-
-    int imageSize = (mdPtr->nCols)*(mdPtr->nRows)*depth;
-    imgPtr = (image_t*)openShmFile(imageStruct->md->imageBufferName, imageSize*sizeof(image_t), 0);
+    size_t imageSize = MKIDShmImage_frameSize(mdPtr);
+    imgPtr = (image_t*)openShmFile(imageStruct->md->imageBufferName, 2*imageSize*sizeof(image_t), 0);
     if(imgPtr == NULL)
         return -1;
  
     imageStruct->image = imgPtr;
+    imageStruct->doneImage = imgPtr + imageSize;
 
     // OPEN SEMAPHORES
     imageStruct->takeImageSem = sem_open(mdPtr->takeImageSemName, O_CREAT, S_IRUSR | S_IWUSR, 0);
@@ -146,7 +136,6 @@ int MKIDShmImage_open(MKID_IMAGE *imageStruct, const char *imgName){
 
 int MKIDShmImage_close(MKID_IMAGE *imageStruct){
     int i;
-    int depth;
 
     sem_close(imageStruct->takeImageSem);
 
@@ -154,14 +143,7 @@ int MKIDShmImage_close(MKID_IMAGE *imageStruct){
         sem_close(imageStruct->doneImageSemList[i]);
     free(imageStruct->doneImageSemList);
 
-    if(imageStruct->md->useEdgeBins==1)
-        depth = imageStruct->md->nWvlBins + 2;
-    else
-        depth = imageStruct->md->nWvlBins;
-
-    int imageSize = (imageStruct->md->nCols)*(imageStruct->md->nRows)*depth;
-
-    munmap(imageStruct->image, sizeof(image_t)*imageSize);
+    munmap(imageStruct->image, 2*sizeof(image_t)*MKIDShmImage_frameSize(imageStruct->md));
     munmap(imageStruct->md, sizeof(MKID_IMAGE_METADATA));
     return 0;
 
@@ -179,7 +161,10 @@ int MKIDShmImage_populateMD(MKID_IMAGE_METADATA *imageMetadata, const char *name
     imageMetadata->startTime = 0;
     imageMetadata->integrationTime = 0;
     imageMetadata->takingImage = 0;
+    imageMetadata->continuous = 0;
     imageMetadata->valid = 1;
+    imageMetadata->doneValid = 1;
+    imageMetadata->frameSeq = 0;
     snprintf(imageMetadata->name, STRBUFLEN, "%s", name);
     snprintf(imageMetadata->wavecalID, WVLIDLEN, "%s", "none");
     snprintf(imageMetadata->imageBufferName, STRBUFLEN, "%s.buf", name);
@@ -199,6 +184,45 @@ void MKIDShmImage_startIntegration(MKID_IMAGE *image, uint64_t startTime, uint64
     
 }
 
+void MKIDShmImage_setContinuous(MKID_IMAGE *image, int continuous){
+    image->md->continuous = continuous ? 1 : 0;
+
+}
+
+int MKIDShmImage_finishIntegration(MKID_IMAGE *image){
+    image->md->frameSeq++; //odd, readers retry until the copy is done
+    __sync_synchronize();
+    memcpy(image->doneImage, image->image, sizeof(image_t) * MKIDShmImage_frameSize(image->md));
+    image->md->doneValid = image->md->valid;
+    __sync_synchronize();
+    image->md->frameSeq++;
+
+    if(!image->md->continuous){
+        image->md->takingImage = 0;
+        return 0;
+
+    }
+
+    //next integration starts where this one stopped so there is no dead time between frames
+    memset(image->image, 0, sizeof(image_t) * MKIDShmImage_frameSize(image->md));
+    image->md->startTime += image->md->integrationTime;
+    image->md->valid = 1;
+    return 1;
+
+}
+
+size_t MKIDShmImage_frameSize(MKID_IMAGE_METADATA *imageMetadata){
+    int depth;
+
+    if(imageMetadata->useEdgeBins==1)
+        depth = imageMetadata->nWvlBins + 2;
+    else
+        depth = imageMetadata->nWvlBins;
+
+    return (size_t)(imageMetadata->nCols)*(imageMetadata->nRows)*depth;
+
+}
+
 void MKIDShmImage_setWvlRange(MKID_IMAGE *image, int wvlStart, int wvlStop){
     image->md->wvlStart = wvlStart;
     image->md->wvlStop = wvlStop;
@@ -241,6 +265,7 @@ int MKIDShmImage_timedwait(MKID_IMAGE *image, int semInd, int time, int stopImag
     //}
 
     if((retval == -1) && (stopImage)){
+        image->md->continuous = 0;
         image->md->takingImage = 0;
         sem_trywait(image->takeImageSem);
 
@@ -255,16 +280,25 @@ int MKIDShmImage_timedwait(MKID_IMAGE *image, int semInd, int time, int stopImag
 int MKIDShmImage_checkIfDone(MKID_IMAGE *image, int semInd){
     return sem_trywait(image->doneImageSemList[semInd]);}
 
-void MKIDShmImage_copy(MKID_IMAGE *image, image_t *outputBuffer){
-    int depth;
+int MKIDShmImage_copy(MKID_IMAGE *image, image_t *outputBuffer){
+    uint64_t seq;
+    int i;
 
-    if(image->md->useEdgeBins==1)
-        depth = image->md->nWvlBins + 2;
-    else
-        depth = image->md->nWvlBins;
-    int imageSize = (image->md->nCols)*(image->md->nRows)*depth;
+    for(i=0; i<COPY_RETRIES; i++){
+        seq = image->md->frameSeq;
+        __sync_synchronize();
+        if(seq & 1){ //writer is filling the done buffer
+            sched_yield();
+            continue;
 
-    memcpy(outputBuffer, image->image, sizeof(image_t) * imageSize);
+        }
+        memcpy(outputBuffer, image->doneImage, sizeof(image_t) * MKIDShmImage_frameSize(image->md));
+        __sync_synchronize();
+        if(image->md->frameSeq == seq)
+            return 0;
 
-}
+    }
 
+    return -1;
+
+}
@@ -9,6 +9,7 @@
 #include <string.h>
 #include <errno.h>
 #include <time.h>
+#include <sched.h>
 
 // Compile shared object with: gcc -shared -o libmkidshm.so -fPIC mkidshm.c -lrt -lpthread
 
@@ -21,10 +22,11 @@ extern "C" {
 #endif
 
 #define N_DONE_SEMS 10
-#define MKIDSHM_VERSION 3
+#define MKIDSHM_VERSION 4
 #define TIMEDWAIT_FUDGE 500 //half ms
 #define STRBUFLEN 80
 #define WVLIDLEN 150
+#define COPY_RETRIES 100 //attempts at a consistent copy of the done frame
 typedef int image_t; //can mess around with changing this w/o many subsitutions
 typedef float coeff_t;
 
@@ -43,6 +45,9 @@ typedef struct{
     uint64_t startTime; //start timestamp of current integration (same as firmware time)
     uint64_t integrationTime; //integration time in half-ms
     uint32_t takingImage;
+    uint32_t continuous; //if 1 the writer starts the next integration as soon as one is done
+    uint32_t doneValid; //valid flag of the frame in the done buffer
+    uint64_t frameSeq; //incremented before and after the done buffer is written, odd while writing
     char name[STRBUFLEN];
     char imageBufferName[STRBUFLEN]; //form: /imgbuffername (in /dev/shm)
     char takeImageSemName[STRBUFLEN];
@@ -57,7 +62,8 @@ typedef struct{
 
     // For nCounts in pixel (x, y) and wavelength bin i:
     //  image[i*nCols*nRows + y*nCols + x]
-    image_t *image; //pointer to shared memory buffer
+    image_t *image; //pointer to shared memory buffer, the frame being integrated
+    image_t *doneImage; //last completed frame, directly after image in the same buffer
 
     sem_t *takeImageSem; //post to start integration
     sem_t **doneImageSemList; //post when integration is done
@@ -96,13 +102,18 @@ int MKIDShmImage_close(MKID_IMAGE *imageStruct);
 int MKIDShmImage_create(MKID_IMAGE_METADATA *imageMetadata, const char *imgName, MKID_IMAGE *outputImage);
 int MKIDShmImage_populateMD(MKID_IMAGE_METADATA *imageMetadata, const char *name, int nCols, int nRows, int useWvl, int nWvlBins, int useEdgeBins, int wvlStart, int wvlStop);
 void MKIDShmImage_startIntegration(MKID_IMAGE *image, uint64_t startTime, uint64_t integrationTime);
+void MKIDShmImage_setContinuous(MKID_IMAGE *image, int continuous);
+//copies the integrated frame to the done buffer and starts the next one if continuous, returns 1 if continuing
+int MKIDShmImage_finishIntegration(MKID_IMAGE *image);
+size_t MKIDShmImage_frameSize(MKID_IMAGE_METADATA *imageMetadata);
 void MKIDShmImage_wait(MKID_IMAGE *image, int semInd);
 
 //time is in half-ms, cancels integration if stopImage is 1
 int MKIDShmImage_timedwait(MKID_IMAGE *image, int semInd, int time, int stopImage);
 int MKIDShmImage_checkIfDone(MKID_IMAGE *image, int semInd);
 void MKIDShmImage_postDoneSem(MKID_IMAGE *image, int semInd);
-void MKIDShmImage_copy(MKID_IMAGE *image, image_t *ouputBuffer);
+//copies the last completed frame, returns -1 if no consistent copy could be made
+int MKIDShmImage_copy(MKID_IMAGE *image, image_t *ouputBuffer);
 void MKIDShmImage_setWvlRange(MKID_IMAGE *image, int wvlStart, int wvlStop);
 //void MKIDShmImage_setInvalid(MKID_IMAGE *image);
 //void MKIDShmImage_setValid(MKID_IMAGE *image);
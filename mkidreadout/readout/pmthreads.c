@@ -101,6 +101,8 @@ void *shmImageWriter(void *prms)
     uint32_t doneIntMask; //constant - each place value corresponds to a roach board
     SHM_IMAGE_WRITER_PARAMS *params;
     MKID_IMAGE *sharedImages;
+    MKID_IMAGE nextImage; //view of a sharedImage that adds photons to its next frame
+    image_t **nextFrames; //photons for the frame after the one being integrated (continuous mode)
     sem_t *quitSem;
     sem_t *streamSem;
 
@@ -126,11 +128,13 @@ void *shmImageWriter(void *prms)
 
     doneIntegrating = calloc(params->nSharedImages, sizeof(uint32_t));
     sharedImages = (MKID_IMAGE*)malloc(params->nSharedImages*sizeof(MKID_IMAGE));
+    nextFrames = (image_t**)malloc(params->nSharedImages*sizeof(image_t*));
 
     for(imgIdx=0; imgIdx<params->nSharedImages; imgIdx++){
         MKIDShmImage_open(sharedImages+imgIdx, params->sharedImageNames[imgIdx]);
-        memset(sharedImages[imgIdx].image, 0, sizeof(*(sharedImages[imgIdx].image)) * sharedImages[imgIdx].md->nCols * sharedImages[imgIdx].md->nRows); 
-        printf("zeroing block w/ size %lu\n" ,sizeof(*(sharedImages[imgIdx].image)) * sharedImages[imgIdx].md->nCols * sharedImages[imgIdx].md->nRows);
+        memset(sharedImages[imgIdx].image, 0, sizeof(*(sharedImages[imgIdx].image)) * MKIDShmImage_frameSize(sharedImages[imgIdx].md)); 
+        printf("zeroing block w/ size %lu\n" ,sizeof(*(sharedImages[imgIdx].image)) * MKIDShmImage_frameSize(sharedImages[imgIdx].md));
+        nextFrames[imgIdx] = (image_t*)calloc(MKIDShmImage_frameSize(sharedImages[imgIdx].md), sizeof(image_t));
 
     }
 
@@ -185,7 +189,8 @@ void *shmImageWriter(void *prms)
                       strcpy(sharedImages[imgIdx].md->wavecalID, params->wavecal->solutionFile);
                       //sharedImages[imgIdx].md->valid = 1;
                       // zero out array:
-                      memset(sharedImages[imgIdx].image, 0, sizeof(*(sharedImages[imgIdx].image)) * sharedImages[imgIdx].md->nCols * sharedImages[imgIdx].md->nRows); 
+                      memset(sharedImages[imgIdx].image, 0, sizeof(*(sharedImages[imgIdx].image)) * MKIDShmImage_frameSize(sharedImages[imgIdx].md)); 
+                      memset(nextFrames[imgIdx], 0, sizeof(image_t) * MKIDShmImage_frameSize(sharedImages[imgIdx].md));
                       if(sharedImages[imgIdx].md->startTime==0)
                           sharedImages[imgIdx].md->startTime = curTs;
                    
@@ -241,6 +246,15 @@ void *shmImageWriter(void *prms)
                            doneIntegrating[imgIdx] |= (1<<curRoachInd);
                            //printf("SharedImageWriter: Roach %d done Integrating\n", boardNums[curRoachInd]);
 
+                           //in continuous mode this board is already in the next frame, keep its photons for it
+                           if(sharedImages[imgIdx].md->continuous && (curTs<=(sharedImages[imgIdx].md->startTime+2*sharedImages[imgIdx].md->integrationTime)))
+                           {
+                               nextImage = sharedImages[imgIdx];
+                               nextImage.image = nextFrames[imgIdx];
+                               addPacketToImage(&nextImage,packet,i*8 - pstart, params->wavecal);
+
+                           }
+
                        }
 
                        //printf("SharedImageWriter: curTs %lld\n", curTs);
@@ -248,7 +262,15 @@ void *shmImageWriter(void *prms)
 
                        if(doneIntegrating[imgIdx]==doneIntMask) //check to see if all boards are done integrating
                        {
-                           sharedImages[imgIdx].md->takingImage = 0;
+                           //copy to the done buffer, in continuous mode the next frame starts right away
+                           if(MKIDShmImage_finishIntegration(sharedImages + imgIdx))
+                           {
+                               //start the new frame with the photons that arrived while the other boards finished
+                               memcpy(sharedImages[imgIdx].image, nextFrames[imgIdx], sizeof(image_t) * MKIDShmImage_frameSize(sharedImages[imgIdx].md));
+                               memset(nextFrames[imgIdx], 0, sizeof(image_t) * MKIDShmImage_frameSize(sharedImages[imgIdx].md));
+
+                           }
+                           doneIntegrating[imgIdx] = 0;
                            clock_gettime(CLOCK_REALTIME, &stopSpec);
                            //nsElapsed = stopSpec.tv_nsec - startSpec.tv_nsec;
                            MKIDShmImage_postDoneSem(sharedImages + imgIdx, -1);
@@ -280,8 +302,12 @@ void *shmImageWriter(void *prms)
     printf("SharedImageWriter: Freeing stuff\n");
     free(olddata);
     free(boardNums);
-    for(imgIdx=0; imgIdx<params->nSharedImages; imgIdx++)
+    for(imgIdx=0; imgIdx<params->nSharedImages; imgIdx++){
         MKIDShmImage_close(sharedImages+imgIdx);
+        free(nextFrames[imgIdx]);
+
+    }
+    free(nextFrames);
     free(sharedImages);
     free(doneIntegrating);
     sem_close(streamSem);
@@ -15,10 +15,12 @@ cdef extern from "<stdint.h>":
 cdef extern from "<semaphore.h>":
     ctypedef union sem_t:
         pass
+    cdef int sem_trywait(sem_t *sem)
 
 cdef extern from "mkidshm.h":
     ctypedef int image_t
     ctypedef float coeff_t
+    cdef int TIMEDWAIT_FUDGE
 
     #PARTIAL DEFINITION, only exposing necessary attributes
     ctypedef struct MKID_IMAGE_METADATA:
@@ -30,13 +32,18 @@ cdef extern from "mkidshm.h":
         uint32_t wvlStart
         uint32_t wvlStop
         uint32_t valid
-        uint32_t integrationTime
+        uint64_t integrationTime
+        uint32_t takingImage
+        uint32_t continuous
+        uint32_t doneValid
+        uint64_t frameSeq
         char name[80]
         char wavecalID[150]
 
     #PARTIAL DEFINITION, only exposing necessary attributes
     ctypedef struct MKID_IMAGE:
         MKID_IMAGE_METADATA *md
+        sem_t *takeImageSem
 
     ctypedef struct MKID_WAVECAL_METADATA:
         uint32_t nCols
@@ -51,10 +58,11 @@ cdef extern from "mkidshm.h":
     cdef int MKIDShmImage_create(MKID_IMAGE_METADATA *imageMetadata, char *imgName, MKID_IMAGE *outputImage)
     cdef int MKIDShmImage_populateMD(MKID_IMAGE_METADATA *imageMetadata, char *name, int nCols, int nRows, int useWvl, int nWvlBins, int useEdgeBins, int wvlStart, int wvlStop)
     cdef int MKIDShmImage_startIntegration(MKID_IMAGE *image, uint64_t startTime, uint64_t integrationTime)
+    cdef void MKIDShmImage_setContinuous(MKID_IMAGE *image, int continuous)
     cdef int MKIDShmImage_wait(MKID_IMAGE *image, int semInd)
     cdef int MKIDShmImage_timedwait(MKID_IMAGE *image, int semInd, int time, int stopImage) nogil
-    cdef int MKIDShmImage_checkIfDone(MKID_IMAGE *image, int semInd)
-    cdef void MKIDShmImage_copy(MKID_IMAGE *image, image_t *outputBuffer)
+    cdef int MKIDShmImage_checkIfDone(MKID_IMAGE *image, int semInd) nogil
+    cdef int MKIDShmImage_copy(MKID_IMAGE *image, image_t *outputBuffer)
 
 
 cdef class ImageCube(object):
@@ -63,6 +71,7 @@ cdef class ImageCube(object):
     """
     cdef MKID_IMAGE image
     cdef int doneSemInd
+    cdef readonly int nSkipped
 
     def __init__(self, name, doneSemInd=0, **kwargs):
         """
@@ -88,6 +97,7 @@ cdef class ImageCube(object):
         """
 
         self.doneSemInd = doneSemInd
+        self.nSkipped = 0
 
         if not name.startswith('/'):
             name = '/'+name
@@ -127,7 +137,7 @@ cdef class ImageCube(object):
         if rval != 0:
             raise Exception('Error opening shared memory file')
 
-    def startIntegration(self, startTime=0, integrationTime=1):
+    def startIntegration(self, startTime=0, integrationTime=1, continuous=False):
         """
         Tells packetmaster to start an integration for this image
         Parameters
@@ -137,20 +147,84 @@ cdef class ImageCube(object):
                 If 0, start immediately w/ timestamp that packetmaster is currently parsing.
             integrationTime: double
                 integration time in seconds
+            continuous: bool
+                If True packetmaster starts the next integration as soon as one is done, so
+                images follow each other with no dead time until stopIntegration() is called.
         """
         startTime = int(startTime*2000)
         integrationTime = int(integrationTime*2000) #convert to half-ms
+        MKIDShmImage_setContinuous(&(self.image), int(continuous))
         MKIDShmImage_startIntegration(&(self.image), startTime, integrationTime)
 
-    def receiveImage(self):
+    def stopIntegration(self):
         """
-        Waits for doneImage semaphore to be posted by packetmaster,
-        then grabs the image from buffer
+        Leaves continuous mode. The integration in progress still completes
         """
+        MKIDShmImage_setContinuous(&(self.image), 0)
+
+    def cancelIntegration(self):
+        """
+        Abandons the integration in progress (and any that hasn't been picked up by packetmaster yet)
+        """
+        self.image.md.continuous = 0
+        self.image.md.takingImage = 0
+        sem_trywait(self.image.takeImageSem)
+
+    def wait(self, timeout=None):
+        """
+        Waits for the doneImage semaphore to be posted by packetmaster without holding the GIL,
+        so other python threads keep running. Never cancels the integration.
+        Parameters
+        ----------
+            timeout: double
+                seconds to wait, 0 to check without blocking. Defaults to one integration time
+                plus a margin.
+        Returns
+        -------
+            True if an image is done, read it with readImage()
+        """
+        cdef int retval
+        cdef int halfms
+        if timeout is None:
+            halfms = self.image.md.integrationTime
+        else:
+            halfms = int(max(timeout, 0)*2000) - TIMEDWAIT_FUDGE  # timedwait adds the margin
+        with nogil:
+            retval = MKIDShmImage_timedwait(&(self.image), self.doneSemInd, halfms, 0)
+        return retval == 0
+
+    def receiveImage(self, timeout=None):
+        """
+        Waits (without holding the GIL) for doneImage semaphore to be posted by packetmaster,
+        then grabs the image from buffer. Outside of continuous mode an integration that doesn't
+        finish in time is cancelled. In continuous mode images that were completed while the
+        caller was busy are skipped, the newest one is returned.
+        Parameters
+        ----------
+            timeout: double
+                seconds to wait, defaults to one integration time plus a margin.
+        """
+        cdef int retval
+        cdef int halfms
+        cdef int stopImage = 0 if self.image.md.continuous else 1
+        if timeout is None:
+            halfms = self.image.md.integrationTime
+        else:
+            halfms = int(max(timeout, 0)*2000) - TIMEDWAIT_FUDGE
         with nogil:
-            retval = MKIDShmImage_timedwait(&(self.image), self.doneSemInd, self.image.md.integrationTime, 1)
+            retval = MKIDShmImage_timedwait(&(self.image), self.doneSemInd, halfms, stopImage)
+        if retval != 0:
+            raise RuntimeError('No image from packetmaster in time')
+        while self._checkIfDone():  # only the newest image is kept in the buffer
+            self.nSkipped += 1
+        return self.readImage()
+
+    def readImage(self):
+        """
+        Grabs the last completed image from the buffer, call after wait() returns True
+        """
         flatImage = self._readImageBuffer()
-        if not self.valid:
+        if not self.image.md.doneValid:
             raise RuntimeError('Wavecal parameters changed during integration!')
         if self.useWvl:
             return np.reshape(flatImage, self._shape).squeeze()
@@ -169,7 +243,8 @@ cdef class ImageCube(object):
     def _readImageBuffer(self):
         imageSize = self._shape[0] * self._shape[1] * self._shape[2]
         imageBuffer = np.empty(imageSize, dtype=np.intc)
-        MKIDShmImage_copy(&(self.image), <image_t*>np.PyArray_DATA(imageBuffer))
+        if MKIDShmImage_copy(&(self.image), <image_t*>np.PyArray_DATA(imageBuffer)) != 0:
+            raise RuntimeError('Image buffer was overwritten while copying')
         return imageBuffer
 
     def invalidate(self):
@@ -202,6 +277,19 @@ cdef class ImageCube(object):
             depth = self.nWvlBins
         return depth, self.image.md.nRows, self.image.md.nCols
 
+    @property
+    def continuous(self):
+        return bool(self.image.md.continuous)
+
+    @property
+    def integrationTime(self):
+        return self.image.md.integrationTime/2000.
+
+    @property
+    def frameNumber(self):
+        """ Number of images completed since the buffer was created """
+        return self.image.md.frameSeq//2
+
     @property
     def nWvlBins(self):
         return self.image.md.nWvlBins
@@ -404,6 +404,12 @@ class IQsweep:
     def Save(self,filename,roach,wmode):            # Save IQ sweep data into a HDF5 file
         
         h5file = open_file(filename, mode = wmode, title = "IQ sweep file created " + time.asctime() )
+        try:
+            self.SaveTo(h5file,roach)
+        finally:
+            h5file.close()
+
+    def SaveTo(self,h5file,roach):              # Save IQ sweep data into an already open HDF5 file
 
         # if there is no existing roach group, create one
         try:
@@ -510,7 +516,6 @@ class IQsweep:
                      
         swp.append()
         table.flush()       
-        h5file.close()
 
     def Load(self,filename,roach,f0,atten):            # Load the desired IQ sweep data from a HDF5 file
 